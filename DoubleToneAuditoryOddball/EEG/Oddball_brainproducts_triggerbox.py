@@ -66,44 +66,56 @@ event values are in use.
 #%% Import packages
 #------------------------------------------------------------------------------
 
-import soundfile as sf
 import datetime
 import numpy as np
 import os.path as op
 import os
 import matplotlib.pyplot as plt
-import json
 import sys
 
-from psychopy import core, visual
+from psychopy import core
 from psychopy.gui import DlgFromDict
 from psychopy.hardware import keyboard
 
-# Triggerbox
-import serial
-import time
-import threading
+# Shared modules
+sys.path.append(op.join('..','..','common'))
+from sequence_generation import generate_sequences
+from stimulus_bank import load_stimulus_bank
+from soundmexpro_player import SoundMexProPlayer
+from trial_plan import compile_trial_plan
+from hardware_backend import load_backend
+from trial_log import TrialLog, finalize_trial_log
+from trial_runner import TrialRunner
+from keyboard_service import KeyboardService
+from trial_display import TrialDisplay
+from trial_loops import run_trials, start_triggerbox_trial
+from triggerbox import TriggerScheduler, TriggerReader
+
+# Hardware backend: 'hardware' (lab) or 'simulator' (runs without DATAPixx/
+# SoundMexPro/TriggerBox, see common/hardware_backend.py)
+Backend = 'hardware'
+backend = load_backend(Backend)
 
 #%% Brainproducts Triggerbox 
 #------------------------------------------------------------------------------
 
-Connected = True
 PulseWidth = 0.01 # 100 ms
 comPort = "COM6" # needs to be specified
-def ReadThread(port):
-    while Connected:
-        if port.inWaiting() > 0:
-            print ("0x%X"%ord(port.read(1)))
 
 # Open the Windows device manager, search for the "TriggerBox VirtualSerial Port (COM6)"
 # in "Ports (COM & LPT)" and enter the COM port number in the constructor.
-port = serial.Serial(comPort)
-# Start the read thread
-thread = threading.Thread(target=ReadThread, args=(port,))
-thread.start()
-# Set the port to an initial state
-port.write([0x00])
-time.sleep(PulseWidth)
+port = backend.serial.Serial(comPort)
+# Start the read thread: blocking reads with timeout, the bytes echoed by the
+# TriggerBox are recorded with timestamps on the clock of the onsets 
+# (core.getTime, see common/triggerbox.py)
+reader = TriggerReader(port, clock=core.getTime)
+reader.start()
+# Trigger pulses are sent from a worker thread, the trial loop is not blocked
+# for the pulse width (see common/triggerbox.py). start() sets the port to an
+# initial state (0x00). Writes are timestamped on the clock of the onsets 
+# (core.getTime).
+triggers = TriggerScheduler(port, pulse_width=PulseWidth, clock=core.getTime)
+triggers.start()
 
 #%% Settings
 #------------------------------------------------------------------------------
@@ -116,6 +128,10 @@ ShowAudioTracks = True
 fullscrMode = False
 # Show information for current trial
 trialinfo = True
+# Render worker: window and trial info are drawn by a worker thread, the trial 
+# loop only posts the trial state without waiting for the flip (False: drawn 
+# in the trial loop)
+RenderWorker = True
 # Current Soundcard
 # SetSoundcard = 'Fireface' 
 SetSoundcard = 'Fireface' 
@@ -129,12 +145,13 @@ expInfo['Fullscreen Mode'] = str(fullscrMode)
 expInfo['Selected Soundcard'] = SetSoundcard
 expInfo['Show Audio Tracks'] = str(ShowAudioTracks)
 expInfo['Show trial info'] = str(trialinfo)
+expInfo['Render worker'] = str(RenderWorker)
 
 # present a dialogue to change params
 dlg = DlgFromDict(expInfo, 
                   title='Double Tone Auditory Oddball',
-                  fixed=['date','Plot signals','Fullscreen Mode','Selected Soundcard','Show Audio Tracks','Show trial info'], 
-                  order = ['date','sub','run','Target tone','Plot signals','Fullscreen Mode','Selected Soundcard','Show Audio Tracks','Show trial info'],
+                  fixed=['date','Plot signals','Fullscreen Mode','Selected Soundcard','Show Audio Tracks','Show trial info','Render worker'], 
+                  order = ['date','sub','run','Target tone','Plot signals','Fullscreen Mode','Selected Soundcard','Show Audio Tracks','Show trial info','Render worker'],
                   )
 if dlg.OK:
     print(expInfo)
@@ -158,6 +175,15 @@ NumTargets = int(NumTrials * 0.3)
 GapSize = 0.1 # 100 ms
 jitter_interval = [0.5, 0.9] # sec
 
+# Keyboard responses are read every 5 ms by the keyboard service and timestamped
+# on key down, the interval only delays the button trigger.
+ResponsePollInterval = 0.005 # sec
+
+# The values are single bits: pulses that overlap (e.g. a key press within 
+# PulseWidth of the stimulus trigger) are merged by the TriggerScheduler into 
+# their bitwise OR, e.g. 0x05 = target + button. These composite codes are not
+# in event_values, the recorded markers have to be split bit by bit into their
+# events.
 event_values = {
     'target': 0x01,  
     'standard': 0x02, 
@@ -179,52 +205,47 @@ kb.clearEvents() # clear events
 #------------------------------------------------------------------------------
     
 # Setup the Window 
-win = visual.Window(
-    fullscr=fullscrMode, 
-    screen = 2,
-    winType='pyglet', 
-    monitor='testMonitor',
-    color=[0,0,0], # default grey
-    colorSpace='rgb',
-    units='height',
-    checkTiming=False 
-    )
+# Window, fixation cross and trial info are drawn by the TrialDisplay (render 
+# worker with RenderWorker = True, see common/trial_display.py)
+display = TrialDisplay(
+    window = dict(fullscr=fullscrMode, 
+                  screen = 2,
+                  winType='pyglet', 
+                  monitor='testMonitor',
+                  color=[0,0,0], # default grey
+                  colorSpace='rgb',
+                  units='height',
+                  checkTiming=False),
+    # Fixation cross
+    cross = dict(name='textStimulusCross',
+                 text='+',
+                 font='Open Sans',
+                 pos=(0, 0), 
+                 height=0.15, 
+                 wrapWidth=None, 
+                 ori=0.0, 
+                 color='white', 
+                 colorSpace='rgb', 
+                 opacity=None, 
+                 languageStyle='LTR',
+                 depth=-1.0),
+    # Information for the current trial
+    info = dict(name='textStimulusTrial',
+                text='',
+                font='Open Sans',
+                pos=(0, -0.1), 
+                height=0.03, 
+                wrapWidth=None,
+                ori=0.0, 
+                color='white', 
+                colorSpace='rgb', 
+                opacity=None, 
+                languageStyle='LTR',
+                depth=-1.0),
+    threaded = RenderWorker)
 
 # Show fixation cross
-# Initialize components for Routine "Stimulus"
-textStimulusCross = visual.TextStim(win=win, name='textStimulusCross',
-    text='+',
-    font='Open Sans',
-    pos=(0, 0), 
-    height=0.15, 
-    wrapWidth=None, 
-    ori=0.0, 
-    color='white', 
-    colorSpace='rgb', 
-    opacity=None, 
-    languageStyle='LTR',
-    depth=-1.0)
-
-# stimulus is automatically drawn every frame
-textStimulusCross.autoDraw = True
-
-# Initialize components for Routine "Stimulus"
-textStimulusTrial = visual.TextStim(win=win, name='textStimulusTrial',
-    text='',
-    font='Open Sans',
-    pos=(0, -0.1), 
-    height=0.03, 
-    wrapWidth=None,
-    ori=0.0, 
-    color='white', 
-    colorSpace='rgb', 
-    opacity=None, 
-    languageStyle='LTR',
-    depth=-1.0)
-
-textStimulusTrial.autoDraw = True
-
-win.flip()
+display.start()
 
 #%% Welcome Message
 #------------------------------------------------------------------------------
@@ -252,24 +273,10 @@ while not_pressed:
 #%% Build double tones and Triggers
 #------------------------------------------------------------------------------
 
-if target == 'clarinet':
-    sig_target1, fs = sf.read(op.join('stimuli','clarinet_new.wav'))
-    sig_target2, fs = sf.read(op.join('stimuli','clarinet_new_short.wav'))
-    
-    sig_standard1, fs = sf.read(op.join('stimuli','oboe_new.wav'))
-    sig_standard2, fs = sf.read(op.join('stimuli','oboe_new_short.wav'))
-
-elif target == 'oboe':
-    sig_target1, fs = sf.read(op.join('stimuli','oboe_new.wav'))
-    sig_target2, fs = sf.read(op.join('stimuli','oboe_new_short.wav'))
-    
-    sig_standard1, fs = sf.read(op.join('stimuli','clarinet_new.wav'))
-    sig_standard2, fs = sf.read(op.join('stimuli','clarinet_new_short.wav')) 
-    
-# In case of stereo signals, take the first column
-gap =  np.zeros(int(GapSize*fs))
-sig_target = np.concatenate((sig_target1[:,1], gap, sig_target2[:,1]))
-sig_standard = np.concatenate((sig_standard1[:,1], gap, sig_standard2[:,1]))
+# Double tones from the precompiled stimulus bank (see common/stimulus_bank.py)
+bank, fs = load_stimulus_bank('stimuli', target, GapSize)
+sig_target = bank['sig_target']
+sig_standard = bank['sig_standard']
     
 if plot_signals:
     plt.figure()
@@ -291,24 +298,14 @@ rng = np.random.default_rng(seed=None)
 trialtypes = {'standard': 0,
               'target': 1}
 
-playmatrix = np.concatenate((trialtypes['standard']*np.ones(NumStandards,dtype=int),
-                             trialtypes['target']*np.ones(NumTargets,dtype=int)))
-# Here you could impose some special rules on the permutation!
+# The playmatrix is drawn directly from all sequences fullfilling the imposed
+# rules (no rejection sampling, see common/sequence_generation.py)
 # 1: The first four trials are always standards
 # 2: No more than two targets in succession
-
-# Update playmatrix as long as imposed conditions are not fullfilled
-update_playmatrix = True
-while update_playmatrix:
-    
-    condition1 = ~(playmatrix[0:4] == trialtypes['standard']*np.ones(4,dtype=int)).all()
-    # trialtypes['target'] > 0 so that convolution operation works
-    condition2 = (3*trialtypes['target'] in np.convolve(playmatrix,np.ones(3,dtype=int),'full'))
-        
-    if (condition1 or condition2):
-        playmatrix = rng.permutation(playmatrix)
-    else:    
-        update_playmatrix = False
+playmatrix = generate_sequences(NumTrials, NumTargets, 
+                                leading_standards=4, 
+                                max_target_run=2, 
+                                rng=rng)[0]
  
 # triallabel 
 #-----------
@@ -324,8 +321,7 @@ jitterlist = jitterlist.round(decimals=3) # round to ms precision
 ## SoundMexPro
 #-------------
 sys.path.append(bin_dir)
-# import soundmexpro
-from soundmexpro import soundmexpro
+soundmexpro = backend.soundmexpro
 
 smp_cfg = {
     'force': 1, # if set to 1, 'exit' is called internally before init
@@ -365,158 +361,194 @@ if ShowAudioTracks:
     soundmexpro('show')
     soundmexpro('showtracks')        
     
-print('Hardware initialized: SoundMexPro')
+# Buffers of standard and target are built once in Python, every trial still
+# transfers the whole buffer with loadmem (see common/soundmexpro_player.py)
+player = SoundMexProPlayer(soundmexpro,
+                           {'standard': (sig_standard,sig_standard),
+                            'target': (sig_target,sig_target)},
+                           name='audio')
+
+# start device in 'play-zeros-if-no-data-in-tracks'-mode, the device is never
+# stopped, zeros are played endlessly.
+player.start()
+    
+print('Hardware initialized and started: SoundMexPro')
 
 #%% Experiment: Audio + Trigger + Keyboard
 #------------------------------------------------------------------------------
 
-trialClock = core.Clock()
-reaction_times = []
-flag = False # breakout / emergency stop
+# Trial plan
+#-----------
+# Timeline of the whole run on the sample grid of the sound card (jitter 
+# rounded to samples), the trial loop only executes it (see 
+# common/trial_plan.py)
+plan = compile_trial_plan(playmatrix, jitterlist, fs, trialtypes,
+                          frames = {label: player.frames(label) for label in trialtypes},
+                          triggers = {label: event_values[label] for label in trialtypes},
+                          response_types = ['target'])
+
+# Keyboard service and trial runner
+#----------------------------------
+# Escape and space are read on the thread of the keyboard service: escape 
+# cancels the running trial, space presses are timestamped on key down (see 
+# common/keyboard_service.py). The trial loop sleeps until the next poll or the
+# end of the trial (see common/trial_runner.py).
+kb_service = KeyboardService(kb, stop_keys=['escape'], response_keys=['space'])
+runner = TrialRunner(poll_interval=ResponsePollInterval, clock=core.getTime,
+                     cancel=kb_service.cancel)
+
+def poll_trial(passedTime):
+    """
+    Called by the runner every ResponsePollInterval during a trial. Checks the 
+    space bar presses recorded by the keyboard service.
+    """
+    global no_response, response_index
+    
+    # Check only within the response window of the trial (trial plan), new 
+    # responses of the keyboard service
+    if no_response and responseWindow is not None and kb_service.count > response_index:
+        times, names = kb_service.get(response_index)
+        response_index += len(times)
+        # first key press within the response window
+        pressed = np.flatnonzero((times >= responseWindow[0]) & (times < responseWindow[1]))
+        
+        if pressed.size:
+            print('Button pressed')
+            # reaction time from the key-down timestamp
+            reactionTime = float(times[pressed[0]]) - startTime
+            trial_log.write('response', trial=trial, rt=reactionTime, key=names[pressed[0]])
+            print(f"Reaction time: {round(reactionTime,3)} s.") # ms precision
+            
+            # Check pressed button
+            no_response = False # leave if-condition
+    
+            # trialinfo is updated when button is pressed
+            if trialinfo:
+                display.show(text='\n' + str(trial+1) + ' / ' + str(NumTrials) 
+                             + '\nTrial type: ' + triallabel[trial]
+                             + '\nReaction time: ' + str(round(reactionTime,3)) + " s")
+                
+            # Send trigger (merged with a running stimulus trigger)
+            triggers.send(event_values['button'])
+
+    return False
 
-for trial, trialtype in enumerate(playmatrix):
-      
-    if flag:
-        break
+## Path to save data
+#-------------------
+dir2save = op.join('results')
+cfg_results_fname = subject + "task-oddball_" + str(run) + "_cfg_results.json"
+if not os.path.exists(dir2save):
+   os.makedirs(dir2save)
+
+# Trial log: every trial and response is written to disk during the run, an 
+# abort or crash doesn't lose the data (see common/trial_log.py)
+trial_log_fname = op.join(dir2save, subject + "task-oddball_" + str(run) + "_trials.jsonl")
+trial_log = TrialLog(trial_log_fname)
+trial_log.write('run', playmatrix=playmatrix.tolist(), triallabel=triallabel,
+                jitterlist=jitterlist.tolist())
+nextOnset = None # planned onset of the next trial
+if trialinfo:
+    # Trial info of every trial laid out before the first trial
+    display.prepare(['\n' + str(trial+1) + ' / ' + str(NumTrials) + '\nTrial type: ' + label
+                     for trial, label in enumerate(triallabel)])
+
+# Trial loop
+#-----------
+# The trials are started by the shared trial loop (see common/trial_loops.py, 
+# also run by common/timing_benchmark.py), the script adds console output, 
+# trial info and trial log.
+def before_trial(index):
+    """
+    Console output, trial info and reset of the response detection.
+    """
+    global trial, trialtype, no_response, response_index
+    trial = index
+    trialtype = playmatrix[trial]
     
     # Standard
     #---------
     if trialtype == trialtypes['standard']:
-        audio = sig_standard
-        trigVal = event_values['standard']
         print('\nStandard trial')
         print('--------------')
         
     # Target
     #-------
     elif trialtype == trialtypes['target']:
-        audio = sig_target
-        trigVal = event_values['target']
         print('\nTarget trial')
         print('------------')
         
     if trialinfo:
-        textStimulusTrial.setText('\n' + str(trial+1) + ' / ' + str(NumTrials) 
-        + '\nTrial type: ' + triallabel[trial])
-        win.flip()
+        display.show(trial)
         
     # Reset for detecting button presses
     no_response = True
-        
-    # Load data onto analog channels
-    #--------------------------------------------------------------------------
-    # Concatenate data into matrix
-    analog_signal = np.stack((audio,audio),axis=1)
-    
-    # IMPORTANT NOTE: reading waves to memory with python creates interleaved data in memory, bit_length
-    # soundmexpro needs non-interleaved data: so force rearranging in memory!!
-    analog_signal = np.asfortranarray(analog_signal)  
-    
-    StimDur = len(audio) / fs
-    
-    # Reset times
-    #------------
-    kb.clock.reset()  # timer (re)starts
-    trialClock.reset()
-   
-    # Load data into memory and start playback
-    #-----------------------------------------
-    smp_cfg = {
-        'data': analog_signal,
-        'track': [0, 1],                         
-        'loopcount': 1,  
-        'name': 'audio + trigger',                    
-        }
-    soundmexpro('loadmem', smp_cfg)
-    
-    # Start playback and send trigger (time-aligned)
-    smp_cfg = {
-        'length' : -1, # device is stopped (playback and record) after all tracks played their data.
-        }
-    soundmexpro('start', smp_cfg)
-    
-    # Send trigger
-    #-------------
-    port.write([trigVal])
-    time.sleep(PulseWidth)
-    # Reset Bit 0, Pin 2 of the Output(to Amp) connector
-    port.write([0x00])
-    time.sleep(PulseWidth)
-    
+    response_index = kb_service.count
+
+def start_trial(trial):
+    """
+    Loads the prebuilt buffer into the running device and sends the trigger
+    (reset after PulseWidth by the scheduler). Onset on the host clock 
+    (core.getTime).
+    """
+    onset = start_triggerbox_trial(player, plan[trial], triggers, clock = runner.clock)
     if ShowAudioTracks:
         soundmexpro('updatetracks') 
-        
-    TrialDur = StimDur + jitterlist[trial]
-    while trialClock.getTime() < TrialDur:  
-        
-        # Check only for deviants
-        if (trialtype == trialtypes['target']):
-              
-                if 'space' in keys:
-                    print('Button pressed')
-                    # reaction time - only look at first key
-                    reactionTime = keys[0].rt
-                    reaction_times.append(reactionTime)
-                    print(f"Reaction time: {round(reactionTime,3)} s.") # ms precision
-                    
-                    # Check pressed button
-                    no_response = False # leave if-condition
-            
-                    # trialinfo is updated when button is pressed
-                    if trialinfo:
-                        textStimulusTrial.setText('\n' + str(trial+1) + ' / ' + str(NumTrials) 
-                        + '\nTrial type: ' + triallabel[trial]
-                        + '\nReaction time: ' + str(round(reactionTime,3)) + " s")
-                        win.flip()
-                        
-                    # Send trigger
-                    port.write([event_values['button']])
-                    time.sleep(PulseWidth)
-                    # Reset Bit 0, Pin 2 of the Output(to Amp) connector
-                    port.write([0x00])
-                    time.sleep(PulseWidth)
-            
-        # wait 1 ms before refresh?!
-        core.wait(0.001)
+    return onset, plan[trial].trial_dur, onset
+
+def trial_started(trial, onset, TrialDur):
+    global startTime, responseWindow, nextOnset
+    startTime = onset
+    responseWindow = plan.response_window(trial, startTime)
+    trial_log.write('trial', trial=trial, label=triallabel[trial], trigger=plan[trial].trigger,
+                    planned_onset=nextOnset, onset=startTime, duration=TrialDur)
+    nextOnset = startTime + TrialDur
+
+def trial_finished(trial, aborted):
+    # Emergency stop (escape)
+    if aborted:
+        print('\n!!!Experiment stopped!!!')
+        player.exit()
             
-    if trialtype == trialtypes['target'] and no_response:
+    if responseWindow is not None and no_response:
         reactionTime = float('inf')
-        reaction_times.append(reactionTime)
+        trial_log.write('response', trial=trial, rt=reactionTime)
         print('No Button pressed')
         print(f"Reaction time: {reactionTime} s.")
         
     print(f"Trial {trial+1} of {NumTrials} played.")
-        
+
+kb_service.start()
+# Sleep until the next poll or the end of the trial
+run_trials(NumTrials, start_trial, runner, poll=poll_trial, before=before_trial, 
+           started=trial_started, finished=trial_finished)
+
+kb_service.stop()
 print('\nAudio playback finished.')
 
+# Send pending trigger pulses and stop the scheduler
+triggers.close()
+# Terminate the read thread after the last echo
+core.wait(0.1)
+reader.stop()
+echo_times, echo_values = reader.get()
+
 #%% Save experiment configuration
 #------------------------------------------------------------------------------
-results_cfg = {
-       'playmatrix': playmatrix.tolist(),
-       'triallabel': triallabel,
-       'jitterlist': jitterlist.tolist(),
-       'reaction times': reaction_times,
-       }
-
-## Path to save data
-#-------------------
-dir2save = op.join('results')
-cfg_results_fname = subject + "task-oddball_" + str(run) + "_cfg_results.json"
-if not os.path.exists(dir2save):
-   os.makedirs(dir2save)
-   
-with open(op.join(dir2save,cfg_results_fname), "w") as outfile:
-    json.dump(results_cfg, outfile)    
+# Summary of the run assembled from the trial log
+trial_log.close()
+results_cfg = finalize_trial_log(
+    trial_log_fname, op.join(dir2save,cfg_results_fname),
+    **{'trigger writes': [[t, value] for t, value in triggers.log], # host clock in s
+       'dropped triggers': triggers.dropped,
+       'trigger echoes': [[t, int(value)] for t, value in zip(echo_times, echo_values)], # host clock in s
+       })
 
 #%% Closing the connection to hardware
 #------------------------------------------------------------------------------
 core.wait(2) 
-# Terminate the read thread
-Connected = False
-thread.join(1.0)
 # Close the serial port
 port.close()
 
-soundmexpro('exit')
-win.close()
+player.exit()
+display.close()
 
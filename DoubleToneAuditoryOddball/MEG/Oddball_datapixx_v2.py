@@ -102,21 +102,37 @@ channels 16-23).
 #%% Import packages
 #------------------------------------------------------------------------------
 
-from pypixxlib import _libdpx as dp
-from pypixxlib import responsepixx as rp
-import soundfile as sf
 import datetime
 import numpy as np
 import os.path as op
 import os
 import matplotlib.pyplot as plt
-import json
 import sys
 
-from psychopy import core, visual
+from psychopy import core
 from psychopy.gui import DlgFromDict
 from psychopy.hardware import keyboard
 
+# Shared modules
+sys.path.append(op.join('..','..','common'))
+from sequence_generation import generate_sequences
+from trial_runner import TrialRunner
+from trial_plan import compile_trial_plan
+from stimulus_bank import load_stimulus_bank
+from hardware_backend import load_backend
+from trial_log import TrialLog, finalize_trial_log
+from response_acquisition import ResponseAcquisition
+from keyboard_service import KeyboardService
+from trial_display import TrialDisplay
+from trial_loops import run_trials, start_datapixx_trial, reset_trigger
+
+# Hardware backend: 'hardware' (lab) or 'simulator' (runs without DATAPixx/
+# SoundMexPro/TriggerBox, see common/hardware_backend.py)
+Backend = 'hardware'
+backend = load_backend(Backend)
+dp = backend.dp
+rp = backend.rp
+
 #%% Settings
 #------------------------------------------------------------------------------
 
@@ -126,6 +142,13 @@ plot_signals = False
 fullscrMode = False
 # Show information for current trial
 trialinfo = True
+# Render worker: window and trial info are drawn by a worker thread, the trial 
+# loop only posts the trial state without waiting for the flip (False: drawn 
+# in the trial loop)
+RenderWorker = True
+# Write standard and target once into DATAPixx RAM (preloaded bank) instead of
+# uploading the audio buffer in every trial
+preload_bank = True
 
 # Experiment info gui
 #--------------------
@@ -134,12 +157,14 @@ expInfo['date'] = str(datetime.datetime.now())
 expInfo['Plot signals'] = str(plot_signals)
 expInfo['Fullscreen Mode'] = str(fullscrMode)
 expInfo['Show trial info'] = str(trialinfo)
+expInfo['Render worker'] = str(RenderWorker)
+expInfo['Preload bank'] = str(preload_bank)
 
 # present a dialogue to change params
 dlg = DlgFromDict(expInfo, 
                   title='Double Tone Auditory Oddball',
-                  fixed=['date','Plot signals','Fullscreen Mode','Show trial info'], 
-                  order = ['date','sub','run','Target tone','Plot signals','Fullscreen Mode','Show trial info'],
+                  fixed=['date','Plot signals','Fullscreen Mode','Show trial info','Render worker','Preload bank'], 
+                  order = ['date','sub','run','Target tone','Plot signals','Fullscreen Mode','Show trial info','Render worker','Preload bank'],
                   )
 if dlg.OK:
     print(expInfo)
@@ -187,6 +212,9 @@ buttonSubset = [button_mapping['blue']]
 buttonDevice = 'mri 10 button'
 recordPushes = True
 recordReleases = False
+# Button log and escape key are read every 10 ms. Button presses are timestamped
+# by the device, so the interval doesn't affect the reaction times.
+ButtonPollInterval = 0.01 # sec
 
 # Channel mapping for AnalogOut
 #------------------------------
@@ -201,52 +229,47 @@ kb.clearEvents() # clear events
 #------------------------------------------------------------------------------
     
 # Setup the Window 
-win = visual.Window(
-    fullscr=fullscrMode, 
-    screen = 2,
-    winType='pyglet', 
-    monitor='testMonitor',
-    color=[0,0,0], # default grey
-    colorSpace='rgb',
-    units='height',
-    checkTiming=False 
-    )
+# Window, fixation cross and trial info are drawn by the TrialDisplay (render 
+# worker with RenderWorker = True, see common/trial_display.py)
+display = TrialDisplay(
+    window = dict(fullscr=fullscrMode, 
+                  screen = 2,
+                  winType='pyglet', 
+                  monitor='testMonitor',
+                  color=[0,0,0], # default grey
+                  colorSpace='rgb',
+                  units='height',
+                  checkTiming=False),
+    # Fixation cross
+    cross = dict(name='textStimulusCross',
+                 text='+',
+                 font='Open Sans',
+                 pos=(0, 0), 
+                 height=0.15, 
+                 wrapWidth=None, 
+                 ori=0.0, 
+                 color='white', 
+                 colorSpace='rgb', 
+                 opacity=None, 
+                 languageStyle='LTR',
+                 depth=-1.0),
+    # Information for the current trial
+    info = dict(name='textStimulusTrial',
+                text='',
+                font='Open Sans',
+                pos=(0, -0.1), 
+                height=0.03, 
+                wrapWidth=None,
+                ori=0.0, 
+                color='white', 
+                colorSpace='rgb', 
+                opacity=None, 
+                languageStyle='LTR',
+                depth=-1.0),
+    threaded = RenderWorker)
 
 # Show fixation cross
-# Initialize components for Routine "Stimulus"
-textStimulusCross = visual.TextStim(win=win, name='textStimulusCross',
-    text='+',
-    font='Open Sans',
-    pos=(0, 0), 
-    height=0.15, 
-    wrapWidth=None, 
-    ori=0.0, 
-    color='white', 
-    colorSpace='rgb', 
-    opacity=None, 
-    languageStyle='LTR',
-    depth=-1.0)
-
-# stimulus is automatically drawn every frame
-textStimulusCross.autoDraw = True
-
-# Initialize components for Routine "Stimulus"
-textStimulusTrial = visual.TextStim(win=win, name='textStimulusTrial',
-    text='',
-    font='Open Sans',
-    pos=(0, -0.1), 
-    height=0.03, 
-    wrapWidth=None,
-    ori=0.0, 
-    color='white', 
-    colorSpace='rgb', 
-    opacity=None, 
-    languageStyle='LTR',
-    depth=-1.0)
-
-textStimulusTrial.autoDraw = True
-
-win.flip()
+display.start()
 
 #%% Welcome Message
 #------------------------------------------------------------------------------
@@ -273,24 +296,10 @@ while not_pressed:
 #%% Build double tones and triggers
 #------------------------------------------------------------------------------
 
-if target == 'clarinet':
-    sig_target1, fs = sf.read(op.join('stimuli','clarinet_new.wav'))
-    sig_target2, fs = sf.read(op.join('stimuli','clarinet_new_short.wav'))
-    
-    sig_standard1, fs = sf.read(op.join('stimuli','oboe_new.wav'))
-    sig_standard2, fs = sf.read(op.join('stimuli','oboe_new_short.wav'))
-
-elif target == 'oboe':
-    sig_target1, fs = sf.read(op.join('stimuli','oboe_new.wav'))
-    sig_target2, fs = sf.read(op.join('stimuli','oboe_new_short.wav'))
-    
-    sig_standard1, fs = sf.read(op.join('stimuli','clarinet_new.wav'))
-    sig_standard2, fs = sf.read(op.join('stimuli','clarinet_new_short.wav')) 
-    
-# In case of stereo signals, take the first column
-gap =  np.zeros(int(GapSize*fs))
-sig_target = np.concatenate((sig_target1[:,1], gap, sig_target2[:,1]))
-sig_standard = np.concatenate((sig_standard1[:,1], gap, sig_standard2[:,1]))
+# Double tones from the precompiled stimulus bank (see common/stimulus_bank.py)
+bank, fs = load_stimulus_bank('stimuli', target, GapSize)
+sig_target = bank['sig_target']
+sig_standard = bank['sig_standard']
  
 if plot_signals:
     plt.figure()
@@ -312,24 +321,14 @@ rng = np.random.default_rng(seed=None)
 trialtypes = {'standard': 0,
               'target': 1}
 
-playmatrix = np.concatenate((trialtypes['standard']*np.ones(NumStandards,dtype=int),
-                             trialtypes['target']*np.ones(NumTargets,dtype=int)))
-# Here you could impose some special rules on the permutation!
+# The playmatrix is drawn directly from all sequences fullfilling the imposed
+# rules (no rejection sampling, see common/sequence_generation.py)
 # 1: The first four trials are always standards
 # 2: No more than two targets in succession
-
-# Update playmatrix as long as imposed conditions are not fullfilled
-update_playmatrix = True
-while update_playmatrix:
-    
-    condition1 = ~(playmatrix[0:4] == trialtypes['standard']*np.ones(4,dtype=int)).all()
-    # trialtypes['target'] > 0 so that convolution operation works
-    condition2 = (3*trialtypes['target'] in np.convolve(playmatrix,np.ones(3,dtype=int),'full'))
-        
-    if (condition1 or condition2):
-        playmatrix = rng.permutation(playmatrix)
-    else:    
-        update_playmatrix = False
+playmatrix = generate_sequences(NumTrials, NumTargets, 
+                                leading_standards=4, 
+                                max_target_run=2, 
+                                rng=rng)[0]
  
 # triallabel 
 #-----------
@@ -382,6 +381,13 @@ print('Automatic button schedule is running.\n')
 listener = rp.ButtonListener(buttonDevice) 
 dp.DPxWriteRegCache()
 
+# Button acquisition: the button log is read on its own thread every 
+# ButtonPollInterval, every press is kept with its device timestamp. Register 
+# accesses of the trial loop hold acquisition.lock (see 
+# common/response_acquisition.py).
+acquisition = ResponseAcquisition(dp, listener, interval=ButtonPollInterval,
+                                  recordPushes=recordPushes, recordReleases=recordReleases)
+
 # Remark signalLength + 1
 # Since the last value of the waveform gets replaced by the default value almost 
 # instantly, your device reading the Digital In signal might not be triggered 
@@ -390,157 +396,211 @@ dp.DPxWriteRegCache()
 # Analog schedules
 #-----------------
 AnalogbufferAddress = int(0)
+
+# Preloaded bank
+#---------------
+# Standard and target are written once to two fixed buffer addresses. Per trial 
+# only the base address of the DacSchedule is selected, so no audio data has to
+# be transferred via USB right before the onset.
+# 2 bytes per sample and channel are needed in the DATAPixx RAM.
+bankAddresses = {'standard': int(0),
+                 'target': int(4e6),
+                 }
+
+if preload_bank:
+    bank_signals = {'standard': np.stack((sig_standard,sig_standard),axis=0),
+                    'target': np.stack((sig_target,sig_target),axis=0),
+                    }
+    # Check that the buffers don't overlap with each other or the button schedule
+    bankEnd = bankAddresses['standard'] + 2*bank_signals['standard'].size
+    if bankEnd > bankAddresses['target']:
+        raise ValueError('Standard buffer overlaps with target buffer in DATAPixx RAM.')
+    bankEnd = bankAddresses['target'] + 2*bank_signals['target'].size
+    if bankEnd > baseAddressButton:
+        raise ValueError('Target buffer overlaps with button schedule in DATAPixx RAM.')
+    
+    for name in ['standard','target']:
+        dp.DPxWriteDacBuffer(bufferData = bank_signals[name], 
+                             bufferAddress = bankAddresses[name], 
+                             channelList = channel)
+    dp.DPxWriteRegCache()
+    print('Standard and target written to DATAPixx RAM (preloaded bank).\n')
+        
+# Trial plan
+#-----------
+# Timeline of the whole run on the DAC sample grid (jitter rounded to samples),
+# the trial loop only executes it (see common/trial_plan.py)
+plan = compile_trial_plan(playmatrix, jitterlist, fs, trialtypes,
+                          frames = {'standard': len(sig_standard), 'target': len(sig_target)},
+                          addresses = bankAddresses if preload_bank else AnalogbufferAddress,
+                          triggers = {'standard': event_values['standard'], 'target': event_values['target']},
+                          response_types = ['target'])
         
 #%% Audio + Trigger
 #------------------------------------------------------------------------------
 
-reaction_times = []
-flag = False # breakout / emergency stop
+# Trial runner
+#-------------
+# The trial loop sleeps until the next event (trigger off, button poll, end of trial)
+# instead of reading the registers every millisecond.
+# Keyboard service: the emergency stop (escape) is read on its own thread and 
+# cancels the running trial (see common/keyboard_service.py)
+kb_service = KeyboardService(kb, stop_keys=['escape'], response_keys=[])
+runner = TrialRunner(poll_interval=ButtonPollInterval, cancel=kb_service.cancel)
+
+def poll_trial(passedTime):
+    """
+    Called by the runner every ButtonPollInterval during a trial. Checks the 
+    button events recorded by the acquisition thread (no register access).
+    """
+    global no_response, response_index
+    
+    # Check only within the response window of the trial (trial plan), new 
+    # events of the acquisition thread
+    if no_response and responseWindow is not None and acquisition.count > response_index:
+        times, buttons = acquisition.get(response_index)
+        response_index += len(times)
+        # first press of a response button within the response window
+        pressed = np.flatnonzero(np.isin(buttons, buttonSubset) & (times >= responseWindow[0])
+                                 & (times < responseWindow[1]))
+
+        if pressed.size:
+            print(f"Button presses! {list(zip(times.tolist(), buttons.tolist()))}")
+            timestamp = float(times[pressed[0]])
+            button = int(buttons[pressed[0]])
+
+            # Append reaction time
+            reactionTime = timestamp - startTime
+            trial_log.write('response', trial=trial, rt=reactionTime, button=button,
+                            timestamp=timestamp)
+            print(f"Reaction time: {reactionTime} s.")
+
+            # Check pressed button
+            no_response = False # leave if-condition
+
+            # trialinfo is updated when button is pressed
+            if trialinfo:
+                display.show(text='\n' + str(trial+1) + ' / ' + str(NumTrials) 
+                             + '\nTrial type: ' + triallabel[trial]
+                             + '\nReaction time: ' + str(round(reactionTime,3)) + " s")
+
+    return False
+
+def trigger_off():
+    """
+    Turns off the trigger channels TrigLen after the onset.
+    """
+    reset_trigger(dp, acquisition.lock)
+
+## Path to save data
+#-------------------
+dir2save = op.join('results')
+cfg_results_fname = subject + "task-oddball_" + str(run) + "_cfg_results.json"
+if not os.path.exists(dir2save):
+   os.makedirs(dir2save)
 
-for trial, trialtype in enumerate(playmatrix):
-      
-    # emergency stop
-    if flag:
-        break
+# Trial log: every trial and response is written to disk during the run, an 
+# abort or crash doesn't lose the data (see common/trial_log.py)
+trial_log_fname = op.join(dir2save, subject + "task-oddball_" + str(run) + "_trials.jsonl")
+trial_log = TrialLog(trial_log_fname)
+trial_log.write('run', playmatrix=playmatrix.tolist(), triallabel=triallabel,
+                jitterlist=jitterlist.tolist())
+nextOnset = None # planned onset of the next trial
+if trialinfo:
+    # Trial info of every trial laid out before the first trial
+    display.prepare(['\n' + str(trial+1) + ' / ' + str(NumTrials) + '\nTrial type: ' + label
+                     for trial, label in enumerate(triallabel)])
+
+# Trial loop
+#-----------
+# Playback and trigger are started by the shared trial loop (see 
+# common/trial_loops.py, also run by common/timing_benchmark.py), the script 
+# adds console output, trial info and trial log.
+def before_trial(index):
+    """
+    Console output, trial info and reset of the response detection.
+    """
+    global trial, trialtype, no_response, response_index
+    trial = index
+    trialtype = playmatrix[trial]
     
     # Standard
     #---------
     if trialtype == trialtypes['standard']:
-        audio = sig_standard
-        trigVal = event_values['standard']
         print('\nStandard trial')
         print('--------------')
         
     # Target
     #-------
     elif trialtype == trialtypes['target']:
-        audio = sig_target
-        trigVal = event_values['target']
         print('\nTarget trial')
         print('------------')
 
     if trialinfo:
-        textStimulusTrial.setText('\n' + str(trial+1) + ' / ' + str(NumTrials) 
-        + '\nTrial type: ' + triallabel[trial])
-        win.flip()
+        display.show(trial)
         
     # Reset for detecting button presses
     no_response = True
-    # Reset audio trigger
-    no_trigger = True
-        
-    # Load data (audio + trigger) onto analog channels
-    #--------------------------------------------------------------------------
-    # nChans x nFrame list where each row of the matrix contains the sample data 
-    # for one DAC channel. Each column of the list contains one sample for each DAC channel.
-    analog_signal = np.stack((audio,audio),axis=0)
-    
-    numBufferFrames = len(audio)
-    maxScheduleFrames = numBufferFrames
-    StimDur = numBufferFrames / fs
-    dp.DPxWriteDacBuffer(bufferData = analog_signal, 
-                         bufferAddress = AnalogbufferAddress, 
-                         channelList = channel)
-    dp.DPxWriteRegCache()
-    
-    # Start playback
-    #--------------------------------------------------------------------------
-    dp.DPxSetDacSchedule(onSet = 0, # Onset delay
-                         rateValue = fs, # sampling rate
-                         rateUnits = "Hz", # rateUnits (str) – This can have three values: “Hz” for samples/seconds, “video” for samples/video frame or “nano” for seconds/samples
-                         maxScheduleFrames = maxScheduleFrames, 
-                         channelList = channel, # If provided, it needs to be a list of size nChans.
-                         bufferBaseAddress = AnalogbufferAddress, 
-                         numBufferFrames = numBufferFrames)
-    dp.DPxStartDacSched() 
-    
-    # Turn on trigger channels  
-    dp.DPxSetDoutValue(bit_value = trigVal, # turn on specific trigger channel
-                       bit_mask = 16777215) # '111111111111111111111111' enable all 24 pins
-    
-    dp.DPxUpdateRegCache() # Read and Write (initiating sound and trigger at the same time)
-    startTime = dp.DPxGetTime()
-    passedTime = 0
-    
-    TrialDur = StimDur + jitterlist[trial] 
-    while passedTime < (TrialDur): # check passed time  
-        dp.DPxUpdateRegCache()
-        currentTime = dp.DPxGetTime()     
-        passedTime = currentTime - startTime
-        
-        keys = kb.getKeys(['escape'])
-        # Emergency stop
-        if 'escape' in keys:
-            print('\n!!!Experiment stopped!!!')
-            flag = True
-            break
-        
-        # Turn off trigger channels 
-        if passedTime > 0.1 and no_trigger: # after 100 ms
-            dp.DPxSetDoutValue(bit_value = 0, # turn off all channels
-                               bit_mask = 16777215) # '111111111111111111111111' enable all 24 pins
-            no_trigger = False
-        
-        if (no_response):
-            listener.updateLogs()
-            output = listener.getNewButtonActivity(buttonSubset, recordPushes, recordReleases)
-            
-            # Check only for target trials
-            if (trialtype == trialtypes['target']):
-                
-                if output != []:
-                    # this prints out the timestamp of the last button push and the button that was pushed
-                    print(f"Button presses! {output}")
-                    timestamp = output[-1][0]
-                    button = output[-1][1] # index only the last button that was pushed
-                    
-                    # Append reaction time
-                    reactionTime = timestamp - startTime
-                    reaction_times.append(reactionTime)
-                    print(f"Reaction time: {reactionTime} s.")
-                   
-                    # Check pressed button
-                    no_response = False # leave if-condition
-                    
-                    # trialinfo is updated when button is pressed
-                    if trialinfo:
-                        textStimulusTrial.setText('\n' + str(trial+1) + ' / ' + str(NumTrials) 
-                        + '\nTrial type: ' + triallabel[trial]
-                        + '\nReaction time: ' + str(round(reactionTime,3)) + " s")
-                        win.flip()
-                        
-        # wait 1 ms before refresh?!
-        core.wait(0.001) 
+    response_index = acquisition.count
+
+def start_trial(trial):
+    """
+    Starts playback and trigger of a trial. Without preloaded bank the audio
+    (audio + trigger) is loaded onto the analog channels first.
+    """
+    analog_signal = None
+    if not preload_bank:
+        audio = sig_standard if playmatrix[trial] == trialtypes['standard'] else sig_target
+        # nChans x nFrame list where each row of the matrix contains the sample data 
+        # for one DAC channel. Each column of the list contains one sample for each DAC channel.
+        analog_signal = np.stack((audio,audio),axis=0)
+    # Buffer address from the plan (preloaded bank: buffer of the trial type)
+    onset, hostOnset = start_datapixx_trial(dp, plan[trial], fs, channel, acquisition.lock, 
+                                            data = analog_signal, clock = runner.clock)
+    return onset, plan[trial].trial_dur, hostOnset
+
+def trial_started(trial, onset, TrialDur):
+    global startTime, responseWindow, nextOnset
+    startTime = onset
+    responseWindow = plan.response_window(trial, startTime)
+    trial_log.write('trial', trial=trial, label=triallabel[trial], trigger=plan[trial].trigger,
+                    planned_onset=nextOnset, onset=startTime, duration=TrialDur)
+    nextOnset = startTime + TrialDur
+
+def trial_finished(trial, aborted):
+    # Emergency stop (escape)
+    if aborted:
+        print('\n!!!Experiment stopped!!!')
+        trigger_off() # in case the trial was stopped before TrigLen
         
     # in case no button has been pressed (no reaction)
-    if trialtype == trialtypes['target'] and no_response:
+    if responseWindow is not None and no_response:
         reactionTime = float('inf')
-        reaction_times.append(reactionTime)
+        trial_log.write('response', trial=trial, rt=reactionTime)
         print('No Button pressed')
         print(f"Reaction time: {reactionTime} s.")
         
     print(f"Trial {trial+1} of {NumTrials} played.\n")
 
+acquisition.start()
+kb_service.start()
+# Sleep until the next event (trigger off, button poll, end of trial)
+run_trials(NumTrials, start_trial, runner, events=[(TrigLen, trigger_off)], poll=poll_trial,
+           before=before_trial, started=trial_started, finished=trial_finished)
+
+acquisition.stop()
+kb_service.stop()
+# complete button record of the run
+times, buttons = acquisition.get()
+trial_log.write('buttons', times=times.tolist(), buttons=buttons.tolist())
+
 print('Audio playback finished.')
 
 #%% Save experiment configuration
 #------------------------------------------------------------------------------
-results_cfg = {
-       'playmatrix': playmatrix.tolist(),
-       'triallabel': triallabel,
-       'jitterlist': jitterlist.tolist(),
-       'reaction times': reaction_times,
-       }
-
-## Path to save data
-#-------------------
-dir2save = op.join('results')
-cfg_results_fname = subject + "task-oddball_" + str(run) + "_cfg_results.json"
-if not os.path.exists(dir2save):
-   os.makedirs(dir2save)
-   
-with open(op.join(dir2save,cfg_results_fname), "w") as outfile:
-    json.dump(results_cfg, outfile) 
+# Summary of the run assembled from the trial log
+trial_log.close()
+results_cfg = finalize_trial_log(trial_log_fname, op.join(dir2save,cfg_results_fname))
 
 #%% Closing the connection to hardware
 #------------------------------------------------------------------------------
@@ -549,4 +609,4 @@ dp.DPxStopAllScheds()
 dp.DPxWriteRegCache() 
 dp.DPxClose() 
 
-win.close()
+display.close()
@@ -72,41 +72,45 @@ Optimization
 #%% Import packages
 #------------------------------------------------------------------------------
 
-from pypixxlib import _libdpx as dp
-from pypixxlib import responsepixx as rp
-import soundfile as sf
 import datetime
 import numpy as np
 import os.path as op
 import os
 import matplotlib.pyplot as plt
-import json
 import sys
 
-from psychopy import core, visual
+from psychopy import core
 from psychopy.gui import DlgFromDict
 from psychopy.hardware import keyboard
 
+# Shared modules
+sys.path.append(op.join('..','..','common'))
+from sequence_generation import generate_sequences
+from trial_runner import TrialRunner
+from stimulus_bank import load_stimulus_bank
+from soundmexpro_player import SoundMexProPlayer
+from trial_plan import compile_trial_plan
+from trial_loops import run_trials, start_soundmexpro_trial
+from hardware_backend import load_backend
+from trigger_encoding import get_encoder
+from trial_log import TrialLog, finalize_trial_log
+from response_acquisition import ResponseAcquisition
+from keyboard_service import KeyboardService
+from trial_display import TrialDisplay
+
+# Hardware backend: 'hardware' (lab) or 'simulator' (runs without DATAPixx/
+# SoundMexPro/TriggerBox, see common/hardware_backend.py)
+Backend = 'hardware'
+backend = load_backend(Backend)
+dp = backend.dp
+rp = backend.rp
+
 #%% TriggerBox - TriggerScaling
 #------------------------------------------------------------------------------
 
-def calculate_trig_word(TrigID, BitRef):
-    """
-    Computes the trigger amplitude for the SPDIF signal
-    BitRef is 16 for MEG
-    8 for EEG (NeurOne System)
-    TrigID is the integer value in the sum channel
-    """
-    # removes prefix “0b”
-    bitmask = bin(TrigID).replace("0b", "")
-    # Extend Bitmask to BitRef bits
-    bitmask = (BitRef - len(bitmask)) * '0' + bitmask
-    # Convert to numpy array
-    bitmask = np.array([int(bit) for bit in bitmask], dtype=np.uint8)
-    powers_of_2 = np.power(2, np.arange(BitRef))
-    TrigWord = np.dot(powers_of_2, bitmask) / 2**BitRef
-
-    return TrigWord
+# Trigger words of the SPDIF trigger track (16 bit, MEG trigger interface). The lookup 
+# table of all values is built once (see common/trigger_encoding.py).
+encoder = get_encoder(bits=16)
 
 #%% Settings
 #------------------------------------------------------------------------------
@@ -119,9 +123,17 @@ ShowAudioTracks = True
 fullscrMode = False
 # Show information for current trial
 trialinfo = True
+# Render worker: window and trial info are drawn by a worker thread, the trial 
+# loop only posts the trial state without waiting for the flip (False: drawn 
+# in the trial loop)
+RenderWorker = True
 # Current Soundcard
 # SetSoundcard = 'Fireface' 
 SetSoundcard = 'Focusrite' 
+# Queue-ahead mode: number of trials queued in SoundMexPro in advance (0: off).
+# Stimulus and jitter (as zeros) are queued, so the onsets are set by the 
+# sample clock of the sound card and not by the trial loop.
+QueueAhead = 3
 
 # Experiment info gui
 #--------------------
@@ -132,12 +144,14 @@ expInfo['Fullscreen Mode'] = str(fullscrMode)
 expInfo['Selected Soundcard'] = SetSoundcard
 expInfo['Show Audio Tracks'] = str(ShowAudioTracks)
 expInfo['Show trial info'] = str(trialinfo)
+expInfo['Render worker'] = str(RenderWorker)
+expInfo['Queue ahead'] = str(QueueAhead)
 
 # present a dialogue to change params
 dlg = DlgFromDict(expInfo, 
                   title='Double Tone Auditory Oddball',
-                  fixed=['date','Plot signals','Fullscreen Mode','Selected Soundcard','Show Audio Tracks','Show trial info'], 
-                  order = ['date','sub','run','Target tone','Plot signals','Fullscreen Mode','Selected Soundcard','Show Audio Tracks','Show trial info'],
+                  fixed=['date','Plot signals','Fullscreen Mode','Selected Soundcard','Show Audio Tracks','Show trial info','Render worker','Queue ahead'], 
+                  order = ['date','sub','run','Target tone','Plot signals','Fullscreen Mode','Selected Soundcard','Show Audio Tracks','Show trial info','Render worker','Queue ahead'],
                   )
 if dlg.OK:
     print(expInfo)
@@ -177,6 +191,9 @@ buttonSubset = [button_mapping['blue']]
 buttonDevice = 'mri 10 button'
 recordPushes = True
 recordReleases = False
+# Button log and escape key are read every 10 ms. Button presses are timestamped
+# by the device, so the interval doesn't affect the reaction times.
+ButtonPollInterval = 0.01 # sec
 
 # Set directory for SoundMexPro
 bin_dir = r'C:\SoundMexPro\bin'
@@ -195,52 +212,47 @@ kb.clearEvents() # clear events
 #------------------------------------------------------------------------------
     
 # Setup the Window 
-win = visual.Window(
-    fullscr=fullscrMode, 
-    screen = 2,
-    winType='pyglet', 
-    monitor='testMonitor',
-    color=[0,0,0], # default grey
-    colorSpace='rgb',
-    units='height',
-    checkTiming=False 
-    )
+# Window, fixation cross and trial info are drawn by the TrialDisplay (render 
+# worker with RenderWorker = True, see common/trial_display.py)
+display = TrialDisplay(
+    window = dict(fullscr=fullscrMode, 
+                  screen = 2,
+                  winType='pyglet', 
+                  monitor='testMonitor',
+                  color=[0,0,0], # default grey
+                  colorSpace='rgb',
+                  units='height',
+                  checkTiming=False),
+    # Fixation cross
+    cross = dict(name='textStimulusCross',
+                 text='+',
+                 font='Open Sans',
+                 pos=(0, 0), 
+                 height=0.15, 
+                 wrapWidth=None, 
+                 ori=0.0, 
+                 color='white', 
+                 colorSpace='rgb', 
+                 opacity=None, 
+                 languageStyle='LTR',
+                 depth=-1.0),
+    # Information for the current trial
+    info = dict(name='textStimulusTrial',
+                text='',
+                font='Open Sans',
+                pos=(0, -0.1), 
+                height=0.03, 
+                wrapWidth=None,
+                ori=0.0, 
+                color='white', 
+                colorSpace='rgb', 
+                opacity=None, 
+                languageStyle='LTR',
+                depth=-1.0),
+    threaded = RenderWorker)
 
 # Show fixation cross
-# Initialize components for Routine "Stimulus"
-textStimulusCross = visual.TextStim(win=win, name='textStimulusCross',
-    text='+',
-    font='Open Sans',
-    pos=(0, 0), 
-    height=0.15, 
-    wrapWidth=None, 
-    ori=0.0, 
-    color='white', 
-    colorSpace='rgb', 
-    opacity=None, 
-    languageStyle='LTR',
-    depth=-1.0)
-
-# stimulus is automatically drawn every frame
-textStimulusCross.autoDraw = True
-
-# Initialize components for Routine "Stimulus"
-textStimulusTrial = visual.TextStim(win=win, name='textStimulusTrial',
-    text='',
-    font='Open Sans',
-    pos=(0, -0.1), 
-    height=0.03, 
-    wrapWidth=None,
-    ori=0.0, 
-    color='white', 
-    colorSpace='rgb', 
-    opacity=None, 
-    languageStyle='LTR',
-    depth=-1.0)
-
-textStimulusTrial.autoDraw = True
-
-win.flip()
+display.start()
 
 #%% Welcome Message
 #------------------------------------------------------------------------------
@@ -267,40 +279,15 @@ while not_pressed:
 #%% Build double tones and triggers
 #------------------------------------------------------------------------------
 
-if target == 'clarinet':
-    sig_target1, fs = sf.read(op.join('stimuli','clarinet_new.wav'))
-    sig_target2, fs = sf.read(op.join('stimuli','clarinet_new_short.wav'))
-    
-    sig_standard1, fs = sf.read(op.join('stimuli','oboe_new.wav'))
-    sig_standard2, fs = sf.read(op.join('stimuli','oboe_new_short.wav'))
-
-elif target == 'oboe':
-    sig_target1, fs = sf.read(op.join('stimuli','oboe_new.wav'))
-    sig_target2, fs = sf.read(op.join('stimuli','oboe_new_short.wav'))
-    
-    sig_standard1, fs = sf.read(op.join('stimuli','clarinet_new.wav'))
-    sig_standard2, fs = sf.read(op.join('stimuli','clarinet_new_short.wav')) 
-    
-# In case of stereo signals, take the first column
-gap =  np.zeros(int(GapSize*fs))
-sig_target = np.concatenate((sig_target1[:,1], gap, sig_target2[:,1]))
-sig_standard = np.concatenate((sig_standard1[:,1], gap, sig_standard2[:,1]))
-
-# Trigger for doubles tones
-#--------------------------
-TrigLen_samp = int(TrigLen*fs)
-
-a = np.zeros(len(sig_target1))
-a[0:TrigLen_samp] = calculate_trig_word(event_values['target'][0], 16)
-b = np.zeros(len(sig_target2))
-b[0:TrigLen_samp] = calculate_trig_word(event_values['target'][1], 16)
-trigger_target = np.concatenate((a,gap,b))
-
-c = np.zeros(len(sig_standard1))
-c[0:TrigLen_samp] = calculate_trig_word(event_values['standard'][0], 16)
-d = np.zeros(len(sig_standard2))
-d[0:TrigLen_samp] = calculate_trig_word(event_values['standard'][1], 16)
-trigger_standard = np.concatenate((c,gap,d))
+# Double tones and triggers from the precompiled stimulus bank (see 
+# common/stimulus_bank.py)
+trigger_values = {label: encoder.encode(event_values[label]).tolist()
+                  for label in ['standard','target']}
+bank, fs = load_stimulus_bank('stimuli', target, GapSize, TrigLen, trigger_values)
+sig_target = bank['sig_target']
+sig_standard = bank['sig_standard']
+trigger_target = bank['trigger_target']
+trigger_standard = bank['trigger_standard']
     
 if plot_signals:
     plt.figure()
@@ -324,24 +311,14 @@ rng = np.random.default_rng(seed=None)
 trialtypes = {'standard': 0,
               'target': 1}
 
-playmatrix = np.concatenate((trialtypes['standard']*np.ones(NumStandards,dtype=int),
-                             trialtypes['target']*np.ones(NumTargets,dtype=int)))
-# Here you could impose some special rules on the permutation!
+# The playmatrix is drawn directly from all sequences fullfilling the imposed
+# rules (no rejection sampling, see common/sequence_generation.py)
 # 1: The first four trials are always standards
 # 2: No more than two targets in succession
-
-# Update playmatrix as long as imposed conditions are not fullfilled
-update_playmatrix = True
-while update_playmatrix:
-    
-    condition1 = ~(playmatrix[0:4] == trialtypes['standard']*np.ones(4,dtype=int)).all()
-    # trialtypes['target'] > 0 so that convolution operation works
-    condition2 = (3*trialtypes['target'] in np.convolve(playmatrix,np.ones(3,dtype=int),'full'))
-        
-    if (condition1 or condition2):
-        playmatrix = rng.permutation(playmatrix)
-    else:    
-        update_playmatrix = False
+playmatrix = generate_sequences(NumTrials, NumTargets, 
+                                leading_standards=4, 
+                                max_target_run=2, 
+                                rng=rng)[0]
  
 # triallabel 
 #-----------
@@ -394,6 +371,13 @@ print('Automatic button schedule is running.\n')
 listener = rp.ButtonListener(buttonDevice) 
 dp.DPxWriteRegCache()
 
+# Button acquisition: the button log is read on its own thread every 
+# ButtonPollInterval, every press is kept with its device timestamp. Register 
+# accesses of the trial loop hold acquisition.lock (see 
+# common/response_acquisition.py).
+acquisition = ResponseAcquisition(dp, listener, interval=ButtonPollInterval,
+                                  recordPushes=recordPushes, recordReleases=recordReleases)
+
 # Remark signalLength + 1
 # Since the last value of the waveform gets replaced by the default value almost 
 # instantly, your device reading the Digital In signal might not be triggered 
@@ -404,8 +388,7 @@ dp.DPxWriteRegCache()
 ## SoundMexPro
 #-------------
 sys.path.append(bin_dir)
-# import soundmexpro
-from soundmexpro import soundmexpro
+soundmexpro = backend.soundmexpro
 
 smp_cfg = {
     'force': 1, # if set to 1, 'exit' is called internally before init
@@ -445,152 +428,204 @@ if ShowAudioTracks:
     soundmexpro('show')
     soundmexpro('showtracks')        
         
-# start device in 'play-zeros-if-no-data-in-tracks'-mode
-smp_cfg = {
-    'length' : 0, # device is never stopped, zeros are played endlessly.
-    }
-soundmexpro('start', smp_cfg)
+# Buffers of standard and target are built once in Python, every trial still
+# transfers the whole buffer with loadmem (see common/soundmexpro_player.py)
+player = SoundMexProPlayer(soundmexpro,
+                           {'standard': (sig_standard,sig_standard,trigger_standard),
+                            'target': (sig_target,sig_target,trigger_target)},
+                           show_tracks=ShowAudioTracks,
+                           # zeros for the longest jitter (queue-ahead mode)
+                           max_silence_frames=int(np.ceil(jitterlist.max()*fs)))
+
+# start device in 'play-zeros-if-no-data-in-tracks'-mode, the device is never
+# stopped, zeros are played endlessly. In queue-ahead mode the device is 
+# started after the first trials are queued.
+if not QueueAhead:
+    player.start()
     
-print('Hardware initialized and started: SoundMexPro + Datapixx3')
+print('Hardware initialized: SoundMexPro + Datapixx3')
 
 #%% Playback Audio + Trigger
 #------------------------------------------------------------------------------
 
-reaction_times = []
-flag = False # breakout / emergency stop
+# Trial runner
+#-------------
+# The trial loop sleeps until the next event (button poll, end of trial)
+# instead of reading the registers every millisecond.
+# Keyboard service: the emergency stop (escape) is read on its own thread and 
+# cancels the running trial (see common/keyboard_service.py)
+kb_service = KeyboardService(kb, stop_keys=['escape'], response_keys=[])
+runner = TrialRunner(poll_interval=ButtonPollInterval, cancel=kb_service.cancel)
+
+def poll_trial(passedTime):
+    """
+    Called by the runner every ButtonPollInterval during a trial. Checks the 
+    button events recorded by the acquisition thread (no register access).
+    """
+    global no_response, response_index
+    
+    # Check only within the response window of the trial (trial plan), new 
+    # events of the acquisition thread
+    if no_response and responseWindow is not None and acquisition.count > response_index:
+        times, buttons = acquisition.get(response_index)
+        response_index += len(times)
+        # first press of a response button within the response window
+        pressed = np.flatnonzero(np.isin(buttons, buttonSubset) & (times >= responseWindow[0])
+                                 & (times < responseWindow[1]))
+
+        if pressed.size:
+            print(f"Button presses! {list(zip(times.tolist(), buttons.tolist()))}")
+            timestamp = float(times[pressed[0]])
+            button = int(buttons[pressed[0]])
+
+            # Append reaction time
+            reactionTime = timestamp - startTime
+            trial_log.write('response', trial=trial, rt=reactionTime, button=button,
+                            timestamp=timestamp)
+            print(f"Reaction time: {reactionTime} s.")
+
+            # Check pressed button
+            no_response = False # leave if-condition
+
+            # trialinfo is updated when button is pressed
+            if trialinfo:
+                display.show(text='\n' + str(trial+1) + ' / ' + str(NumTrials) 
+                             + '\nTrial type: ' + triallabel[trial]
+                             + '\nReaction time: ' + str(round(reactionTime,3)) + " s")
+
+    return False
 
-for trial, trialtype in enumerate(playmatrix):
-      
-    # emergency stop
-    if flag:
-        break
+## Path to save data
+#-------------------
+dir2save = op.join('results')
+cfg_results_fname = subject + "task-oddball_" + str(run) + "_cfg_results.json"
+if not os.path.exists(dir2save):
+   os.makedirs(dir2save)
+
+# Trial log: every trial and response is written to disk during the run, an 
+# abort or crash doesn't lose the data (see common/trial_log.py)
+trial_log_fname = op.join(dir2save, subject + "task-oddball_" + str(run) + "_trials.jsonl")
+trial_log = TrialLog(trial_log_fname)
+trial_log.write('run', playmatrix=playmatrix.tolist(), triallabel=triallabel,
+                jitterlist=jitterlist.tolist())
+nextOnset = None # planned onset of the next trial
+play_positions = []
+if trialinfo:
+    # Trial info of every trial laid out before the first trial
+    display.prepare(['\n' + str(trial+1) + ' / ' + str(NumTrials) + '\nTrial type: ' + label
+                     for trial, label in enumerate(triallabel)])
+
+# Trial plan
+#-----------
+# Timeline of the whole run on the sample grid of the sound card (jitter 
+# rounded to samples), the trial loop only executes it (see 
+# common/trial_plan.py)
+plan = compile_trial_plan(playmatrix, jitterlist, fs, trialtypes,
+                          frames = {label: player.frames(label) for label in trialtypes},
+                          triggers = {label: event_values[label][0] for label in trialtypes},
+                          response_types = ['target'])
+
+# Queue-ahead mode
+#-----------------
+if QueueAhead:
+    # Stimulus + jitter as zeros, onsets set by the sample clock
+    for k in range(min(QueueAhead, NumTrials)):
+        player.queue(plan[k].label, plan[k].silence)
+    player.start()
+
+# Trial loop
+#-----------
+# The trials are started by the shared trial loop (see common/trial_loops.py, 
+# also run by common/timing_benchmark.py), the script adds console output, 
+# trial info and trial log.
+def before_trial(index):
+    """
+    Console output, trial info and reset of the response detection.
+    """
+    global trial, trialtype, no_response, response_index
+    trial = index
+    trialtype = playmatrix[trial]
     
     # Standard
     #---------
     if trialtype == trialtypes['standard']:
-        audio = sig_standard
-        trigger = trigger_standard
         print('\nStandard trial')
         print('--------------')
         
     # Target
     #-------
     elif trialtype == trialtypes['target']:
-        audio = sig_target
-        trigger = trigger_target
         print('\nTarget trial')
         print('------------')
         
     if trialinfo:
-        textStimulusTrial.setText('\n' + str(trial+1) + ' / ' + str(NumTrials) 
-        + '\nTrial type: ' + triallabel[trial])
-        win.flip()
+        display.show(trial)
         
     # Reset for detecting button presses
     no_response = True
+    response_index = acquisition.count
+
+def start_trial(trial):
+    """
+    Loads the prebuilt buffer (audio + trigger) of the trial into memory. In 
+    queue-ahead mode the queue is refilled (the current trial has been queued 
+    before) and the onset is computed from the play position.
+    """
+    onset, TrialDur, hostOnset, position = start_soundmexpro_trial(
+        player, plan, trial, dp, acquisition.lock, QueueAhead, clock = runner.clock)
+    if QueueAhead:
+        play_positions.append(position)
+    return onset, TrialDur, hostOnset
+
+def trial_started(trial, onset, TrialDur):
+    global startTime, responseWindow, nextOnset
+    startTime = onset
+    responseWindow = plan.response_window(trial, startTime)
+    trial_log.write('trial', trial=trial, label=triallabel[trial],
+                    trigger=plan[trial].trigger, planned_onset=nextOnset,
+                    onset=startTime, duration=TrialDur,
+                    play_position=play_positions[-1] if QueueAhead else None)
+    nextOnset = startTime + TrialDur
+
+def trial_finished(trial, aborted):
+    # Emergency stop (escape)
+    if aborted:
+        print('\n!!!Experiment stopped!!!')
+        player.exit()
         
-    # Load data onto analog channels
-    #--------------------------------------------------------------------------
-    # Concatenate data into matrix
-    analog_signal = np.stack((audio,audio,trigger),axis=1)
-    
-    # IMPORTANT NOTE: reading waves to memory with python creates interleaved data in memory
-    # soundmexpro needs non-interleaved data: so force rearranging in memory!!
-    analog_signal = np.asfortranarray(analog_signal)  
-    
-    StimDur = len(audio) / fs
-   
-    # Load data into memory
-    #----------------------
-    smp_cfg = {
-        'data': analog_signal,
-        'track': [0, 1, 2],                         
-        'loopcount': 1,  
-        'name': 'audio + trigger',                    
-        }
-    soundmexpro('loadmem', smp_cfg)
-    
-    if ShowAudioTracks:
-        soundmexpro('updatetracks') 
-    
-    dp.DPxUpdateRegCache()
-    startTime = dp.DPxGetTime() # start time of Trial
-    passedTime = 0
-    
-    TrialDur = StimDur + jitterlist[trial] 
-    while passedTime < TrialDur: # check passed time
-        dp.DPxUpdateRegCache()
-        currentTime = dp.DPxGetTime()     
-        passedTime = currentTime - startTime
-        
-        keys = kb.getKeys(['escape'])
-        # Emergency stop
-        if 'escape' in keys:
-            print('\n!!!Experiment stopped!!!')
-            flag = True
-            soundmexpro('exit')
-            break
-        
-        if (no_response):
-            listener.updateLogs()
-            output = listener.getNewButtonActivity(buttonSubset, recordPushes, recordReleases)
-            
-            # Check only for target trials
-            if (trialtype == trialtypes['target']):
-                
-                if output != []:
-                    # this prints out the timestamp of the last button push and the button that was pushed
-                    print(f"Button presses! {output}")
-                    timestamp = output[-1][0]
-                    button = output[-1][1] # index only the last button that was pushed
-                    
-                    # Append reaction time
-                    reactionTime = timestamp - startTime
-                    reaction_times.append(reactionTime)
-                    print(f"Reaction time: {reactionTime} s.")
-                   
-                    # Check pressed button
-                    no_response = False # leave if-condition
-                    
-                    # trialinfo is updated when button is pressed
-                    if trialinfo:
-                        textStimulusTrial.setText('\n' + str(trial+1) + ' / ' + str(NumTrials) 
-                        + '\nTrial type: ' + triallabel[trial]
-                        + '\nReaction time: ' + str(round(reactionTime,3)) + " s")
-                        win.flip()
-                
-        # wait 1 ms before refresh?!
-        core.wait(0.001) 
-      
     # in case no button has been pressed (no reaction)
-    if trialtype == trialtypes['target'] and no_response:
+    if responseWindow is not None and no_response:
         reactionTime = float('inf')
-        reaction_times.append(reactionTime)
+        trial_log.write('response', trial=trial, rt=reactionTime)
         print('No Button pressed')
         print(f"Reaction time: {reactionTime} s.")
         
     print(f"Trial {trial+1} of {NumTrials} played.\n")
 
+acquisition.start()
+kb_service.start()
+# Sleep until the next event (button poll, end of trial)
+run_trials(NumTrials, start_trial, runner, poll=poll_trial, before=before_trial, 
+           started=trial_started, finished=trial_finished)
+
+acquisition.stop()
+kb_service.stop()
+# complete button record of the run
+times, buttons = acquisition.get()
+trial_log.write('buttons', times=times.tolist(), buttons=buttons.tolist())
+
 print('\nAudio playback finished.')
 
 #%% Save experiment configuration
 #------------------------------------------------------------------------------
-results_cfg = {
-       'playmatrix': playmatrix.tolist(),
-       'triallabel': triallabel,
-       'jitterlist': jitterlist.tolist(),
-       'reaction times': reaction_times,
-       }
-
-## Path to save data
-#-------------------
-dir2save = op.join('results')
-cfg_results_fname = subject + "task-oddball_" + str(run) + "_cfg_results.json"
-if not os.path.exists(dir2save):
-   os.makedirs(dir2save)
-   
-with open(op.join(dir2save,cfg_results_fname), "w") as outfile:
-    json.dump(results_cfg, outfile)    
+# Summary of the run assembled from the trial log
+trial_log.close()
+results_extra = {}
+if QueueAhead:
+    results_extra['onset samples'] = plan.trials['onset'].tolist()
+    results_extra['play positions'] = play_positions
+results_cfg = finalize_trial_log(trial_log_fname, op.join(dir2save,cfg_results_fname),
+                                 **results_extra)
 
 #%% Closing the connection to hardware
 #------------------------------------------------------------------------------
@@ -599,5 +634,5 @@ dp.DPxStopAllScheds()
 dp.DPxWriteRegCache() 
 dp.DPxClose() 
 
-soundmexpro('exit')
-win.close()
+player.exit()
+display.close()
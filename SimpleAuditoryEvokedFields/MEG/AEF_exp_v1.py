@@ -50,7 +50,6 @@ lateralization of effects.
 
 #%% Import packages
 #------------------------------------------------------------------------------
-from pypixxlib import _libdpx as dp
 import soundfile as sf
 import numpy as np
 import os.path as op
@@ -59,6 +58,16 @@ from psychopy.hardware import keyboard
 import matplotlib.pyplot as plt
 import sys
 
+# Shared modules
+sys.path.append(op.join('..','..','common'))
+from hardware_backend import load_backend
+
+# Hardware backend: 'hardware' (lab) or 'simulator' (runs without DATAPixx/
+# SoundMexPro/TriggerBox, see common/hardware_backend.py)
+Backend = 'hardware'
+backend = load_backend(Backend)
+dp = backend.dp
+
 #%% Settings
 #------------------------------------------------------------------------------
 
@@ -14,6 +14,9 @@ Auditory Evoked Fields experiment (N100m)
 - No settings are saved
 - No visual component included
 - Use calibration.py to measure / calculate Calibration Values (CalVal)
+- single_schedule: the whole click train (including the jitter) is rendered 
+  into the DATAPixx RAM and played back with one DacSchedule and one 
+  DoutSchedule. Python only monitors the progress, ISIs are sample-accurate.
 
 Hardware / Software details
 -------------------------------------------------------------------------------
@@ -49,7 +52,6 @@ lateralization of effects.
 
 #%% Import packages
 #------------------------------------------------------------------------------
-from pypixxlib import _libdpx as dp
 import soundfile as sf
 import numpy as np
 import os.path as op
@@ -58,11 +60,28 @@ from psychopy.hardware import keyboard
 import matplotlib.pyplot as plt
 import sys
 
+# Shared modules
+sys.path.append(op.join('..','..','common'))
+from hardware_backend import load_backend
+from trial_loops import (click_train_onsets, write_click_train, start_click_train, 
+                         monitor_click_train, start_click_trial, wait_click_trial)
+
+# Hardware backend: 'hardware' (lab) or 'simulator' (runs without DATAPixx/
+# SoundMexPro/TriggerBox, see common/hardware_backend.py)
+Backend = 'hardware'
+backend = load_backend(Backend)
+dp = backend.dp
+
 #%% Settings
 #------------------------------------------------------------------------------
 
 # Plot Click
 plot_click = False
+# Render the whole click train into DATAPixx RAM and play it back with a single
+# schedule (sample-accurate ISIs, no per-trial communication with the device)
+single_schedule = True
+# Number of frames written to the DATAPixx RAM at once
+ChunkFrames = 2**20
 
 # Audio signal
 NumTrials = 400
@@ -172,65 +191,86 @@ while not_pressed:
     
 #%% Start Playback
 #------------------------------------------------------------------------------
+
+# Playback is run by the shared trial loops (see common/trial_loops.py, also 
+# run by common/timing_benchmark.py)
+
+def emergency_stop():
+    """
+    True if escape has been pressed.
+    """
+    return 'escape' in kb.getKeys(['space','escape'])
+
+def print_trial(trial):
+    print(f"Trial {trial+1} of {NumTrials} played.")
+
+# Single schedule: whole click train
+#-----------------------------------
+if single_schedule:
     
-# Writes the data that will be used by the DAC buffer to drive the analogue outputs
-#----------------------------------------------------------------------------------
-dp.DPxWriteDacBuffer(bufferData = audio_data,
-                     bufferAddress = int(0),
-                     channelList = channel)
-# Writes the digital output waveform data in ‘bufferData’ to the DATAPixx RAM at memory address ‘bufferAddress’
-#--------------------------------------------------------------------------------------------------------------
-dp.DPxWriteDoutBuffer(bufferData = trigger,
-                      bufferAddress= int(8e6))
-
-dp.DPxWriteRegCache()
-
-# Loop over Trials
-#-----------------
-for trial in range(0,NumTrials):
-    
-    # Configure a schedule for autonomous DAC analog signal acquisition
+    # Onsets on the sample grid, the jitter is baked in as zero samples
     #------------------------------------------------------------------
-    dp.DPxSetDacSchedule(scheduleOnset = 0, 
-                         scheduleRate = fs, 
-                         rateUnits = "Hz", 
-                         maxScheduleFrames = Nsamples, 
-                         channelList = channel, # If provided, it needs to be a list of size nChans.
-                         bufferBaseAddress= int(0), 
-                         numBufferFrames = Nsamples)
-    dp.DPxStartDacSched()  
+    onsets, TotalFrames = click_train_onsets(jitterlist, fs, Nsamples)
+    
+    # Render and write click train in chunks
+    #---------------------------------------
+    print('\nWriting click train into DATAPixx RAM...')
+    DacAddress, DoutAddress = write_click_train(dp, onsets, TotalFrames, audio_data, trigger, 
+                                                channel, ChunkFrames)
+    print(f"{TotalFrames} frames ({TotalFrames/fs:.1f} s) written.")
     
-    # Implements a digital output schedule in a DATAPixx
-    #---------------------------------------------------
-    dp.DPxSetDoutSchedule(scheduleOnset = 0.0,
-                          scheduleRate = fs,
-                          maxScheduleFrames = Nsamples,
-                          bufferAddress = int(8e6), 
-                          numBufferFrames=None)
-    dp.DPxStartDoutSched()
+    # One schedule for the whole run
+    #-------------------------------
+    startTime = start_click_train(dp, fs, channel, TotalFrames, DacAddress, DoutAddress)
     
-    dp.DPxUpdateRegCache() # Read and Write
-    startTime = dp.DPxGetTime()
-    passedTime = 0
+    # Monitor progress
+    #-----------------
+    # no busy waiting, the timing is handled by the device
+    aborted = monitor_click_train(dp, startTime, onsets / fs, 
+                                  wait = lambda interval: core.wait(interval, hogCPUperiod=0),
+                                  interval = 0.1, stop = emergency_stop, on_trial = print_trial)
+    # Emergency stop
+    if aborted:
+        print('\n!!!Experiment stopped!!!')
+        dp.DPxStopAllScheds()
+        dp.DPxWriteRegCache() 
+        dp.DPxClose() 
+        sys.exit()
+
+# Trial by trial
+#----------------
+else:
     
-    # Wait until trial has finished 
-    #------------------------------
-    while passedTime < jitterlist[trial]:
-        
-        dp.DPxUpdateRegCache()
-        currentTime = dp.DPxGetTime()     
-        passedTime = currentTime - startTime
-        
-        keys = kb.getKeys(['space','escape'])
-        # Emergency stop
-        if 'escape' in keys:
+    # Writes the data that will be used by the DAC buffer to drive the analogue outputs
+    #----------------------------------------------------------------------------------
+    dp.DPxWriteDacBuffer(bufferData = audio_data,
+                         bufferAddress = int(0),
+                         channelList = channel)
+    # Writes the digital output waveform data in ‘bufferData’ to the DATAPixx RAM at memory address ‘bufferAddress’
+    #--------------------------------------------------------------------------------------------------------------
+    dp.DPxWriteDoutBuffer(bufferData = trigger,
+                          bufferAddress= int(8e6))
+
+    dp.DPxWriteRegCache()
+
+    # Loop over Trials
+    #-----------------
+    for trial in range(0,NumTrials):
+    
+        # DAC and Dout schedule of the click
+        #-----------------------------------
+        startTime = start_click_trial(dp, fs, channel, Nsamples, 
+                                      DacAddress = int(0), DoutAddress = int(8e6))
+    
+        # Wait until trial has finished (wait 1 ms before refresh)
+        #---------------------------------------------------------
+        if wait_click_trial(dp, startTime, jitterlist[trial], wait = core.wait, 
+                            interval = 0.001, stop = emergency_stop):
+            # Emergency stop
             print('\n!!!Experiment stopped!!!')
             sys.exit()
-            
-        # wait 1 ms before refresh?!
-        core.wait(0.001) 
     
-    print(f"Trial {trial+1} of {NumTrials} played.")
+        print_trial(trial)
 
 print('Audio playback finished.')
 
@@ -23,13 +23,74 @@ Optional:
   https://mne.tools/dev/auto_tutorials/preprocessing/59_head_positions.html
 - Transformation to common head positions between runs. That means same
   head-dev-trafo for all runs
+  
+Parallel processing
+-------------------
+- With n_jobs > 1 the (subject, fname) pairs are processed in a process pool.
+  New files are only started as long as the estimated memory of all files in
+  process stays below the memory budget (max_memory_gb).
+- The report is written in a separate stage from the saved PSDs, in parallel
+  across subjects.
+  
+Cache
+-----
+- Bad channel detection and Maxwell filtering are skipped if a hash of the 
+  inputs (raw file, ct_sparse.fif, sss_cal.dat, destination, head positions) 
+  and parameters matches the hash stored with the derivative 
+  (*-maxfilter_cache.json) and the -raw_tsss.fif file exists.
+- Bad channels are cached separately, so changing only Maxwell filter 
+  parameters doesn't repeat the bad channel detection.
+
+Low memory mode
+---------------
+- The raw data is never loaded completely. Note that the raw file is read 
+  without preload, so raw.copy() of the whole recording is cheap in the normal
+  mode as well, the memory is needed by find_bad_channels_maxwell and 
+  maxwell_filter, which load the whole recording. In low memory mode bad 
+  channels are detected on a few segments spread over the recording, the 
+  Maxwell filter is applied to chunks of chunk_duration which are written to 
+  temporary files and streamed into the -raw_tsss.fif file.
+- The chunks are filtered with non-overlapping tSSS windows 
+  (st_overlap=False), the normal mode uses overlapping windows (default of 
+  maxwell_filter). The results differ slightly, mainly at the window borders.
+- The PSDs are averaged over the chunks.
+- The peak memory (RSS) of the process that handled a file is reported. 
+  Pool workers are reused for several files, so the peak can include memory
+  left over from a previous file of the same worker. The RSS at the start of
+  the file is reported as well, the difference is the increase caused by the
+  file.
+
+Report
+------
+- PSDs before and after Maxwell filtering are computed once and saved next to
+  the derivative (*-raw_psd.h5, *-raw_tsss_psd.h5). They are reused as long as
+  the Maxwell filter cache is valid.
+- The report stage (run_report) only reads the saved PSDs, plots them one by 
+  one and closes each figure immediately. It can be run without the Maxwell 
+  filter stage (run_maxfilter).
+
+Head positions
+--------------
+- With chpi_window the cHPI amplitudes and locations are computed for time 
+  windows of the recording in parallel (n_jobs) and merged afterwards. The 
+  windows overlap by chpi_overlap, only the fits starting inside the window 
+  are kept (fit times of compute_chpi_amplitudes are the starts of the fit 
+  windows).
+- cHPI locations are saved (*_chpi_locs.npz). Changing only the parameters of
+  compute_head_pos (chpi_head_pos_params) reuses them.
 """
 
 #%% Settings
 import os
 import os.path as op
+import json
+import hashlib
+import functools
+import threading
+import numpy as np
 import mne
 from mne.preprocessing import find_bad_channels_maxwell
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 subjects  = ['sub-01','sub-02','sub-03']
 # subjects  = ['sub-01']
@@ -53,148 +114,596 @@ ref_fname = 'aef_run-1'
 
 # Apply and compute movement correction
 MC = 0
+# cHPI computations in time windows of chpi_window s (None: whole recording)
+chpi_window = 300
+# Overlap of the windows in s (longer than the cHPI fit window)
+chpi_overlap = 1
+# Parameters of compute_head_pos
+chpi_head_pos_params = dict(gof_limit=0.98, dist_limit=0.005)
 
-#%% Headposition computations for movement correction
+# Number of worker processes (1: serial processing as before). With n_jobs > 1
+# several files are processed at the same time, each in its own worker 
+# process, so the memory use is multiplied (limited by max_memory_gb).
+n_jobs = 4
+# Memory budget for files processed at the same time in GB. None: 75% of the 
+# available memory (requires psutil), otherwise no limit.
+max_memory_gb = None
+# Estimated memory needed per file as multiple of the file size (raw data as 
+# float64, copy for bad channel detection and maxfiltered data)
+memory_factor = 6
 
-if MC: 
-    for subject in subjects:
-        
-        figs_list= []
-        captions_list = []
-        dir2save =  os.path.join(rootpath,'derivatives',subject,'maxfilter')
+# Processing stages: Maxwell filtering (incl. PSDs) and report
+run_maxfilter = 1
+run_report = 1
 
-        # use reduced set for head movement computations
-        fnames_reduced = [fname for fname in fnames if 'aef' in fname]
-        for fname in fnames_reduced:
-            
-            raw_fname = os.path.join(rootpath,'rawdata',subject,'meg',subject + '_task-' + fname + '.fif')
-            headpos_fname = os.path.join(rootpath,'derivatives',subject,'maxfilter',subject + '_task-' + fname + '_head_pos_raw.pos')
-            
-            # Head positions are computed if raw meg file exists and positions
-            # havent been computed yet
-            if op.isfile(raw_fname) and not op.isfile(headpos_fname):
-                
-                raw = mne.io.read_raw_fif(raw_fname, allow_maxshield=False, verbose=True)
-            
-                #%% Compute head position
-                chpi_amplitudes = mne.chpi.compute_chpi_amplitudes(raw)
-                chpi_locs = mne.chpi.compute_chpi_locs(raw.info, chpi_amplitudes)
-                head_pos = mne.chpi.compute_head_pos(raw.info, chpi_locs, verbose=True)
-                
-                if head_pos.shape[0]>0: # cHPI active
+# Skip bad channel detection and Maxwell filtering for unchanged inputs and 
+# parameters
+use_cache = True
+
+# Low memory mode: no complete raw data in memory
+low_memory = False
+# Total duration and number of segments for the bad channel detection in s
+bad_detection_duration = 120
+bad_detection_segments = 4
+# Duration of chunks for Maxwell filtering in s (rounded to a multiple of 
+# st_duration)
+chunk_duration = 300
+
+#%% Function definitions
+
+def get_raw_fname(subject, fname):
+    return os.path.join(rootpath,'rawdata',subject,'meg',subject + '_task-' + fname + '.fif')
+
+def get_dir2save(subject):
+    return os.path.join(rootpath,'derivatives',subject,'maxfilter')
+
+def get_psd_fname(subject, fname, tsss):
+    suffix = '-raw_tsss_psd.h5' if tsss else '-raw_psd.h5'
+    return os.path.join(get_dir2save(subject),subject + '_task-' + fname + suffix)
+
+def fig_to_array(fig):
+    """
+    Renders a matplotlib figure into an RGB array and closes the figure. The
+    arrays can be send back from worker processes and added to the report.
+    """
+    import matplotlib.pyplot as plt
+    fig.canvas.draw()
+    image = np.asarray(fig.canvas.buffer_rgba())[:, :, :3].copy()
+    plt.close(fig)
+    return image
+
+@functools.lru_cache(maxsize=None)
+def _file_hash(path, size, mtime_ns):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def file_hash(path):
+    """
+    Returns the sha256 of the file content (None for None). Files are hashed 
+    only once per process as long as size and modification time don't change.
+    """
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return _file_hash(op.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+def cache_key(params):
+    """
+    Returns a hash of a dictionary with file hashes and parameters.
+    """
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def read_cache(cache_fname):
+    if use_cache and op.isfile(cache_fname):
+        with open(cache_fname) as json_file:
+            return json.load(json_file)
+    return {}
+
+def write_cache(cache_fname, cache):
+    with open(cache_fname, 'w') as outfile:
+        json.dump(cache, outfile, indent=4)
+
+class PeakMemory:
+    """
+    Samples the memory (RSS) of the process in a background thread. Requires 
+    psutil, otherwise the peak RSS of the whole process lifetime is used 
+    (resource module, not available on Windows).
+    
+    The peak is the peak of the (worker) process, which includes memory kept 
+    from previous files processed by the same worker. start_mb is the RSS at 
+    start(), peak_mb - start_mb is the increase during the measurement (psutil
+    only).
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_mb = None
+        self.start_mb = None
+        self._stop = threading.Event()
+        self._thread = None
+        
+    def start(self):
+        try:
+            import psutil
+        except ImportError:
+            return
+        process = psutil.Process()
+        self.start_mb = process.memory_info().rss / 1e6
+        self.peak_mb = self.start_mb
+        
+        def sample():
+            while True:
+                self.peak_mb = max(self.peak_mb, process.memory_info().rss / 1e6)
+                if self._stop.wait(self.interval):
+                    break
                 
-                    #%% Save head position     
-                    if not op.exists(dir2save):
-                        os.makedirs(dir2save)
-                        print("Directory '{}' created".format(dir2save))
-        
-                    mne.chpi.write_head_pos(headpos_fname, head_pos)
-                    
-                    captions_list.append(fname)
-                    figs_list.append(mne.viz.plot_head_positions(head_pos, mode='traces',show=False))
-        
-        # add to report if list is not empty
-        if figs_list:
-            #%% Add plots of the data to the HTML report
-            report_fname = op.join(dir2save,subject+'-report.hdf5')
-            report_html_fname = op.join(dir2save,subject+'-report.html')
-            
-            with mne.open_report(report_fname) as report:
-                report.add_figure(
-                figs_list,
-                title='Extracting and visualizing subject head movement',
-                caption=captions_list,
-                replace=True
-                )
-            report.save(report_html_fname, overwrite=True,open_browser=False)  
+        self._thread = threading.Thread(target=sample, daemon=True)
+        self._thread.start()
+        
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        else:
+            try:
+                import resource
+            except ImportError:
+                return None
+            # ru_maxrss in kB on Linux
+            self.peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+        return self.peak_mb
+
+def iter_chunks(raw, chunk_samples, min_samples=0):
+    """
+    Yields loaded copies of consecutive, non-overlapping chunks of a raw 
+    object which is not preloaded. A last chunk shorter than min_samples is 
+    merged into the previous chunk (maxwell_filter needs at least st_duration
+    of data per chunk).
+    """
+    starts = list(range(0, raw.n_times, chunk_samples))
+    if len(starts) > 1 and raw.n_times - starts[-1] < min_samples:
+        del starts[-1]
+    stops = starts[1:] + [raw.n_times]
+    for start, stop in zip(starts, stops):
+        yield raw.copy().crop(tmin=raw.times[start], tmax=raw.times[stop-1]).load_data()
+
+def get_chunk_samples(raw, st_duration):
+    duration = chunk_duration
+    if st_duration is not None:
+        duration = max(round(chunk_duration/st_duration), 1) * st_duration
+    return int(round(duration * raw.info['sfreq']))
 
-#%% maxfilter processing
+def average_spectra(spectra, weights):
+    """
+    Weighted average of the PSDs of several chunks.
+    """
+    data = np.average([spectrum.get_data() for spectrum in spectra], axis=0, weights=weights)
+    return mne.time_frequency.SpectrumArray(data, spectra[0].info, spectra[0].freqs)
 
-for subject in subjects:
+def detect_bad_channels_segments(raw, coord_frame):
+    """
+    Bad channel detection on bad_detection_segments segments spread evenly over
+    the recording (bad_detection_duration in total). Only the segments are 
+    loaded.
+    """
+    duration = raw.times[-1]
+    if duration <= bad_detection_duration:
+        raw_check = raw.copy().load_data()
+    else:
+        segment = bad_detection_duration / bad_detection_segments
+        starts = np.linspace(0, duration - segment, bad_detection_segments)
+        raw_check = mne.concatenate_raws([raw.copy().crop(tmin=start, tmax=start+segment).load_data()
+                                          for start in starts])
+    return find_bad_channels_maxwell(
+        raw_check, cross_talk=crosstalk_file, calibration=fine_cal_file,
+        coord_frame=coord_frame, return_scores=False, verbose=True)
+
+def maxwell_filter_chunked(raw, tsss_fname, st_duration, **kwargs):
+    """
+    Applies the Maxwell filter chunk by chunk. Each chunk is saved into a 
+    temporary file, the chunks are streamed into tsss_fname afterwards. 
+    Chunks are a multiple of st_duration (a shorter tail is merged into the 
+    last chunk) and the tSSS windows don't overlap
+    (st_overlap=False), so the windows are the same as for the whole recording
+    with st_overlap=False. They differ from the overlapping windows of the 
+    normal mode.
     
-    figs_list_before = []
-    figs_list_after = []
+    Returns
+    -------
+    psd_before, psd_after: PSDs averaged over the chunks
+    """
+    chunk_samples = get_chunk_samples(raw, st_duration)
+    min_samples = 0 if st_duration is None else int(np.ceil(st_duration * raw.info['sfreq']))
+    tmp_fnames = []
+    spectra_before, spectra_after, weights = [], [], []
+    
+    for idx, raw_chunk in enumerate(iter_chunks(raw, chunk_samples, min_samples)):
+        raw_chunk_tsss = mne.preprocessing.maxwell_filter(
+            raw_chunk, st_duration=st_duration, st_overlap=False, verbose=True, **kwargs)
+        tmp_fname = tsss_fname.replace('-raw_tsss.fif', f"_chunk-{idx:03d}-raw_tsss.fif")
+        raw_chunk_tsss.save(tmp_fname, overwrite=True)
+        tmp_fnames.append(tmp_fname)
+        
+        spectra_before.append(raw_chunk.compute_psd())
+        spectra_after.append(raw_chunk_tsss.compute_psd())
+        weights.append(raw_chunk.n_times)
+        del raw_chunk, raw_chunk_tsss
+        
+    # Stream chunks into one file (data is read buffer by buffer while saving)
+    raw_tsss = mne.concatenate_raws([mne.io.read_raw_fif(tmp_fname, verbose=True) 
+                                     for tmp_fname in tmp_fnames])
+    # Remove annotations of the chunk borders
+    boundaries = np.flatnonzero(np.isin(raw_tsss.annotations.description, 
+                                        ['BAD boundary', 'EDGE boundary']))
+    raw_tsss.annotations.delete(boundaries)
+    raw_tsss.save(tsss_fname, overwrite=True)
+    del raw_tsss
+    for tmp_fname in tmp_fnames:
+        os.remove(tmp_fname)
+        
+    return average_spectra(spectra_before, weights), average_spectra(spectra_after, weights)
+
+def compute_psds_chunked(raw, raw_tsss, st_duration):
+    """
+    PSDs before and after Maxwell filtering averaged over chunks.
+    """
+    chunk_samples = get_chunk_samples(raw, st_duration)
+    spectra = []
+    for raw_ in [raw, raw_tsss]:
+        chunk_spectra, weights = [], []
+        for raw_chunk in iter_chunks(raw_, chunk_samples):
+            chunk_spectra.append(raw_chunk.compute_psd())
+            weights.append(raw_chunk.n_times)
+        spectra.append(average_spectra(chunk_spectra, weights))
+    return spectra
+
+def compute_chpi_window(raw_fname, tmin, tmax, keep_tmin, keep_tmax):
+    """
+    cHPI locations of a time window (relative times in s). Only the fits 
+    starting between keep_tmin and keep_tmax are returned (the times of 
+    compute_chpi_amplitudes are the starts of the fit windows). Runs in a 
+    worker process in case of parallel processing.
+    """
+    raw = mne.io.read_raw_fif(raw_fname, allow_maxshield=False, verbose=False)
+    chpi_amplitudes = mne.chpi.compute_chpi_amplitudes(raw, tmin=tmin, tmax=tmax, verbose=False)
+    times = chpi_amplitudes['times'] - raw.first_samp / raw.info['sfreq']
+    keep = (times >= keep_tmin) & (times < keep_tmax)
+    chpi_amplitudes = select_times(chpi_amplitudes, keep)
+    chpi_locs = mne.chpi.compute_chpi_locs(raw.info, chpi_amplitudes, verbose=False)
+    return chpi_locs
+
+def select_times(chpi_dict, keep):
+    """
+    Selects time points of cHPI amplitudes or locations (all arrays with one 
+    entry per time point).
+    """
+    n_times = len(chpi_dict['times'])
+    return {key: value[keep] if isinstance(value, np.ndarray) and value.shape[:1] == (n_times,) 
+            else value for key, value in chpi_dict.items()}
+
+def merge_times(chpi_dicts):
+    """
+    Concatenates cHPI amplitudes or locations of consecutive windows.
+    """
+    merged = dict(chpi_dicts[0])
+    n_times = len(merged['times'])
+    for key, value in merged.items():
+        if isinstance(value, np.ndarray) and value.shape[:1] == (n_times,):
+            merged[key] = np.concatenate([chpi_dict[key] for chpi_dict in chpi_dicts])
+    return merged
+
+def get_chpi_windows(raw):
+    """
+    Returns (tmin, tmax, keep_tmin, keep_tmax) for each time window.
+    """
+    duration = raw.times[-1]
+    if chpi_window is None or duration <= chpi_window:
+        return [(0, None, -np.inf, np.inf)]
+    windows = []
+    for keep_tmin in np.arange(0, duration, chpi_window):
+        keep_tmax = keep_tmin + chpi_window
+        windows.append((max(keep_tmin - chpi_overlap, 0), min(keep_tmax + chpi_overlap, duration),
+                        keep_tmin, keep_tmax))
+    # last window keeps everything up to the end of the recording
+    windows[-1] = windows[-1][:3] + (np.inf,)
+    return windows
+
+def compute_chpi(raw_fnames, executor=None):
+    """
+    Computes the cHPI locations of several files. The time windows of all 
+    files are processed in parallel with an executor.
+    
+    Returns
+    -------
+    list of chpi_locs
+    """
+    jobs = []
+    for raw_fname in raw_fnames:
+        raw = mne.io.read_raw_fif(raw_fname, allow_maxshield=False, verbose=False)
+        windows = get_chpi_windows(raw)
+        if executor is None:
+            jobs.append([compute_chpi_window(raw_fname, *window) for window in windows])
+        else:
+            jobs.append([executor.submit(compute_chpi_window, raw_fname, *window) for window in windows])
+        
+    results = []
+    for job in jobs:
+        if executor is not None:
+            job = [future.result() for future in job]
+        results.append(merge_times(job))
+    return results
+
+def compute_head_positions(subject):
+    """
+    Computes and saves the head positions of all runs of a subject (cHPI) and
+    adds them to the report. cHPI locations are reused if the raw file is 
+    unchanged.
+    """
+    figs_list= []
     captions_list = []
-    dir2save = os.path.join(rootpath,'derivatives',subject,'maxfilter')
+    dir2save = get_dir2save(subject)
     
-    for fname in fnames:
+    # use reduced set for head movement computations
+    fnames_reduced = [fname for fname in fnames if 'aef' in fname 
+                      and op.isfile(get_raw_fname(subject, fname))]
+    
+    def get_fname(fname, suffix):
+        return os.path.join(dir2save, subject + '_task-' + fname + suffix)
+    
+    # Keys of the cHPI fits and head positions
+    chpi_keys, head_pos_keys, caches = {}, {}, {}
+    for fname in fnames_reduced:
+        chpi_keys[fname] = cache_key({
+            'raw': file_hash(get_raw_fname(subject, fname)),
+            'chpi_window': chpi_window,
+            'chpi_overlap': chpi_overlap,
+            'mne': mne.__version__,
+            })
+        head_pos_keys[fname] = cache_key({
+            'chpi': chpi_keys[fname],
+            'params': chpi_head_pos_params,
+            })
+        caches[fname] = read_cache(get_fname(fname, '_chpi_cache.json'))
+    
+    # Head positions are computed if they havent been computed yet or the 
+    # inputs changed
+    todo = [fname for fname in fnames_reduced 
+            if caches[fname].get('head_pos_key') != head_pos_keys[fname]
+            or not op.isfile(get_fname(fname, '_head_pos_raw.pos'))]
+    # cHPI fits are computed if they can't be reused
+    todo_chpi = [fname for fname in todo 
+                 if caches[fname].get('chpi_key') != chpi_keys[fname]
+                 or not op.isfile(get_fname(fname, '_chpi_locs.npz'))]
+    
+    if todo_chpi and not op.exists(dir2save):
+        os.makedirs(dir2save, exist_ok=True)
+        print("Directory '{}' created".format(dir2save))
+        
+    #%% Compute cHPI amplitudes and locations
+    raw_fnames = [get_raw_fname(subject, fname) for fname in todo_chpi]
+    if n_jobs > 1 and chpi_window is not None:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            chpi_results = compute_chpi(raw_fnames, executor)
+    else:
+        chpi_results = compute_chpi(raw_fnames)
         
-        #%% Load data
-        raw_fname = os.path.join(rootpath,'rawdata',subject,'meg',subject + '_task-' + fname + '.fif')
+    for fname, chpi_locs in zip(todo_chpi, chpi_results):
+        np.savez(get_fname(fname, '_chpi_locs.npz'), **chpi_locs)
+        caches[fname] = {'chpi_key': chpi_keys[fname]}
+        write_cache(get_fname(fname, '_chpi_cache.json'), caches[fname])
     
-        if op.isfile(raw_fname):
+    for fname in todo:
+        
+        raw = mne.io.read_raw_fif(get_raw_fname(subject, fname), allow_maxshield=False, verbose=True)
+        with np.load(get_fname(fname, '_chpi_locs.npz')) as chpi_locs:
+            chpi_locs = dict(chpi_locs)
+        
+        #%% Compute head position
+        head_pos = mne.chpi.compute_head_pos(raw.info, chpi_locs, verbose=True, **chpi_head_pos_params)
+        
+        if head_pos.shape[0]>0: # cHPI active
+        
+            #%% Save head position
+            mne.chpi.write_head_pos(get_fname(fname, '_head_pos_raw.pos'), head_pos)
+            caches[fname]['head_pos_key'] = head_pos_keys[fname]
+            write_cache(get_fname(fname, '_chpi_cache.json'), caches[fname])
             
-            raw = mne.io.read_raw_fif(raw_fname, allow_maxshield=False, verbose=True)
+            captions_list.append(fname)
+            figs_list.append(mne.viz.plot_head_positions(head_pos, mode='traces',show=False))
+    
+    # add to report if list is not empty
+    if figs_list:
+        #%% Add plots of the data to the HTML report
+        report_fname = op.join(dir2save,subject+'-report.hdf5')
+        report_html_fname = op.join(dir2save,subject+'-report.html')
         
-            #%% Oversampled temporal projection
-            if OTP:
-                raw = mne.preprocessing.oversampled_temporal_projection(raw)
+        with mne.open_report(report_fname) as report:
+            report.add_figure(
+            figs_list,
+            title='Extracting and visualizing subject head movement',
+            caption=captions_list,
+            replace=True
+            )
+        report.save(report_html_fname, overwrite=True,open_browser=False)  
+
+def process_file(subject, fname):
+    """
+    Bad channel detection and Maxwell filtering of a single file. Runs in a 
+    worker process in case of parallel processing.
+    
+    Returns
+    -------
+    result: dict with subject, fname, peak memory of the worker process and its
+        memory at the start of the file
+    """
+    dir2save = get_dir2save(subject)
+    peak_memory = PeakMemory()
+    peak_memory.start()
+    
+    #%% Load data
+    raw_fname = get_raw_fname(subject, fname)
+    raw = mne.io.read_raw_fif(raw_fname, allow_maxshield=False, verbose=True)
+
+    # Oversampled temporal projection is applied after the cache check
+    if OTP and low_memory:
+        raise ValueError('Oversampled temporal projection needs the whole recording (low_memory = False).')
+    
+    #%% emptyroom 
+    head_pos = None
+    if 'empty' in fname:      
+        destination = None
+        st_duration = None
+        coord_frame = "meg"
             
-            #%% emptyroom 
-            if 'empty' in fname:      
-                destination = None
-                head_pos = None
-                st_duration = None
-                coord_frame = "meg"
-                    
-            #%% recordings with subjects inside meg
-            else:
-                st_duration = 10
-                coord_frame = 'head'
-                
-                #%% Head Position Transformation
-                if HPT: 
-                    # Use headposition of a recording as reference
-                    destination = os.path.join(rootpath,'rawdata',subject,'meg',subject + '_task-'+ ref_fname + '.fif')
-                else:
-                    destination = None
-                    
-                #%% Movement Correction  
-                if MC: 
-                    headpos_fname = os.path.join(rootpath,'derivatives',subject,'maxfilter',subject + '_task-' + fname + '_head_pos_raw.pos')
-                    if op.isfile(headpos_fname):
-                        head_pos = headpos_fname    
-                else:
-                    head_pos = None       
-                
-            #%% Detect bad channels
-            raw.info['bads'] = []
+    #%% recordings with subjects inside meg
+    else:
+        st_duration = 10
+        coord_frame = 'head'
+        
+        #%% Head Position Transformation
+        if HPT: 
+            # Use headposition of a recording as reference
+            destination = get_raw_fname(subject, ref_fname)
+        else:
+            destination = None
+            
+        #%% Movement Correction  
+        if MC: 
+            headpos_fname = os.path.join(dir2save,subject + '_task-' + fname + '_head_pos_raw.pos')
+            if op.isfile(headpos_fname):
+                head_pos = headpos_fname    
+        
+    #%% Cache keys
+    tsss_fname = os.path.join(dir2save,subject + '_task-' + fname + '-raw_tsss.fif')
+    cache_fname = os.path.join(dir2save,subject + '_task-' + fname + '-maxfilter_cache.json')
+    cache = read_cache(cache_fname)
+    
+    bads_key = cache_key({
+        'raw': file_hash(raw_fname),
+        'cross_talk': file_hash(crosstalk_file),
+        'calibration': file_hash(fine_cal_file),
+        'coord_frame': coord_frame,
+        'OTP': OTP,
+        'mne': mne.__version__,
+        'segments': [bad_detection_duration, bad_detection_segments] if low_memory else None,
+        })
+    maxfilter_key = cache_key({
+        'bads': bads_key,
+        'st_duration': st_duration,
+        'destination': file_hash(destination),
+        'head_pos': file_hash(head_pos),
+        # the chunked output (non-overlapping tSSS windows) differs from the
+        # normal mode
+        'chunks': {'low_memory': True, 'chunk_duration': chunk_duration, 
+                   'st_overlap': False} if low_memory else None,
+        })
+    
+    psd_fnames = [get_psd_fname(subject, fname, tsss) for tsss in [False, True]]
+    
+    if cache.get('maxfilter_key') == maxfilter_key and op.isfile(tsss_fname):
+        print(f"{subject} {fname}: Maxwell filtered data taken from cache.")
+        if all(op.isfile(psd_fname) for psd_fname in psd_fnames):
+            result = {'subject': subject,
+                      'fname': fname,
+                      'peak_rss_mb': peak_memory.stop(),
+                      'start_rss_mb': peak_memory.start_mb,
+                      }
+            return result
+        if OTP:
+            raw = mne.preprocessing.oversampled_temporal_projection(raw)
+        raw.info['bads'] = cache['bads']
+        raw_tsss = mne.io.read_raw_fif(tsss_fname, verbose=True)
+        if low_memory:
+            psd_before, psd_after = compute_psds_chunked(raw, raw_tsss, st_duration)
+        
+    else:
+        #%% Oversampled temporal projection
+        if OTP:
+            raw = mne.preprocessing.oversampled_temporal_projection(raw)
+            
+        #%% Detect bad channels
+        raw.info['bads'] = []
+        if cache.get('bads_key') == bads_key:
+            print(f"{subject} {fname}: Bad channels taken from cache.")
+            auto_noisy_chs, auto_flat_chs = cache['noisy'], cache['flat']
+        elif low_memory:
+            auto_noisy_chs, auto_flat_chs = detect_bad_channels_segments(raw, coord_frame)
+        else:
             raw_check = raw.copy()
             auto_noisy_chs, auto_flat_chs = find_bad_channels_maxwell(
                 raw_check, cross_talk=crosstalk_file, calibration=fine_cal_file,
                 coord_frame=coord_frame, return_scores=False, verbose=True)
-            print(auto_noisy_chs)  
-            print(auto_flat_chs)  
-            
-            # Update list of bad channels
-            bads = raw.info['bads'] + auto_noisy_chs + auto_flat_chs
-            raw.info['bads'] = bads
+        print(auto_noisy_chs)  
+        print(auto_flat_chs)  
+        
+        # Update list of bad channels
+        bads = raw.info['bads'] + auto_noisy_chs + auto_flat_chs
+        raw.info['bads'] = bads
+        
+        if not op.exists(dir2save):
+            os.makedirs(dir2save, exist_ok=True)
+            print("Directory '{}' created".format(dir2save))
             
-            #%% Apply MaxFilter
+        #%% Apply MaxFilter and save data
+        if low_memory:
+            psd_before, psd_after = maxwell_filter_chunked(
+                raw, tsss_fname, st_duration, cross_talk=crosstalk_file, calibration=fine_cal_file,
+                head_pos=head_pos, destination=destination, coord_frame=coord_frame)
+        else:
             raw_tsss = mne.preprocessing.maxwell_filter(
                 raw, cross_talk=crosstalk_file, calibration=fine_cal_file, 
                 st_duration=st_duration, head_pos=head_pos, destination=destination, coord_frame=coord_frame, verbose=True)
-                
-            #%% Save data
-            if not op.exists(dir2save):
-                os.makedirs(dir2save)
-                print("Directory '{}' created".format(dir2save))
-                
-            raw_tsss.save(os.path.join(dir2save,subject + '_task-' + fname + '-raw_tsss.fif'),overwrite=True)
-
-            #%% Add a plot of the data to the HTML report
-            # report_fname = op.join(dir2save,subject+'-report.hdf5')
-            # report_html_fname = op.join(dir2save,subject+'-report.html')
-            # with mne.open_report(report_fname) as report:
-            #     report.add_raw(raw=raw, title=f'Raw data before maxwell filter : {task}', psd=True, replace=True)
-            #     report.add_raw(raw=raw_tsss, title=f'Raw data after maxwell filter: {task}', psd=True, replace=True)
-            #     report.save(report_html_fname, overwrite=True,open_browser=False)
-                
-            figs_list_before.append(raw.compute_psd().plot(show=False, xscale='log'))
-            figs_list_after.append(raw_tsss.compute_psd().plot(show=False, xscale='log'))
-            captions_list.append(fname)
+            raw_tsss.save(tsss_fname,overwrite=True)
         
-    #%% Append plots to report
+        # Cache is written after saving, so it is only valid with the saved file
+        write_cache(cache_fname, {'bads_key': bads_key,
+                                  'noisy': auto_noisy_chs,
+                                  'flat': auto_flat_chs,
+                                  'bads': bads,
+                                  'maxfilter_key': maxfilter_key,
+                                  })
+
+    #%% PSDs for the HTML report
+    if not low_memory:
+        psd_before = raw.compute_psd()
+        psd_after = raw_tsss.compute_psd()
+    for psd, psd_fname in zip([psd_before, psd_after], psd_fnames):
+        psd.save(psd_fname, overwrite=True)
+        
+    result = {'subject': subject,
+              'fname': fname,
+              'peak_rss_mb': peak_memory.stop(),
+              'start_rss_mb': peak_memory.start_mb,
+              }
+    print(f"{subject} {fname}: peak memory of the worker (RSS) {result['peak_rss_mb']} MB "
+          f"(at start of the file: {result['start_rss_mb']} MB)")
+    return result
+
+def write_report(subject):
+    """
+    Appends the PSD plots of all files of a subject to the report. The PSDs are
+    read from disk, each figure is rendered and closed right away.
+    """
+    dir2save = get_dir2save(subject)
+    figs_list_before = []
+    figs_list_after = []
+    captions_list = []
+    # keep order of fnames
+    for fname in fnames:
+        psd_fnames = [get_psd_fname(subject, fname, tsss) for tsss in [False, True]]
+        if not all(op.isfile(psd_fname) for psd_fname in psd_fnames):
+            continue
+        for psd_fname, figs_list in zip(psd_fnames, [figs_list_before, figs_list_after]):
+            psd = mne.time_frequency.read_spectrum(psd_fname)
+            figs_list.append(fig_to_array(psd.plot(show=False, xscale='log')))
+            del psd
+        captions_list.append(fname)
+        
+    if not captions_list:
+        return
+    
     report_fname = op.join(dir2save,subject + '-report.hdf5')
     report_html_fname = op.join(dir2save,subject + '-report.html')
     with mne.open_report(report_fname) as report:
@@ -210,4 +719,86 @@ for subject in subjects:
         caption=captions_list,
         replace=True
         )
-    report.save(report_html_fname, overwrite=True,open_browser=False)  
\ No newline at end of file
+    report.save(report_html_fname, overwrite=True,open_browser=False)
+
+def get_memory_budget():
+    """
+    Returns the memory budget for files processed at the same time in bytes.
+    """
+    if max_memory_gb is not None:
+        return max_memory_gb * 1e9
+    try:
+        import psutil
+    except ImportError:
+        return float('inf')
+    return 0.75 * psutil.virtual_memory().available
+
+def estimate_memory(raw_fname):
+    """
+    Estimated memory in bytes needed to process a file. In low memory mode only
+    a chunk of the recording is in memory.
+    """
+    memory = memory_factor * op.getsize(raw_fname)
+    if low_memory:
+        duration = mne.io.read_raw_fif(raw_fname, allow_maxshield=False, verbose=False).times[-1]
+        memory *= min(1, max(chunk_duration, bad_detection_duration) / duration)
+    return memory
+
+def run_parallel(tasks):
+    """
+    Processes (subject, fname) pairs in a process pool. A new file is only 
+    started if the estimated memory of all running files stays within the 
+    memory budget (at least one file is always processed).
+    
+    Returns
+    -------
+    results: list of results of process_file
+    """
+    budget = get_memory_budget()
+    queue = list(tasks)
+    pending = {} # future: estimated memory
+    results = []
+    
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        while queue or pending:
+            # Fill pool as long as memory budget allows it
+            while queue and len(pending) < n_jobs:
+                memory = estimate_memory(get_raw_fname(*queue[0]))
+                if pending and sum(pending.values()) + memory > budget:
+                    break
+                pending[executor.submit(process_file, *queue.pop(0))] = memory
+                
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                results.append(future.result())
+                
+    return results
+
+#%% Processing
+
+if __name__ == '__main__':
+    
+    #%% Headposition computations for movement correction
+    if MC and run_maxfilter: 
+        for subject in subjects:
+            compute_head_positions(subject)
+            
+    #%% maxfilter processing
+    if run_maxfilter:
+        tasks = [(subject, fname) for subject in subjects for fname in fnames 
+                 if op.isfile(get_raw_fname(subject, fname))]
+        
+        if n_jobs > 1:
+            results = run_parallel(tasks)
+        else:
+            results = [process_file(*task) for task in tasks]
+    
+    #%% Append plots to report
+    if run_report:
+        if n_jobs > 1 and len(subjects) > 1:
+            with ProcessPoolExecutor(max_workers=min(n_jobs, len(subjects))) as executor:
+                list(executor.map(write_report, subjects))
+        else:
+            for subject in subjects:
+                write_report(subject)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Check of the recorded triggers (Python counterpart of check_trigger.m)
+
+- Loop over all subjects
+- Loop over all runs
+- only the stim channels are read from the .fif files (no MATLAB/FieldTrip)
+- events are the steps to a higher value (like mne.find_events), extracted 
+  with vectorized NumPy over the whole channel
+- number of events and onset-to-onset intervals (jitter) per stim channel
+
+Matching with the results of the experiment scripts
+---------------------------------------------------
+If the results JSON of a run exists (results_dir, *_cfg_results.json with
+playmatrix and jitterlist), the events with the trial values (trial_values)
+of the sum channel are matched against the saved sequence:
+- the sum channel is masked to the bits of the trial values before the edges
+  are extracted, so a trial onset during another trigger (e.g. button press,
+  16 + 1 = 17) keeps its trial value
+- the recorded onsets are assigned to the planned trials by their 
+  onset-to-onset intervals (match_tolerance), starting from the best of 
+  several anchors, so a missing or additional onset (also at the start) 
+  doesn't shift the following trials
+- number of trials, missing trials and trial types (playmatrix)
+- recorded minus planned onset-to-onset interval (stim_duration + jitterlist)
+  of consecutive trials
+
+Usage
+-----
+    python check_trigger.py
+The summary is printed and saved to derivatives/trigger_check.json.
+"""
+
+#%% Settings
+import os
+import os.path as op
+import json
+import numpy as np
+import mne
+
+subjects  = ['sub-01','sub-02','sub-03']
+fnames = ['aef_run-1',
+          'aef_run-2']
+
+# path to project (needs to be adjusted)
+rootpath = op.join('C:',os.sep,'Users','tillhabersetzer','Nextcloud','Synchronisation','Projekte','GitHub','MEEG-experiments','SimpleAuditoryEvokedFields')
+
+# Stim channels to check and channel used for the jitter and the matching
+stim_channels = ['STI001','STI101']
+sum_channel = 'STI101'
+
+# Event values of the trial onsets in the sum channel per trial type of the
+# playmatrix (AEF: a single trial type). The values must not share bits with
+# other triggers (e.g. button).
+trial_values = {0: 1}
+# Maximum deviation of a recorded from the planned onset-to-onset interval in 
+# s (matching with the results JSON)
+match_tolerance = 0.1
+
+# Folder with the results JSON of the experiment scripts (None: no matching)
+results_dir = None
+# Stimulus duration in s: planned onset-to-onset interval is
+# stim_duration + jitterlist (AEF: 0, the jitter is the ISI)
+stim_duration = 0
+
+#%% Function definitions
+
+def get_raw_fname(subject, fname):
+    return os.path.join(rootpath,'rawdata',subject,'meg',subject + '_task-' + fname + '.fif')
+
+def get_results_fname(subject, fname):
+    """
+    Results JSON as saved by the experiment scripts, e.g.
+    sub-01task-oddball_1_cfg_results.json for oddball_run-1.
+    """
+    if results_dir is None:
+        return None
+    return op.join(results_dir, subject + 'task-' + fname.replace('_run-','_') + '_cfg_results.json')
+
+def read_stim_channels(raw_fname, channels):
+    """
+    Reads only the given stim channels of a recording.
+
+    Returns
+    -------
+    data: dict
+        channel -> int64 array of the whole recording
+    sfreq: float
+    """
+    raw = mne.io.read_raw_fif(raw_fname, allow_maxshield=True, verbose=False)
+    channels = [ch for ch in channels if ch in raw.ch_names]
+    data = raw.get_data(picks=channels)
+    return dict(zip(channels, np.rint(data).astype(np.int64))), raw.info['sfreq']
+
+def find_edges(signal):
+    """
+    Samples and values of the steps to a higher value (vectorized over the
+    whole channel, a value at the first sample counts as an event). Falling
+    back from overlapping triggers (e.g. button press during a trial trigger)
+    is not an event.
+    """
+    previous = np.concatenate(([0], signal[:-1]))
+    samples = np.flatnonzero(signal > previous)
+    return samples, signal[samples]
+
+def find_trial_edges(signal, onset_values=None):
+    """
+    Trial onsets of the sum channel: the channel is masked to the bits of the
+    trial values (onset_values, default: trial_values) before the edges are 
+    extracted, so other triggers (e.g. button press) neither hide nor change a
+    trial onset.
+    """
+    if onset_values is None:
+        onset_values = trial_values
+    mask = 0
+    for value in onset_values.values():
+        mask |= value
+    samples, values = find_edges(signal & mask)
+    # only the trial onsets
+    is_trial = np.isin(values, list(onset_values.values()))
+    return samples[is_trial], values[is_trial]
+
+def _follow_trials(times, planned, onset, trial, tolerance):
+    """
+    Assignment of the onsets after an anchor (onset is trial): every following
+    onset is assigned to the planned trial whose onset-to-onset interval to 
+    the trial of the previous assigned onset is closest to the recorded 
+    interval (at most tolerance apart).
+
+    Returns
+    -------
+    trials: array of int
+        planned trial of each onset (-1: not assigned)
+    error: float
+        summed absolute deviation of the assigned intervals in s
+    """
+    trials = np.full(len(times), -1)
+    trials[onset] = trial
+    last = onset # last assigned onset
+    error = 0.
+    for onset in range(onset+1, len(times)):
+        target = planned[trials[last]] + times[onset] - times[last]
+        k = np.searchsorted(planned, target)
+        candidates = [c for c in (k-1, k) if trials[last] < c < len(planned)]
+        if not candidates:
+            continue
+        trial = min(candidates, key=lambda c: abs(planned[c] - target))
+        if abs(planned[trial] - target) <= tolerance:
+            trials[onset] = trial
+            error += abs(planned[trial] - target)
+            last = onset
+    return trials, error
+
+def align_trials(samples, sfreq, planned_isi, tolerance=None, n_anchor=5):
+    """
+    Assigns the recorded trial onsets to the planned trials. Each of the first
+    n_anchor onsets is tried as each of the first n_anchor planned trials 
+    (anchor), the following onsets are assigned by their onset-to-onset 
+    intervals (at most tolerance apart, default: match_tolerance). The anchor 
+    with the most assigned onsets (then the smallest interval error) is kept.
+    So missing first trials or additional onsets before the run (e.g. test 
+    triggers) don't shift the trials, a missing onset later on skips its 
+    trial and an additional onset isn't assigned.
+
+    Parameters
+    ----------
+    samples: array of int
+        recorded trial onsets
+    sfreq: float
+    planned_isi: array
+        planned onset-to-onset interval after each trial in s (stim_duration 
+        + jitterlist)
+    tolerance: float or None
+        maximum deviation of the intervals in s. The default is None 
+        (match_tolerance).
+    n_anchor: int
+        number of onsets and planned trials tried as anchor. The default is 5.
+
+    Returns
+    -------
+    trials: array of int
+        planned trial of each onset (-1: not assigned)
+    """
+    if tolerance is None:
+        tolerance = match_tolerance
+    planned_isi = np.asarray(planned_isi, dtype=float)
+    planned = np.concatenate(([0], np.cumsum(planned_isi[:-1])))
+    times = samples / sfreq
+    best, best_score = np.full(len(samples), -1), None
+    for onset in range(min(n_anchor, len(samples))):
+        for trial in range(min(n_anchor, len(planned))):
+            trials, error = _follow_trials(times, planned, onset, trial, tolerance)
+            score = (np.sum(trials >= 0), -error)
+            if best_score is None or score > best_score:
+                best, best_score = trials, score
+    return best
+
+def describe(values):
+    """
+    Returns count, mean, std, min, p95 and max.
+    """
+    values = np.asarray(values, dtype=float)
+    if values.size == 0:
+        return dict(n=0)
+    return dict(n=int(values.size), mean=values.mean(), std=values.std(), min=values.min(),
+                p95=np.percentile(values, 95), max=values.max())
+
+def match_results(samples, values, sfreq, results_cfg):
+    """
+    Matches the trial onsets of the sum channel (find_trial_edges) with 
+    playmatrix and jitterlist of the results JSON.
+    """
+    playmatrix = np.asarray(results_cfg['playmatrix'], dtype=int)
+    jitterlist = np.asarray(results_cfg['jitterlist'], dtype=float)
+    planned_values = np.array([trial_values[trialtype] for trialtype in playmatrix], dtype=np.int64)
+
+    trials = align_trials(samples, sfreq, stim_duration + jitterlist)
+    assigned = trials >= 0
+    samples, values, trials = samples[assigned], values[assigned], trials[assigned]
+    # onset-to-onset intervals of consecutive trials only
+    consecutive = np.diff(trials) == 1
+    isi_error = (np.diff(samples) / sfreq - (stim_duration + jitterlist[trials[:-1]]))[consecutive]
+    return {'trials planned': int(len(planned_values)),
+            'trials recorded': int(np.sum(assigned)),
+            'trials missing': int(len(planned_values) - len(trials)),
+            'onsets not assigned': int(np.sum(~assigned)),
+            'wrong trial type': int(np.sum(values != planned_values[trials])),
+            'ISI error [ms]': describe(isi_error * 1000)}
+
+def check_file(subject, fname):
+    data, sfreq = read_stim_channels(get_raw_fname(subject, fname), stim_channels)
+    summary = {'duration [s]': None}
+    for channel, signal in data.items():
+        samples, values = find_edges(signal)
+        unique, counts = np.unique(values, return_counts=True)
+        summary[channel] = {'events': int(len(samples)),
+                            'values': {int(value): int(count) for value, count in zip(unique, counts)}}
+        if channel == sum_channel:
+            # time between first and last trigger
+            if len(samples):
+                summary['duration [s]'] = (samples[-1] - samples[0]) / sfreq
+            trial_samples, onset_values = find_trial_edges(signal)
+            summary[channel]['onset-to-onset [ms]'] = describe(np.diff(trial_samples) * 1000 / sfreq)
+
+            results_fname = get_results_fname(subject, fname)
+            if results_fname is not None and op.isfile(results_fname):
+                with open(results_fname) as json_file:
+                    summary['results'] = match_results(trial_samples, onset_values, sfreq, 
+                                                       json.load(json_file))
+    return summary
+
+def print_summary(subject, fname, summary):
+    print(f"\n{subject} {fname} (duration {summary['duration [s]']} s)")
+    for channel in stim_channels:
+        if channel not in summary:
+            continue
+        print(f"  {channel}: {summary[channel]['events']} events, values {summary[channel]['values']}")
+        if 'onset-to-onset [ms]' in summary[channel]:
+            print(f"  {channel} onset-to-onset [ms]: {_format(summary[channel]['onset-to-onset [ms]'])}")
+    if 'results' in summary:
+        results = summary['results']
+        print(f"  trials recorded/planned: {results['trials recorded']}/{results['trials planned']}, "
+              f"missing: {results['trials missing']}, "
+              f"onsets not assigned: {results['onsets not assigned']}, "
+              f"wrong trial type: {results['wrong trial type']}")
+        print(f"  ISI error [ms]: {_format(results['ISI error [ms]'])}")
+
+def _format(stats):
+    return ', '.join(f"{key} {value:.3f}" if isinstance(value, float) else f"{key} {value}"
+                     for key, value in stats.items())
+
+#%% Check all recordings
+
+if __name__ == '__main__':
+
+    summaries = {}
+    for subject in subjects:
+        for fname in fnames:
+            if not op.isfile(get_raw_fname(subject, fname)):
+                continue
+            summary = check_file(subject, fname)
+            print_summary(subject, fname, summary)
+            summaries[subject + '_task-' + fname] = summary
+
+    dir2save = op.join(rootpath,'derivatives')
+    if not op.exists(dir2save):
+        os.makedirs(dir2save)
+    with open(op.join(dir2save,'trigger_check.json'), 'w') as outfile:
+        json.dump(summaries, outfile, indent=4)
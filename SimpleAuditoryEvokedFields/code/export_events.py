@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Export of BIDS events (_events.tsv) from the recordings and the results JSON
+
+- Loop over all subjects
+- Loop over all runs
+- the trial onsets are taken from the sum channel of the recording (sample
+  accurate, see check_trigger.py), trial types and reaction times from the
+  results JSON of the experiment script (playmatrix, triallabel, reaction
+  times)
+- the sum channel is masked to the bits of the trial values, so a trial onset
+  during another trigger (e.g. button press) keeps its value
+- the onsets are assigned to the trials of the results JSON by their 
+  onset-to-onset intervals (check_trigger.align_trials). Missing trials and 
+  onsets before the first or after the last assigned trial (e.g. test 
+  triggers) are left out with a warning. An onset within the run that can't 
+  be assigned or whose value doesn't match trial_values[playmatrix] raises a
+  ValueError, no events are written for the run.
+- all columns are built in one vectorized pass and written next to the raw
+  data: sub-01_task-aef_run-1.fif -> sub-01_task-aef_run-1_events.tsv
+
+Columns
+-------
+onset, duration (s), sample, trial_type, value, response_time (s, n/a for
+trials without response and for misses)
+
+Epoching can read the events directly (e.g. pandas.read_csv(fname, sep='\t')
+or mne-bids) instead of extracting the triggers from the raw data again.
+"""
+
+#%% Settings
+import os
+import os.path as op
+import json
+import warnings
+import numpy as np
+
+from check_trigger import read_stim_channels, find_trial_edges, align_trials
+
+subjects  = ['sub-01','sub-02','sub-03']
+fnames = ['aef_run-1',
+          'aef_run-2']
+
+# path to project (needs to be adjusted)
+rootpath = op.join('C:',os.sep,'Users','tillhabersetzer','Nextcloud','Synchronisation','Projekte','GitHub','MEEG-experiments','SimpleAuditoryEvokedFields')
+
+# Channel with the trial onsets
+sum_channel = 'STI101'
+
+# Event values of the trial onsets in the sum channel per trial type of the
+# playmatrix and names of the trial types without results JSON
+trial_values = {0: 1}
+trial_names = {0: 'click'}
+
+# Trial types with a response (reaction times in the results JSON in the
+# order of these trials, oddball: [1] for the targets)
+response_types = []
+
+# Folder with the results JSON of the experiment scripts (None: trial types
+# from the recorded values only)
+results_dir = None
+# Duration of the stimulus in s: planned onset-to-onset interval is 
+# stim_duration + jitterlist
+stim_duration = 0
+# Maximum deviation of a recorded from the planned onset-to-onset interval in s
+match_tolerance = 0.1
+
+#%% Function definitions
+
+def get_raw_fname(subject, fname):
+    return os.path.join(rootpath,'rawdata',subject,'meg',subject + '_task-' + fname + '.fif')
+
+def get_events_fname(subject, fname):
+    return os.path.join(rootpath,'rawdata',subject,'meg',subject + '_task-' + fname + '_events.tsv')
+
+def get_results_fname(subject, fname):
+    """
+    Results JSON as saved by the experiment scripts, e.g.
+    sub-01task-oddball_1_cfg_results.json for oddball_run-1.
+    """
+    if results_dir is None:
+        return None
+    return op.join(results_dir, subject + 'task-' + fname.replace('_run-','_') + '_cfg_results.json')
+
+def build_events(samples, values, sfreq, results_cfg=None):
+    """
+    Returns the columns of the events table.
+
+    Parameters
+    ----------
+    samples, values: arrays
+        trial onsets in the sum channel (find_trial_edges)
+    sfreq: float
+    results_cfg: dict or None
+        results JSON of the run
+
+    Returns
+    -------
+    events: dict
+        column -> array
+    """
+    value_types = {value: trialtype for trialtype, value in trial_values.items()}
+    if results_cfg is None:
+        trialtypes = np.array([value_types[value] for value in values])
+        trial_type = np.array([trial_names[trialtype] for trialtype in trialtypes], dtype=object)
+        response_time = np.full(len(values), np.nan)
+    else:
+        playmatrix = np.asarray(results_cfg['playmatrix'], dtype=int)
+        jitterlist = np.asarray(results_cfg['jitterlist'], dtype=float)
+        trials = align_trials(samples, sfreq, stim_duration + jitterlist, match_tolerance)
+        assigned = np.flatnonzero(trials >= 0)
+        if assigned.size == 0:
+            raise ValueError("No onset matches the planned trials.")
+        # onsets before or after the run (e.g. test triggers) are left out
+        outside = np.r_[:assigned[0], assigned[-1]+1:len(trials)]
+        if outside.size:
+            warnings.warn(f"Onsets at samples {samples[outside].tolist()} are outside of the "
+                          f"run and left out.")
+            run = slice(assigned[0], assigned[-1]+1)
+            samples, values, trials = samples[run], values[run], trials[run]
+        if np.any(trials < 0):
+            raise ValueError(f"Onsets at samples {samples[trials < 0].tolist()} don't match "
+                             f"the planned trials.")
+        planned_values = np.array([trial_values[trialtype] for trialtype in playmatrix],
+                                  dtype=np.int64)
+        wrong = np.flatnonzero(values != planned_values[trials])
+        if wrong.size:
+            raise ValueError(f"Recorded values of trials {trials[wrong].tolist()} don't match "
+                             f"trial_values[playmatrix].")
+        if len(trials) != len(playmatrix):
+            missing = np.setdiff1d(np.arange(len(playmatrix)), trials)
+            warnings.warn(f"{len(trials)} trials recorded, {len(playmatrix)} planned. "
+                          f"Trials {missing.tolist()} are missing.")
+        trialtypes = playmatrix[trials]
+        trial_type = np.asarray(results_cfg['triallabel'], dtype=object)[trials]
+
+        # reaction times in the order of the trials with a response
+        response_times = np.full(len(playmatrix), np.nan)
+        has_response = np.flatnonzero(np.isin(playmatrix, response_types))
+        reaction_times = np.asarray(results_cfg['reaction times'], dtype=float)
+        m = min(len(has_response), len(reaction_times))
+        response_times[has_response[:m]] = reaction_times[:m]
+        response_time = response_times[trials]
+        # misses are saved as inf
+        response_time[~np.isfinite(response_time)] = np.nan
+
+    return {'onset': samples / sfreq,
+            'duration': np.full(len(samples), float(stim_duration)),
+            'sample': samples,
+            'trial_type': trial_type,
+            'value': values,
+            'response_time': response_time}
+
+def write_events_tsv(events_fname, events):
+    """
+    Writes the events table (n/a for missing values).
+    """
+    columns = [np.char.mod('%.6f', events['onset']),
+               np.char.mod('%.6f', events['duration']),
+               np.char.mod('%d', events['sample']),
+               events['trial_type'].astype(str),
+               np.char.mod('%d', events['value']),
+               np.where(np.isnan(events['response_time']), 'n/a',
+                        np.char.mod('%.6f', events['response_time']))]
+    lines = ['\t'.join(row) for row in zip(*columns)]
+    with open(events_fname, 'w') as outfile:
+        outfile.write('\t'.join(events.keys()) + '\n')
+        outfile.writelines(line + '\n' for line in lines)
+
+def export_events(subject, fname):
+    data, sfreq = read_stim_channels(get_raw_fname(subject, fname), [sum_channel])
+    # trial onsets, sum channel masked to the bits of the trial values
+    samples, values = find_trial_edges(data[sum_channel], trial_values)
+
+    results_cfg = None
+    results_fname = get_results_fname(subject, fname)
+    if results_fname is not None and op.isfile(results_fname):
+        with open(results_fname) as json_file:
+            results_cfg = json.load(json_file)
+
+    events = build_events(samples, values, sfreq, results_cfg)
+    write_events_tsv(get_events_fname(subject, fname), events)
+    return events
+
+#%% Export all recordings
+
+if __name__ == '__main__':
+
+    for subject in subjects:
+        for fname in fnames:
+            if not op.isfile(get_raw_fname(subject, fname)):
+                continue
+            events = export_events(subject, fname)
+            print(f"{subject} {fname}: {len(events['onset'])} events written.")
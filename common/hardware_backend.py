@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Hardware backends of the experiment scripts
+
+The scripts don't import pypixxlib, soundmexpro or serial directly, but take
+them from a backend:
+- 'hardware': the real interfaces of the lab (imported on first use, so a
+  script only needs the packages of the devices it uses)
+- 'simulator': in-process simulation of DATAPixx, ResponsePixx, SoundMexPro
+  and TriggerBox (see simulator.py). Runs on any computer and records every
+  hardware output in backend.device.events.
+
+Example
+-------
+    backend = load_backend('simulator', press_script=[(2.0, 1)])
+    dp = backend.dp
+    rp = backend.rp
+    soundmexpro = backend.soundmexpro
+    port = backend.serial.Serial('COM6')
+"""
+
+import importlib
+
+BACKENDS = ['hardware', 'simulator']
+
+#%% Backends
+#------------------------------------------------------------------------------
+
+class HardwareBackend:
+    """
+    Real hardware interfaces, imported on first access:
+    - dp: pypixxlib._libdpx
+    - rp: pypixxlib.responsepixx
+    - soundmexpro: soundmexpro.soundmexpro (the SoundMexPro bin folder has to
+      be on the search path)
+    - serial: pyserial
+    """
+    name = 'hardware'
+    device = None
+
+    @property
+    def dp(self):
+        return importlib.import_module('pypixxlib._libdpx')
+
+    @property
+    def rp(self):
+        return importlib.import_module('pypixxlib.responsepixx')
+
+    @property
+    def soundmexpro(self):
+        return importlib.import_module('soundmexpro').soundmexpro
+
+    @property
+    def serial(self):
+        return importlib.import_module('serial')
+
+class SimulatorBackend:
+    """
+    Simulated interfaces sharing one SimulatedDevice (device).
+    """
+    name = 'simulator'
+
+    def __init__(self, **options):
+        from simulator import (SimulatedDevice, SimulatedDPx, SimulatedResponsePixx,
+                               SimulatedSoundMexPro, SimulatedSerialModule)
+        self.device = SimulatedDevice(**options)
+        self.dp = SimulatedDPx(self.device)
+        self.rp = SimulatedResponsePixx(self.device, self.dp)
+        self.soundmexpro = SimulatedSoundMexPro(self.device)
+        self.serial = SimulatedSerialModule(self.device)
+
+def load_backend(name='hardware', **options):
+    """
+    Returns the backend.
+
+    Parameters
+    ----------
+    name: str
+        'hardware' or 'simulator'. The default is 'hardware'.
+    options:
+        options of the simulated device (see simulator.SimulatedDevice)
+
+    Returns
+    -------
+    backend: HardwareBackend or SimulatorBackend
+    """
+    if name == 'hardware':
+        return HardwareBackend()
+    elif name == 'simulator':
+        return SimulatorBackend(**options)
+    raise ValueError(f"Unknown backend '{name}', use one of {BACKENDS}.")
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Keyboard service: emergency stop and keyboard responses
+
+The trial loops used to call kb.getKeys(['escape']) (or ['escape','space'])
+in every iteration, and in the EEG scripts the same keyboard queue was read
+for the emergency stop and for the reaction times.
+
+The KeyboardService is the only reader of the PsychoPy keyboard during the
+trials. It reads the keyboard on its own thread at a fixed interval and
+- sets the cancellation event (cancel, threading.Event) when a stop key is
+  pressed. The TrialRunner waits on this event (TrialRunner(cancel=...)), so
+  a trial is aborted at most interval + spin_margin after the key press
+  (keys are read on key down, getKeys(waitRelease=False)).
+- stores the response keys with their key-down timestamps (KeyPress.tDown,
+  host clock of PsychoPy, core.getTime) in a preallocated ring buffer. The
+  reaction time is tDown - onset, independent of when the key is read.
+
+PsychoPy reads the keyboard from a thread with the psychtoolbox backend
+(default when psychtoolbox is installed).
+
+Example
+-------
+    kb_service = KeyboardService(kb, stop_keys=['escape'], response_keys=['space'])
+    runner = TrialRunner(poll_interval=0.005, clock=core.getTime, cancel=kb_service.cancel)
+    kb_service.start()
+    ...
+    response_index = kb_service.count
+    aborted = runner.run(TrialDur, poll=poll_trial, start=startTime)
+    ...
+    kb_service.stop()
+"""
+
+import threading
+import time
+import numpy as np
+
+#%% Keyboard service
+#------------------------------------------------------------------------------
+
+class KeyboardService:
+    """
+    Reads the keyboard from a service thread.
+
+    Parameters
+    ----------
+    kb: psychopy.hardware.keyboard.Keyboard
+        keyboard (not read by the trial loop while the service is running)
+    stop_keys: list of str
+        keys that set the cancellation event. The default is ['escape'].
+    response_keys: list of str
+        keys stored as responses. The default is ['space'].
+    interval: float
+        time between two reads of the keyboard in s. The default is 0.005.
+    size: int
+        capacity of the ring buffer (older entries are overwritten). The
+        default is 1024.
+    sleep: callable
+        sleep function. The default is time.sleep.
+    """
+
+    def __init__(self, kb, stop_keys=('escape',), response_keys=('space',), interval=0.005,
+                 size=1024, sleep=time.sleep):
+        self.kb = kb
+        self.stop_keys = list(stop_keys)
+        self.response_keys = list(response_keys)
+        self.interval = interval
+        self.size = size
+        self.sleep = sleep
+        self.cancel = threading.Event()
+        self.times = np.zeros(size)
+        self.names = np.empty(size, dtype=object)
+        self.count = 0 # number of responses received, only written by the thread
+        self._running = False
+        self._thread = None
+
+    @property
+    def cancelled(self):
+        return self.cancel.is_set()
+
+    def start(self):
+        """
+        Discards the keys pressed so far and starts the service thread.
+        """
+        self.kb.clearEvents()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='KeyboardService',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def get(self, start=0):
+        """
+        Returns key-down times and names of the responses since the start-th
+        response (at most the last size responses).
+
+        Returns
+        -------
+        times: array
+            host clock (core.getTime) in s
+        names: array of str
+        """
+        count = self.count
+        start = max(start, count - self.size, 0)
+        index = np.arange(start, count) % self.size
+        return self.times[index], self.names[index]
+
+    def update(self):
+        """
+        Reads the keyboard once.
+        """
+        # keys are returned on key down (default waitRelease=True: on release)
+        for key in self.kb.getKeys(self.stop_keys + self.response_keys, waitRelease=False):
+            if key.name in self.stop_keys:
+                self.cancel.set()
+                continue
+            index = self.count % self.size
+            self.times[index] = key.tDown
+            self.names[index] = key.name
+            self.count += 1
+
+    def _run(self):
+        while self._running:
+            self.update()
+            self.sleep(self.interval)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Background acquisition of the ResponsePixx button log
+
+The DATAPixx scripts used to read the DIN log inside the button poll of the
+trial loop (DPxUpdateRegCache, listener.updateLogs, getNewButtonActivity) and
+stopped reading it after the first response of a trial, so later presses were
+never logged and could show up as responses of the next trial.
+
+The ResponseAcquisition drains the button log on its own thread at a fixed
+interval and stores every event (device timestamp, button) in a preallocated
+ring buffer. The trial loop only compares the event counter with its own index
+(no USB transfer) and reads the new events when there are any. All buttons are
+recorded, the trial loop selects the buttons of interest (buttonSubset).
+getNewButtonActivity is called with buttonSubset None, which pypixxlib 
+defines as all buttons (the default of the argument, also used by 
+DoubleToneAuditoryOddball/MEG/get_buttonIDs.py).
+
+pypixxlib is not thread-safe: every register access of the trial loop has to
+hold the lock of the acquisition (acquisition.lock). This includes staging
+register writes (DPxSetDacSchedule, DPxSetDoutValue, ...): the register cache
+is shared, so the DPxUpdateRegCache of the acquisition thread also commits
+writes that the main thread has staged but not written yet. Writes have to be
+staged and committed (DPxWriteRegCache / DPxUpdateRegCache) within the same
+'with acquisition.lock' block.
+
+Example
+-------
+    acquisition = ResponseAcquisition(dp, rp.ButtonListener(buttonDevice))
+    acquisition.start()
+    ...
+    response_index = acquisition.count
+    with acquisition.lock:
+        dp.DPxStartDacSched()
+        dp.DPxUpdateRegCache()
+        startTime = dp.DPxGetTime()
+    ...
+    if acquisition.count > response_index:
+        times, buttons = acquisition.get(response_index)
+    ...
+    acquisition.stop()
+"""
+
+import threading
+import time
+import numpy as np
+
+#%% Response acquisition
+#------------------------------------------------------------------------------
+
+class ResponseAcquisition:
+    """
+    Reads the button log of a ResponsePixx from an acquisition thread.
+
+    Parameters
+    ----------
+    dp: module
+        pypixxlib._libdpx (or the simulated DATAPixx)
+    listener: ButtonListener
+        listener of the button device
+    interval: float
+        time between two reads of the button log in s. The default is 0.005.
+    size: int
+        capacity of the ring buffer (older entries are overwritten). The
+        default is 4096.
+    recordPushes, recordReleases: bool
+        events passed to getNewButtonActivity. The default is pushes only.
+    lock: threading.RLock or None
+        lock of the DATAPixx register access. The default is None (new lock).
+    sleep: callable
+        sleep function. The default is time.sleep.
+    """
+
+    def __init__(self, dp, listener, interval=0.005, size=4096, recordPushes=True,
+                 recordReleases=False, lock=None, sleep=time.sleep):
+        self.dp = dp
+        self.listener = listener
+        self.interval = interval
+        self.size = size
+        self.recordPushes = recordPushes
+        self.recordReleases = recordReleases
+        self.lock = threading.RLock() if lock is None else lock
+        self.sleep = sleep
+        self.times = np.zeros(size)
+        self.buttons = np.zeros(size, dtype=np.int64)
+        self.count = 0 # number of events received, only written by the thread
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the acquisition thread. From now on register writes of the
+        main thread have to be staged and committed while holding self.lock,
+        otherwise the thread commits them at the time of its next read.
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='ResponseAcquisition',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        """
+        Stops the acquisition thread after a last read of the button log.
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def get(self, start=0):
+        """
+        Returns device timestamps and buttons of the events since the start-th
+        event (at most the last size events).
+
+        Returns
+        -------
+        times: array
+            device clock in s
+        buttons: array of int
+        """
+        count = self.count
+        start = max(start, count - self.size, 0)
+        index = np.arange(start, count) % self.size
+        return self.times[index], self.buttons[index]
+
+    def update(self):
+        """
+        Reads the button log once and appends the new events.
+        """
+        with self.lock:
+            self.dp.DPxUpdateRegCache()
+            self.listener.updateLogs()
+            output = self.listener.getNewButtonActivity(None, self.recordPushes,
+                                                        self.recordReleases)
+        for event in output:
+            index = self.count % self.size
+            self.times[index] = event[0]
+            self.buttons[index] = event[1]
+            self.count += 1
+
+    def _run(self):
+        while self._running:
+            self.update()
+            self.sleep(self.interval)
+        # events between the last read and stop()
+        self.update()
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Constrained generation of trial sequences (playmatrix)
+
+Sequences of standards (0) and targets (1) are sampled directly instead of 
+permuting the playmatrix until all rules are fullfilled (rejection sampling).
+The number of valid continuations is counted once for every position, number
+of remaining targets and run-length state (dynamic programming). Sampling walks
+through this table, so every sequence is drawn in O(NumTrials) and all valid 
+sequences are equally likely - exactly the distribution of the rejection 
+sampling, but without retries.
+
+Supported rules
+---------------
+- leading_standards: the first trials are always standards
+- max_target_run: no more than max_target_run targets in succession
+- min_target_spacing: at least min_target_spacing standards between two targets
+- max_standard_run: no more than max_standard_run standards in succession
+
+Example
+-------
+Rules of the double tone oddball (first four trials are standards, no more 
+than two targets in succession):
+    
+    playmatrix = generate_sequences(160, 48, leading_standards=4, 
+                                    max_target_run=2)[0]
+    
+Counterbalancing across subjects (one sequence per row):
+    
+    playmatrices = generate_sequences(160, 48, n_sequences=1000, 
+                                      leading_standards=4, max_target_run=2)
+"""
+
+import functools
+import numpy as np
+
+#%% Counting table
+#------------------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=16)
+def _build_table(num_trials, num_targets, leading_standards, max_target_run,
+                 min_target_spacing, max_standard_run):
+    """
+    Counts the valid continuations in log-space (no overflow for long runs).
+    
+    States are the run length of the last trial type:
+    - standard runs of length 1..capS after the first target
+    - standard runs of length 1..capP before the first target (no spacing rule)
+    - target runs of length 1..capT
+    - start state (no previous trial)
+    
+    Returns
+    -------
+    log_counts: (num_trials+1, num_targets+1, n_states) array
+        log number of valid continuations after i trials with k targets left 
+    next_standard, next_target: (n_states,) arrays
+        successor state if a standard/target is appended, -1 if not allowed
+    start: int
+        index of the start state
+    """
+    capT = num_trials if max_target_run is None else max_target_run
+    capT = max(min(capT, num_trials), 1)
+    capP = 1 if max_standard_run is None else max(min(max_standard_run, num_trials), 1)
+    capS = max(capP, min(min_target_spacing, num_trials), 1)
+    
+    S = np.arange(capS) # standard runs
+    P = capS + np.arange(capP) # leading standard runs
+    T = capS + capP + np.arange(capT) # target runs
+    start = capS + capP + capT
+    n_states = start + 1
+    
+    next_standard = np.full(n_states, -1, dtype=int)
+    next_target = np.full(n_states, -1, dtype=int)
+    
+    def standard_allowed(r):
+        return max_standard_run is None or r < max_standard_run
+    target_allowed = max_target_run is None or max_target_run > 0
+    
+    for r in range(1, capS+1):
+        if standard_allowed(r):
+            next_standard[S[r-1]] = S[min(r+1, capS)-1]
+        if target_allowed and r >= min_target_spacing:
+            next_target[S[r-1]] = T[0]
+    for r in range(1, capP+1):
+        if standard_allowed(r):
+            next_standard[P[r-1]] = P[min(r+1, capP)-1]
+        if target_allowed:
+            next_target[P[r-1]] = T[0]
+    for r in range(1, capT+1):
+        if standard_allowed(0):
+            next_standard[T[r-1]] = S[0]
+        if min_target_spacing == 0 and r < capT:
+            next_target[T[r-1]] = T[r]
+    if standard_allowed(0):
+        next_standard[start] = P[0]
+    if target_allowed:
+        next_target[start] = T[0]
+    
+    log_counts = np.full((num_trials+1, num_targets+1, n_states), -np.inf)
+    log_counts[num_trials, 0, :] = 0.0
+    
+    for i in range(num_trials-1, -1, -1):
+        for s in range(n_states):
+            options = np.full(num_targets+1, -np.inf)
+            if next_standard[s] >= 0:
+                options = log_counts[i+1, :, next_standard[s]].copy()
+            if next_target[s] >= 0 and i >= leading_standards:
+                options[1:] = np.logaddexp(options[1:], log_counts[i+1, :-1, next_target[s]])
+            log_counts[i, :, s] = options
+    
+    log_counts.setflags(write=False)
+    return log_counts, next_standard, next_target, start
+
+def _check_rules(num_trials, num_targets, leading_standards, max_target_run,
+                 min_target_spacing, max_standard_run):
+    if not 0 <= num_targets <= num_trials:
+        raise ValueError('num_targets must be between 0 and num_trials.')
+    if leading_standards < 0 or min_target_spacing < 0:
+        raise ValueError('leading_standards and min_target_spacing must be >= 0.')
+    if max_target_run is not None and max_target_run < 0:
+        raise ValueError('max_target_run must be >= 0 or None.')
+    if max_standard_run is not None and max_standard_run < 0:
+        raise ValueError('max_standard_run must be >= 0 or None.')
+
+#%% Public functions
+#------------------------------------------------------------------------------
+
+def count_sequences(num_trials, num_targets, leading_standards=0, max_target_run=None,
+                    min_target_spacing=0, max_standard_run=None):
+    """
+    Returns the number of valid sequences (float, may be very large).
+    
+    Parameters
+    ----------
+    see generate_sequences
+    
+    Returns
+    -------
+    n: float
+    """
+    _check_rules(num_trials, num_targets, leading_standards, max_target_run,
+                 min_target_spacing, max_standard_run)
+    log_counts, _, _, start = _build_table(num_trials, num_targets, leading_standards, 
+                                           max_target_run, min_target_spacing, 
+                                           max_standard_run)
+    return float(np.exp(log_counts[0, num_targets, start]))
+
+def generate_sequences(num_trials, num_targets, n_sequences=1, leading_standards=0, 
+                       max_target_run=None, min_target_spacing=0, max_standard_run=None, 
+                       rng=None):
+    """
+    Draws valid sequences uniformly from all sequences fullfilling the rules.
+    
+    Parameters
+    ----------
+    num_trials: int
+        length of each sequence
+    num_targets: int
+        number of targets (1) in each sequence, the rest are standards (0)
+    n_sequences: int
+        number of sequences (e.g. one per subject). The default is 1.
+    leading_standards: int
+        number of standards at the beginning. The default is 0.
+    max_target_run: int or None
+        maximum number of targets in succession. The default is None (no limit).
+    min_target_spacing: int
+        minimum number of standards between two targets. The default is 0.
+    max_standard_run: int or None
+        maximum number of standards in succession. The default is None (no limit).
+    rng: numpy.random.Generator or int or None
+        random number generator or seed. The default is None.
+        
+    Returns
+    -------
+    sequences: (n_sequences, num_trials) int array
+        0: standard, 1: target
+    """
+    _check_rules(num_trials, num_targets, leading_standards, max_target_run,
+                 min_target_spacing, max_standard_run)
+    rng = np.random.default_rng(rng)
+    log_counts, next_standard, next_target, start = _build_table(
+        num_trials, num_targets, leading_standards, max_target_run, 
+        min_target_spacing, max_standard_run)
+    
+    if np.isneginf(log_counts[0, num_targets, start]):
+        raise ValueError('No sequence fullfills the given rules.')
+    
+    sequences = np.zeros((n_sequences, num_trials), dtype=int)
+    state = np.full(n_sequences, start, dtype=int)
+    remaining = np.full(n_sequences, num_targets, dtype=int)
+    
+    # One vectorized step per trial for all sequences
+    for i in range(num_trials):
+        ns = next_target[state]
+        allowed = (ns >= 0) & (remaining > 0) & (i >= leading_standards)
+        # probability of a target = completions after target / all completions
+        log_p = np.full(n_sequences, -np.inf)
+        log_p[allowed] = (log_counts[i+1, remaining[allowed]-1, ns[allowed]]
+                          - log_counts[i, remaining[allowed], state[allowed]])
+        is_target = rng.random(n_sequences) < np.exp(log_p)
+        
+        sequences[:, i] = is_target
+        remaining -= is_target
+        state = np.where(is_target, ns, next_standard[state])
+        
+    return sequences
+
+def check_sequences(sequences, num_targets=None, leading_standards=0, max_target_run=None,
+                    min_target_spacing=0, max_standard_run=None):
+    """
+    Checks whether sequences fullfill the rules.
+    
+    Parameters
+    ----------
+    sequences: (num_trials,) or (n_sequences, num_trials) array with 0 and 1
+    other parameters: see generate_sequences, num_targets=None is not checked
+    
+    Returns
+    -------
+    valid: bool or (n_sequences,) bool array
+    """
+    sequences = np.asarray(sequences, dtype=int)
+    single = sequences.ndim == 1
+    sequences = np.atleast_2d(sequences)
+    valid = np.isin(sequences, [0, 1]).all(axis=1)
+    
+    if num_targets is not None:
+        valid &= sequences.sum(axis=1) == num_targets
+    valid &= (sequences[:, :leading_standards] == 0).all(axis=1)
+    
+    for value, max_run in [(1, max_target_run), (0, max_standard_run)]:
+        if max_run is not None:
+            # window sums of length max_run+1 reach max_run+1 only for longer runs
+            hits = (sequences == value).astype(int)
+            window = np.ones(max_run+1, dtype=int)
+            sums = np.array([np.convolve(h, window, 'valid') for h in hits])
+            valid &= ~(sums == max_run+1).any(axis=1) if sums.size else True
+            
+    if min_target_spacing > 0:
+        for n, seq in enumerate(sequences):
+            gaps = np.diff(np.flatnonzero(seq)) - 1
+            valid[n] &= (gaps >= min_target_spacing).all()
+            
+    return bool(valid[0]) if single else valid
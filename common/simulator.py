@@ -0,0 +1,466 @@
+# -*- coding: utf-8 -*-
+"""
+In-process simulator of the lab hardware
+
+Mimics the subset of the hardware interfaces used by the experiment scripts, so
+the trial loops can be run, profiled and load-tested without the MEG/EEG lab:
+- DATAPixx: pypixxlib._libdpx functions (SimulatedDPx)
+- ResponsePixx: pypixxlib.responsepixx.ButtonListener (SimulatedResponsePixx)
+- SoundMexPro: soundmexpro(cmd, cfg) (SimulatedSoundMexPro)
+- Brain Products TriggerBox: serial.Serial (SimulatedSerial)
+
+All interfaces share one SimulatedDevice which models
+- a device clock (host clock with an offset, runs in real time)
+- the register cache of the DATAPixx: register writes (schedules, digital
+  outputs) are collected and only take effect with DPxWriteRegCache or
+  DPxUpdateRegCache, which take a USB round trip (reg_latency). DPxGetTime
+  returns the time latched by the last DPxUpdateRegCache, like the real device.
+- DAC/Dout schedules and the RAM they play from
+- scripted button presses (press_script)
+- the audio stream of SoundMexPro (sample clock, queued data per track)
+- the serial port of the TriggerBox (written bytes are echoed back)
+
+Everything the hardware would output is recorded in device.events (list of
+dicts with device time 'time', host time 'host' and 'type'), e.g. 'dac_start',
+'dout_start', 'dout', 'button', 'audio', 'serial_write'.
+
+Use load_backend('simulator') from hardware_backend.py instead of creating
+the classes directly.
+"""
+
+import threading
+import time
+import numpy as np
+
+#%% Device model
+#------------------------------------------------------------------------------
+
+class SimulatedDevice:
+    """
+    State shared by all simulated interfaces.
+
+    Parameters
+    ----------
+    reg_latency: float
+        round trip time of a register cache read/write in s. The default is
+        0.0004.
+    reg_jitter: float
+        standard deviation of the round trip time in s. The default is 0.0001.
+    ram_size: int
+        size of the DATAPixx RAM in bytes. The default is 2**31.
+    press_script: callable or list or None
+        button presses. A list of (time, button) with device times, or a
+        callable press_script(event) that is called for every 'dac_start' and
+        'audio' event and returns a list of (delay, button) relative to the
+        event. The default is None (no presses).
+    audio_latency: float
+        output latency of SoundMexPro in s (data loaded with loadmem into an
+        empty track starts playing after this time). The default is 0.01.
+    seed: int or None
+        seed of the random latencies. The default is 0.
+    clock: callable
+        host clock in s. The default is time.perf_counter.
+    sleep: callable
+        sleep function used to model latencies. The default is time.sleep.
+    """
+
+    def __init__(self, reg_latency=0.0004, reg_jitter=0.0001, ram_size=2**31,
+                 press_script=None, audio_latency=0.01, seed=0,
+                 clock=time.perf_counter, sleep=time.sleep):
+        self.reg_latency = reg_latency
+        self.reg_jitter = reg_jitter
+        self.ram_size = ram_size
+        self.audio_latency = audio_latency
+        self.rng = np.random.default_rng(seed)
+        self.clock = clock
+        self.sleep = sleep
+        self.t0 = clock()
+        self.lock = threading.RLock()
+        self.events = []
+
+        self.presses = []
+        self.press_script = None
+        if callable(press_script):
+            self.press_script = press_script
+        elif press_script is not None:
+            self.presses = sorted(press_script)
+
+    def now(self):
+        """
+        Device time in s.
+        """
+        return self.clock() - self.t0
+
+    def log(self, event_type, time=None, **fields):
+        event = dict(time=self.now() if time is None else time, host=self.clock(),
+                     type=event_type, **fields)
+        with self.lock:
+            self.events.append(event)
+            if self.press_script is not None and event_type in ['dac_start', 'audio']:
+                for delay, button in self.press_script(event):
+                    self.presses.append((event['time'] + delay, button))
+                self.presses.sort()
+        return event
+
+    def round_trip(self):
+        """
+        Models a USB round trip. Returns the device time at which the
+        registers were written/read (middle of the round trip).
+        """
+        latency = max(self.reg_latency + self.reg_jitter * self.rng.standard_normal(), 0)
+        start = self.now()
+        self.sleep(latency)
+        return start + latency / 2
+
+    def pop_presses(self, until):
+        """
+        Returns and removes all button presses up to device time until.
+        """
+        with self.lock:
+            n = 0
+            while n < len(self.presses) and self.presses[n][0] <= until:
+                n += 1
+            presses, self.presses = self.presses[:n], self.presses[n:]
+        return presses
+
+    def get_events(self, event_type=None):
+        with self.lock:
+            return [event for event in self.events
+                    if event_type is None or event['type'] == event_type]
+
+#%% DATAPixx
+#------------------------------------------------------------------------------
+
+def _arguments(args, kwargs, names, aliases=None, defaults=None):
+    """
+    Maps positional and keyword arguments to names (the scripts use different
+    keyword names for the same pypixxlib arguments).
+    """
+    values = dict(defaults or {})
+    values.update(zip(names, args))
+    for key, value in kwargs.items():
+        values[(aliases or {}).get(key, key)] = value
+    return values
+
+class SimulatedDPx:
+    """
+    Subset of pypixxlib._libdpx.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.ram = {'dac': {}, 'dout': {}}
+        self.pending = []
+        self.time = 0.0
+        self.is_open = False
+        self.dac_schedule = None
+        self.dout_schedule = None
+        self.dac_running = None
+        self.dout_value = 0
+        self.button_schedules = False
+        self.button_schedules_mode = 0
+
+    # Device
+    def DPxOpen(self):
+        self.is_open = True
+        self.device.log('open')
+
+    def DPxClose(self):
+        self.is_open = False
+        self.device.log('close')
+
+    def DPxIsReady(self):
+        return self.is_open
+
+    def DPxGetRamSize(self):
+        return self.device.ram_size
+
+    def DPxEnableDinDebounce(self):
+        pass
+
+    def DPxSetDoutButtonSchedulesMode(self, mode=0):
+        self.button_schedules_mode = mode
+
+    def DPxEnableDoutButtonSchedules(self):
+        self.pending.append(('button_schedules', True))
+
+    # Register cache
+    def _commit(self, latch_time):
+        t = self.device.round_trip()
+        for action, value in self.pending:
+            if action == 'dac_start':
+                self.dac_running = (t, value)
+                self.device.log('dac_start', time=t, **value)
+            elif action == 'dout_start':
+                self.device.log('dout_start', time=t, **value)
+            elif action == 'dout':
+                self.dout_value = value
+                self.device.log('dout', time=t, value=value)
+            elif action == 'stop':
+                self.dac_running = None
+                self.device.log('stop', time=t)
+            elif action == 'button_schedules':
+                self.button_schedules = value
+        self.pending = []
+        if latch_time:
+            self.time = t
+        return t
+
+    def DPxWriteRegCache(self):
+        self._commit(latch_time=False)
+
+    def DPxUpdateRegCache(self):
+        self._commit(latch_time=True)
+
+    def DPxGetTime(self):
+        return self.time
+
+    # RAM
+    def DPxWriteDacBuffer(self, *args, **kwargs):
+        values = _arguments(args, kwargs, ['bufferData', 'bufferAddress', 'channelList'],
+                            defaults={'bufferAddress': 0, 'channelList': None})
+        data = np.asarray(values['bufferData'], dtype=float)
+        nbytes = 2 * data.size
+        self._check_ram(values['bufferAddress'], nbytes)
+        self.ram['dac'][int(values['bufferAddress'])] = data.copy()
+        self.device.round_trip()
+        return int(values['bufferAddress']) + nbytes
+
+    def DPxWriteDoutBuffer(self, *args, **kwargs):
+        values = _arguments(args, kwargs, ['bufferData', 'bufferAddress'],
+                            defaults={'bufferAddress': 8000000})
+        data = np.asarray(values['bufferData'])
+        nbytes = 2 * data.size
+        self._check_ram(values['bufferAddress'], nbytes)
+        self.ram['dout'][int(values['bufferAddress'])] = data.copy()
+        self.device.round_trip()
+        return int(values['bufferAddress']) + nbytes
+
+    def _check_ram(self, address, nbytes):
+        if address < 0 or address + nbytes > self.device.ram_size:
+            raise ValueError(f"Buffer at {address} with {nbytes} bytes exceeds the RAM.")
+
+    # Schedules
+    def DPxSetDacSchedule(self, *args, **kwargs):
+        self.dac_schedule = _arguments(
+            args, kwargs,
+            ['scheduleOnset', 'scheduleRate', 'rateUnits', 'maxScheduleFrames',
+             'channelList', 'bufferBaseAddress', 'numBufferFrames'],
+            aliases={'onSet': 'scheduleOnset', 'rateValue': 'scheduleRate'},
+            defaults={'rateUnits': 'Hz', 'channelList': None, 'bufferBaseAddress': 0,
+                      'numBufferFrames': None})
+
+    def DPxSetDoutSchedule(self, *args, **kwargs):
+        self.dout_schedule = _arguments(
+            args, kwargs,
+            ['scheduleOnset', 'scheduleRate', 'maxScheduleFrames', 'bufferAddress',
+             'numBufferFrames'],
+            aliases={'onSet': 'scheduleOnset', 'rateValue': 'scheduleRate'},
+            defaults={'bufferAddress': 8000000, 'numBufferFrames': None})
+
+    def _schedule_event(self, schedule, address_key):
+        rate = schedule['scheduleRate']
+        frames = schedule['maxScheduleFrames']
+        return dict(address=int(schedule[address_key]), frames=int(frames), rate=rate,
+                    onset=schedule['scheduleOnset'], duration=frames / rate)
+
+    def DPxStartDacSched(self):
+        self.pending.append(('dac_start', self._schedule_event(self.dac_schedule, 'bufferBaseAddress')))
+
+    def DPxStartDoutSched(self):
+        self.pending.append(('dout_start', self._schedule_event(self.dout_schedule, 'bufferAddress')))
+
+    def DPxStopAllScheds(self):
+        self.pending.append(('stop', None))
+
+    def DPxIsDacSchedRunning(self):
+        if self.dac_running is None:
+            return False
+        start, schedule = self.dac_running
+        return self.time < start + schedule['onset'] + schedule['duration']
+
+    def DPxSetDoutValue(self, *args, **kwargs):
+        values = _arguments(args, kwargs, ['bit_value', 'bit_mask'])
+        value = (self.dout_value & ~values['bit_mask']) | (values['bit_value'] & values['bit_mask'])
+        self.pending.append(('dout', int(value)))
+
+    def __getattr__(self, name):
+        raise AttributeError(f"{name} is not implemented in the DATAPixx simulator.")
+
+class SimulatedButtonListener:
+    """
+    Subset of pypixxlib.responsepixx.ButtonListener. Button presses are taken
+    from the press script of the device.
+    """
+
+    def __init__(self, device, dpx, buttonDevice=None):
+        self.device = device
+        self.dpx = dpx
+        self.buttonDevice = buttonDevice
+        self.log = []
+
+    def updateLogs(self):
+        # the DIN log is read with the register cache (time of the last update)
+        for press_time, button in self.device.pop_presses(self.dpx.time):
+            self.log.append((press_time, button))
+            self.device.log('button', time=press_time, button=button)
+            if self.dpx.button_schedules:
+                self.device.log('dout_button_schedule', time=press_time, button=button)
+
+    def getNewButtonActivity(self, buttonSubset=None, recordPushes=True, recordReleases=False):
+        output = [[press_time, button] for press_time, button in self.log
+                  if recordPushes and (buttonSubset is None or button in buttonSubset)]
+        self.log = []
+        return output
+
+class SimulatedResponsePixx:
+    """
+    Subset of pypixxlib.responsepixx.
+    """
+
+    def __init__(self, device, dpx):
+        self.device = device
+        self.dpx = dpx
+
+    def ButtonListener(self, buttonDevice=None):
+        return SimulatedButtonListener(self.device, self.dpx, buttonDevice)
+
+#%% SoundMexPro
+#------------------------------------------------------------------------------
+
+class SimulatedSoundMexPro:
+    """
+    Callable with the interface of soundmexpro(cmd, cfg). The device plays a
+    stream at the sample rate given with 'init'. Data loaded with 'loadmem' is
+    appended to the queue of each track. Returns tuples starting with the
+    success flag (1).
+    """
+
+    def __init__(self, device, command_latency=0.0002):
+        self.device = device
+        self.command_latency = command_latency
+        self.fs = 44100
+        self.n_tracks = 2
+        self.start_time = None
+        self.queue_end = np.zeros(self.n_tracks, dtype=int)
+        self.pending = []
+
+    def position(self, t=None):
+        """
+        Play position in samples at device time t (samples since 'start').
+        """
+        if self.start_time is None:
+            return 0
+        t = self.device.now() if t is None else t
+        return max(int((t - self.start_time) * self.fs), 0)
+
+    def __call__(self, cmd, cfg=None):
+        cfg = cfg or {}
+        self.device.sleep(self.command_latency)
+        if cmd == 'init':
+            self.fs = cfg.get('samplerate', self.fs)
+            self.n_tracks = cfg.get('track', self.n_tracks)
+            self.queue_end = np.zeros(self.n_tracks, dtype=int)
+            self.pending = []
+        elif cmd == 'start':
+            # sample 0 is played after the output latency
+            self.start_time = self.device.now() + self.device.audio_latency
+            self.device.log('audio_start', length=cfg.get('length', 0))
+            for fields in self.pending:
+                self.device.log('audio', time=self.start_time + fields['onset_sample'] / self.fs,
+                                **fields)
+            self.pending = []
+        elif cmd == 'stop' or cmd == 'exit':
+            self.start_time = None
+            self.queue_end = np.zeros(self.n_tracks, dtype=int)
+            self.device.log('audio_' + cmd)
+        elif cmd == 'loadmem':
+            return self._loadmem(cfg)
+        elif cmd == 'playposition':
+            return (1, [self.position()] * self.n_tracks)
+        return (1,)
+
+    def _loadmem(self, cfg):
+        data = np.asarray(cfg['data'])
+        if data.ndim == 1:
+            data = data[:, np.newaxis]
+        tracks = np.atleast_1d(cfg.get('track', np.arange(data.shape[1])))
+        onset = int(self.queue_end[tracks].max())
+        if self.start_time is not None:
+            # data loaded into empty tracks is played after the output latency
+            earliest = int((self.device.now() + self.device.audio_latency
+                            - self.start_time) * self.fs)
+            onset = max(earliest, onset)
+        # data is played loopcount times (0: endless, not simulated)
+        length = data.shape[0] * max(int(cfg.get('loopcount', 1)), 1)
+        self.queue_end[tracks] = onset + length
+        if not data.any():
+            return (1,)
+        # first non-zero value of the last track (trigger track)
+        trigger = data[:, -1]
+        nonzero = np.flatnonzero(trigger)
+        fields = dict(onset_sample=onset, length=length, tracks=tracks.tolist(),
+                      trigger=float(trigger[nonzero[0]]) if nonzero.size else 0.0)
+        if self.start_time is None:
+            self.pending.append(fields)
+        else:
+            self.device.log('audio', time=self.start_time + onset / self.fs, **fields)
+        return (1,)
+
+#%% Serial port (TriggerBox)
+#------------------------------------------------------------------------------
+
+class SimulatedSerial:
+    """
+    Subset of serial.Serial. Written values are echoed back like the
+    TriggerBox does and logged as 'serial_write' events.
+    """
+
+    def __init__(self, device, port=None, baudrate=9600, timeout=None, **kwargs):
+        self.device = device
+        self.port = port
+        self.timeout = timeout
+        self.is_open = True
+        self._buffer = bytearray()
+        self._data = threading.Condition()
+
+    def write(self, data):
+        data = bytes(data)
+        for value in data:
+            self.device.log('serial_write', value=value)
+        with self._data:
+            self._buffer.extend(data)
+            self._data.notify_all()
+        return len(data)
+
+    def inWaiting(self):
+        with self._data:
+            return len(self._buffer)
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def read(self, size=1):
+        with self._data:
+            self._data.wait_for(lambda: len(self._buffer) >= size or not self.is_open,
+                                timeout=self.timeout)
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+    def close(self):
+        with self._data:
+            self.is_open = False
+            self._data.notify_all()
+
+class SimulatedSerialModule:
+    """
+    Stands in for the serial module (serial.Serial(...)).
+    """
+
+    def __init__(self, device):
+        self.device = device
+
+    def Serial(self, *args, **kwargs):
+        return SimulatedSerial(self.device, *args, **kwargs)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+SoundMexPro player: device started once, buffers built once in Python
+
+The device is started once in 'play-zeros-if-no-data-in-tracks' mode
+('start' with length 0) and keeps running for the whole experiment. The
+multi-track buffers of every condition (e.g. standard/target with audio and
+trigger tracks) are built once when the player is created, together with the
+complete 'loadmem' configuration. Every trial still issues a full 'loadmem'
+of its buffer (SoundMexPro copies all samples of the buffer into the queue of
+the tracks), what is saved per trial is:
+- no 'start' per trial, so the ASIO device is never stopped and restarted
+- no stacking/copying of the tracks in Python per trial
+
+The buffers are float64 (double, the format the scripts passed to the 
+wrapper before) and column-major (non-interleaved, one column per track). 
+They are checked once when they are built (check_buffer) and the trial loop 
+passes the exact same arrays, so numpy doesn't copy or allocate anything per 
+trial. check_buffer only checks the numpy layout, conversions inside the 
+SoundMexPro wrapper can't be checked from Python.
+
+SoundMexPro has no command to register named buffers in the device and play
+them later, so the buffers can't be kept resident in the device: the data is
+transferred with 'loadmem' in every trial, only building it in Python is
+avoided.
+
+Queue-ahead mode
+----------------
+Data loaded with 'loadmem' is appended to the data already queued in the
+tracks. queue(condition, silence_frames) loads the stimulus followed by the
+exact jitter as zeros (in samples, a slice of one zero buffer of 
+max_silence_frames allocated when the player is created), so several trials 
+can be queued before they are played and the onsets are set by the sample 
+clock of the sound card.
+The device is started after the first trials are queued, so position() (play
+position in samples since 'start') directly relates to the planned onsets.
+
+Example
+-------
+    player = SoundMexProPlayer(soundmexpro,
+                               {'standard': (sig_standard, sig_standard, trigger_standard),
+                                'target': (sig_target, sig_target, trigger_target)})
+    player.start()
+    ...
+    player.play('target')
+"""
+
+import numpy as np
+
+DTYPE = np.float64
+
+def check_buffer(buffer, dtype=DTYPE):
+    """
+    Raises a ValueError if numpy would copy the buffer to get a column-major
+    array of the given dtype. Conversions inside SoundMexPro are not checked.
+    """
+    if np.asarray(buffer, dtype=dtype, order='F') is not buffer:
+        raise ValueError(f"Buffer needs a copy: dtype {buffer.dtype}, "
+                         f"F-contiguous {buffer.flags.f_contiguous} (expected {np.dtype(dtype)}, True).")
+
+def build_buffer(data, dtype=DTYPE):
+    """
+    Returns a column-major (frames x tracks) buffer of the given dtype. Tracks
+    (sequence of 1D arrays) are written directly into the buffer, without an
+    interleaved float64 intermediate.
+    """
+    if isinstance(data, np.ndarray) and data.ndim == 2:
+        buffer = np.asarray(data, dtype=dtype, order='F')
+    else:
+        buffer = np.empty((len(data[0]), len(data)), dtype=dtype, order='F')
+        for track, samples in enumerate(data):
+            buffer[:, track] = samples
+    check_buffer(buffer, dtype)
+    return buffer
+
+class SoundMexProPlayer:
+    """
+    Parameters
+    ----------
+    soundmexpro: callable
+        soundmexpro function (after 'init', 'trackmap', ...)
+    conditions: dict
+        condition -> sequence of 1D arrays (one per track) or 2D array
+        (frames x tracks)
+    tracks: list or None
+        tracks the buffers are loaded to. The default is None (0..n_tracks-1).
+    name: str or dict
+        name of the data segments shown in the track view, or condition ->
+        name. The default is 'audio + trigger'.
+    show_tracks: bool
+        call 'updatetracks' after loading (ShowAudioTracks). The default is
+        False.
+    dtype: numpy dtype
+        sample format of the buffers. The default is float64.
+    max_silence_frames: int
+        longest silence of queue() in frames (e.g. maximum of the jitter). The
+        default is 0 (no silence).
+    """
+
+    def __init__(self, soundmexpro, conditions, tracks=None, name='audio + trigger',
+                 show_tracks=False, dtype=DTYPE, max_silence_frames=0):
+        self.soundmexpro = soundmexpro
+        self.show_tracks = show_tracks
+        self.dtype = dtype
+        self.buffers = {}
+        self.configs = {}
+        for condition, data in conditions.items():
+            buffer = build_buffer(data, dtype)
+            n_tracks = buffer.shape[1]
+            self.buffers[condition] = buffer
+            self.configs[condition] = {
+                'data': buffer,
+                'track': list(range(n_tracks)) if tracks is None else list(tracks),
+                'loopcount': 1,
+                'name': name[condition] if isinstance(name, dict) else name,
+                }
+        # one zero buffer for the silence in queue-ahead mode, queue() loads a
+        # column-major view of its first silence_frames x n_tracks samples
+        n_tracks = max(len(config['track']) for config in self.configs.values())
+        self.max_silence_frames = int(max_silence_frames)
+        self._zeros = np.zeros(self.max_silence_frames * n_tracks, dtype=dtype)
+        self.silence = {condition: dict(config, name='silence')
+                        for condition, config in self.configs.items()}
+        self.running = False
+
+    def frames(self, condition):
+        """
+        Number of frames of the buffer of a condition.
+        """
+        return self.buffers[condition].shape[0]
+
+    def duration(self, condition, fs):
+        """
+        Duration of the buffer of a condition in s.
+        """
+        return self.buffers[condition].shape[0] / fs
+
+    def start(self):
+        """
+        Starts the device once, zeros are played endlessly until data is
+        loaded.
+        """
+        if not self.running:
+            self.soundmexpro('start', {'length': 0})
+            self.running = True
+
+    def play(self, condition):
+        """
+        Appends the prebuilt buffer of the condition to the tracks. Playback
+        starts immediately if the tracks are empty. This is a full 'loadmem'
+        of the buffer in every call (the samples are copied by SoundMexPro).
+        """
+        self.soundmexpro('loadmem', self.configs[condition])
+        if self.show_tracks:
+            self.soundmexpro('updatetracks')
+
+    def queue(self, condition, silence_frames=0):
+        """
+        Appends the buffer of the condition followed by silence_frames zeros
+        to the queue of the tracks (queue-ahead mode).
+        """
+        if silence_frames > self.max_silence_frames:
+            raise ValueError(f"Silence of {silence_frames} frames is longer than "
+                             f"max_silence_frames ({self.max_silence_frames}).")
+        self.soundmexpro('loadmem', self.configs[condition])
+        if silence_frames > 0:
+            silence = self.silence[condition]
+            n_tracks = len(silence['track'])
+            silence['data'] = self._zeros[:silence_frames*n_tracks].reshape(
+                (silence_frames, n_tracks), order='F')
+            self.soundmexpro('loadmem', silence)
+        if self.show_tracks:
+            self.soundmexpro('updatetracks')
+
+    def position(self):
+        """
+        Play position of the device in samples since 'start' (first track).
+        """
+        return int(np.atleast_1d(self.soundmexpro('playposition')[1])[0])
+
+    def exit(self):
+        self.soundmexpro('exit')
+        self.running = False
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Precompiled stimulus bank for the double tones of the oddball paradigm
+
+Instead of reading the WAV files and building the double tones and trigger
+tracks at the start of every run, the final float32 arrays are built once and
+stored in a single binary file next to the stimuli (stimuli/bank/). A JSON
+manifest stores the parameters (fs, sha256 of the WAV files, GapSize, TrigLen,
+trigger values) and the offsets of the arrays. Later runs map the file into
+memory (np.memmap, read-only) without copying, as long as the manifest matches.
+The bank is rebuilt automatically if a WAV file or a parameter changes.
+
+Signals in the bank
+-------------------
+- sig_target, sig_standard: double tones (channel of the WAV files, gap of
+  GapSize s between the tones)
+- trigger_target, trigger_standard (only with trigger_values): trigger tracks
+  with the trigger value during the first TrigLen s of each tone
+
+Example
+-------
+    bank, fs = load_stimulus_bank('stimuli', 'clarinet', GapSize=0.1,
+                                  TrigLen=0.1, trigger_values={'standard': [5,5],
+                                                               'target': [5,5]})
+    sig_target = bank['sig_target']
+"""
+
+import os
+import os.path as op
+import json
+import hashlib
+import numpy as np
+import soundfile as sf
+
+# WAV files of the two instruments (first and second tone)
+INSTRUMENTS = {'clarinet': ['clarinet_new.wav', 'clarinet_new_short.wav'],
+               'oboe': ['oboe_new.wav', 'oboe_new_short.wav']}
+
+BANK_VERSION = 1
+DTYPE = np.float32
+
+#%% Helper functions
+#------------------------------------------------------------------------------
+
+def _file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _build_signals(stimuli_dir, target, standard, GapSize, TrigLen, trigger_values, channel):
+    """
+    Builds the double tones and trigger tracks (same steps as in the
+    experiment scripts before).
+    """
+    signals = {}
+    fs = None
+    for label, instrument in [('target', target), ('standard', standard)]:
+        tones = []
+        for fname in INSTRUMENTS[instrument]:
+            sig, fs_wav = sf.read(op.join(stimuli_dir, fname), dtype='float64')
+            if fs is not None and fs_wav != fs:
+                raise ValueError('All stimuli must have the same sampling rate.')
+            fs = fs_wav
+            # In case of stereo signals, take the given column
+            tones.append(sig[:, channel] if sig.ndim > 1 else sig)
+
+        gap = np.zeros(int(GapSize*fs))
+        signals['sig_' + label] = np.concatenate((tones[0], gap, tones[1]))
+
+        if trigger_values is not None:
+            TrigLen_samp = int(TrigLen*fs)
+            triggers = []
+            for tone, value in zip(tones, trigger_values[label]):
+                trigger = np.zeros(len(tone))
+                trigger[0:TrigLen_samp] = value
+                triggers.append(trigger)
+            signals['trigger_' + label] = np.concatenate((triggers[0], gap, triggers[1]))
+
+    return signals, int(fs)
+
+#%% Public functions
+#------------------------------------------------------------------------------
+
+def load_stimulus_bank(stimuli_dir, target, GapSize, TrigLen=0.1, trigger_values=None,
+                       channel=1, bank_dir=None):
+    """
+    Loads the stimulus bank, it is built first if it doesn't exist or doesn't
+    match the WAV files and parameters.
+
+    Parameters
+    ----------
+    stimuli_dir: str
+        folder with the WAV files
+    target: str
+        'clarinet' or 'oboe', the other instrument is the standard
+    GapSize: float
+        gap between the two tones in s
+    TrigLen: float
+        length of the triggers in s. The default is 0.1.
+    trigger_values: dict or None
+        {'standard': [value1, value2], 'target': [value1, value2]} sample values
+        of the trigger tracks at the onsets of the two tones (e.g. 5 V for the
+        DATAPixx, trigger words for SPDIF). The default is None (no trigger
+        tracks).
+    channel: int
+        channel of the WAV files. The default is 1.
+    bank_dir: str or None
+        folder of the bank files. The default is None (stimuli_dir/bank).
+
+    Returns
+    -------
+    bank: dict of read-only float32 np.memmap
+    fs: int
+        sampling rate
+    """
+    if target not in INSTRUMENTS:
+        raise ValueError(f"target must be one of {list(INSTRUMENTS)}.")
+    standard = [instrument for instrument in INSTRUMENTS if instrument != target][0]
+    if bank_dir is None:
+        bank_dir = op.join(stimuli_dir, 'bank')
+
+    wav_fnames = INSTRUMENTS[target] + INSTRUMENTS[standard]
+    params = {'version': BANK_VERSION,
+              'dtype': np.dtype(DTYPE).str,
+              'target': target,
+              'GapSize': GapSize,
+              'TrigLen': TrigLen,
+              'trigger_values': None if trigger_values is None else
+                                {label: [float(value) for value in values]
+                                 for label, values in trigger_values.items()},
+              'channel': channel,
+              'wav_hashes': {fname: _file_hash(op.join(stimuli_dir, fname))
+                             for fname in wav_fnames},
+              }
+    key = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    bank_fname = op.join(bank_dir, 'bank_' + key + '.bin')
+    manifest_fname = op.join(bank_dir, 'bank_' + key + '.json')
+
+    manifest = None
+    if op.isfile(manifest_fname) and op.isfile(bank_fname):
+        with open(manifest_fname) as json_file:
+            manifest = json.load(json_file)
+        if manifest.get('params') != params:
+            manifest = None
+
+    if manifest is None:
+        manifest = build_stimulus_bank(stimuli_dir, target, standard, GapSize, TrigLen,
+                                       trigger_values, channel, bank_fname, manifest_fname,
+                                       params)
+
+    bank = {}
+    for name, entry in manifest['signals'].items():
+        bank[name] = np.memmap(bank_fname, dtype=manifest['params']['dtype'], mode='r',
+                               offset=entry['offset'], shape=(entry['length'],))
+    return bank, manifest['fs']
+
+def build_stimulus_bank(stimuli_dir, target, standard, GapSize, TrigLen, trigger_values,
+                        channel, bank_fname, manifest_fname, params):
+    """
+    Builds the signals and writes the bank file and manifest. The manifest is
+    written last, so an interrupted build is never used.
+
+    Returns
+    -------
+    manifest: dict
+    """
+    signals, fs = _build_signals(stimuli_dir, target, standard, GapSize, TrigLen,
+                                 trigger_values, channel)
+    os.makedirs(op.dirname(bank_fname), exist_ok=True)
+
+    manifest = {'params': params, 'fs': fs, 'signals': {}}
+    offset = 0
+    with open(bank_fname, 'wb') as f:
+        for name, signal in signals.items():
+            data = signal.astype(DTYPE)
+            f.write(data.tobytes())
+            manifest['signals'][name] = {'offset': offset, 'length': len(data)}
+            offset += data.nbytes
+
+    with open(manifest_fname, 'w') as json_file:
+        json.dump(manifest, json_file, indent=4)
+    return manifest
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+"""
+Stimulus-onset timing benchmark of the trial loops
+
+Runs the trial loops of the experiment scripts for N trials against the
+simulated hardware (hardware_backend.load_backend('simulator'), fixed seed)
+and reports the distributions (mean, p95, p99, max) of
+- onset error: actual stimulus onset (device clock) minus the intended onset
+  (startTime + TrialDur of the previous trial). For SoundMexPro it includes
+  the output latency of the device (audio_latency of the simulator).
+- ISI error: onset-to-onset interval minus the planned interval (stimulus
+  duration + jitterlist)
+- pulse width error: duration of the trigger pulse minus TrigLen (only for
+  triggers switched by the host)
+- CPU time per trial of the host
+
+Loops
+-----
+- oddball_datapixx: Oddball_datapixx_v2.py (DAC schedule per trial, trigger
+  off after TrigLen, button log read by the ResponseAcquisition thread).
+  Oddball_datapixx_v1.py starts its trials with the same function.
+- oddball_soundmexpro: Oddball_soundmexpro.py (prebuilt buffer loaded per
+  trial into the running device, button log read by the ResponseAcquisition
+  thread)
+- oddball_soundmexpro_queue: Oddball_soundmexpro.py in queue-ahead mode
+  (stimulus + jitter queued 3 trials ahead, onsets set by the sample clock)
+- oddball_eeg_triggerbox: Oddball_eeg_triggerbox.py (as oddball_soundmexpro,
+  onsets on the host clock, no DATAPixx)
+- oddball_brainproducts: Oddball_brainproducts_triggerbox.py (prebuilt buffer
+  per trial, trigger pulse of PulseWidth by the TriggerScheduler)
+- aef: AEF_exp_v2.py with single_schedule = True (default, whole click train
+  in one DAC and Dout schedule). The onsets are the rising edges of the
+  trigger track in the simulated RAM, timed by the start of the schedule.
+  The CPU time of the monitoring loop is divided equally among the trials.
+- aef_trial_by_trial: AEF_exp_v2.py with single_schedule = False (DAC and
+  Dout schedule per trial, 1 ms polling loop)
+
+The loops call the trial loops of the scripts (common/trial_loops.py) and 
+leave out window, keyboard and logging. Stimulus and jitter durations can be 
+scaled down (time_scale) for quick runs, the overhead per trial doesn't depend
+on them.
+
+Usage
+-----
+    python timing_benchmark.py --trials 100 --time-scale 0.2
+    python timing_benchmark.py --loops aef --max-onset-error-ms 2
+"""
+
+import argparse
+import sys
+import time
+import numpy as np
+from functools import partial
+
+from hardware_backend import load_backend
+from trial_runner import TrialRunner
+from soundmexpro_player import SoundMexProPlayer
+from trial_plan import compile_trial_plan
+from response_acquisition import ResponseAcquisition
+from triggerbox import TriggerScheduler
+from trial_loops import (run_trials, start_datapixx_trial, reset_trigger,
+                         start_soundmexpro_trial, start_triggerbox_trial, click_train_onsets, write_click_train,
+                         start_click_train, monitor_click_train, start_click_trial,
+                         wait_click_trial)
+
+LOOPS = ['oddball_datapixx', 'oddball_soundmexpro', 'oddball_soundmexpro_queue',
+         'oddball_eeg_triggerbox', 'oddball_brainproducts', 'aef',
+         'aef_trial_by_trial']
+
+#%% Trial loops
+#------------------------------------------------------------------------------
+
+def _jitterlist(rng, n_trials, jitter_interval, time_scale):
+    jitterlist = jitter_interval[0] + (jitter_interval[1]-jitter_interval[0])*rng.uniform(size=n_trials)
+    return (jitterlist * time_scale).round(decimals=3)
+
+class _TrialTimes:
+    """
+    Start time, trial duration and CPU time of every trial (callbacks of
+    run_trials).
+    """
+
+    def __init__(self):
+        self.start_time, self.trial_dur, self.cpu_time = [], [], []
+        self._cpu = None
+
+    def before(self, trial):
+        self._cpu = time.process_time()
+
+    def started(self, trial, startTime, TrialDur):
+        self.start_time.append(startTime)
+        self.trial_dur.append(TrialDur)
+
+    def finished(self, trial, aborted):
+        self.cpu_time.append(time.process_time() - self._cpu)
+
+    def to_dict(self, **extra):
+        return dict(start_time=np.array(self.start_time), trial_dur=np.array(self.trial_dur),
+                    cpu_time=np.array(self.cpu_time), **extra)
+
+def _response_poll(acquisition):
+    """
+    Poll of the oddball scripts: new button events are read when the counter
+    of the acquisition has changed.
+    """
+    state = {'index': 0}
+
+    def before(trial):
+        state['index'] = acquisition.count
+
+    def poll(passedTime):
+        if acquisition.count > state['index']:
+            times, buttons = acquisition.get(state['index'])
+            state['index'] += len(times)
+        return False
+
+    return before, poll
+
+def run_oddball_datapixx(backend, n_trials, time_scale=1.0, seed=0, fs=44100,
+                         stim_frames=57329, jitter_interval=(0.5, 0.9), TrigLen=0.1,
+                         poll_interval=0.01):
+    """
+    Trial loop of Oddball_datapixx_v2.py (preloaded bank).
+
+    Returns
+    -------
+    trials: dict of arrays (start_time, trial_dur, cpu_time)
+    """
+    dp, rp = backend.dp, backend.rp
+    rng = np.random.default_rng(seed)
+    playmatrix = (rng.uniform(size=n_trials) < 0.3).astype(int)
+    jitterlist = _jitterlist(rng, n_trials, jitter_interval, time_scale)
+    numBufferFrames = max(int(stim_frames * time_scale), 1)
+    TrigLen = TrigLen * time_scale
+    channel = [1, 2]
+    bankAddresses = {'standard': int(0), 'target': int(4e6)}
+    trialtypes = {'standard': 0, 'target': 1}
+
+    dp.DPxOpen()
+    for address in bankAddresses.values():
+        dp.DPxWriteDacBuffer(bufferData=np.zeros((2, numBufferFrames)),
+                             bufferAddress=address, channelList=channel)
+    dp.DPxWriteRegCache()
+    plan = compile_trial_plan(playmatrix, jitterlist, fs, trialtypes, frames=numBufferFrames,
+                              addresses=bankAddresses, triggers={'standard': 1, 'target': 2},
+                              response_types=['target'])
+    acquisition = ResponseAcquisition(dp, rp.ButtonListener('mri 10 button'))
+    runner = TrialRunner(poll_interval=poll_interval)
+    trial_times = _TrialTimes()
+    reset_response, poll_trial = _response_poll(acquisition)
+
+    def before(trial):
+        trial_times.before(trial)
+        reset_response(trial)
+
+    def start_trial(trial):
+        startTime, hostOnset = start_datapixx_trial(dp, plan[trial], fs, channel,
+                                                    acquisition.lock, clock=runner.clock)
+        return startTime, plan[trial].trial_dur, hostOnset
+
+    acquisition.start()
+    run_trials(n_trials, start_trial, runner,
+               events=[(TrigLen, lambda: reset_trigger(dp, acquisition.lock))],
+               poll=poll_trial, before=before, started=trial_times.started,
+               finished=trial_times.finished)
+
+    acquisition.stop()
+    dp.DPxStopAllScheds()
+    dp.DPxWriteRegCache()
+    dp.DPxClose()
+    return trial_times.to_dict(TrigLen=TrigLen)
+
+def run_oddball_soundmexpro(backend, n_trials, time_scale=1.0, seed=0, fs=44100,
+                            stim_frames=57329, jitter_interval=(0.5, 0.9),
+                            poll_interval=0.01, queue_ahead=0, datapixx=True):
+    """
+    Trial loop of Oddball_soundmexpro.py (queue_ahead: QueueAhead). Without 
+    DATAPixx (datapixx=False) the loop of Oddball_eeg_triggerbox.py: onsets on
+    the host clock, no button log.
+    """
+    soundmexpro = backend.soundmexpro
+    rng = np.random.default_rng(seed)
+    playmatrix = (rng.uniform(size=n_trials) < 0.3).astype(int)
+    jitterlist = _jitterlist(rng, n_trials, jitter_interval, time_scale)
+    n_frames = max(int(stim_frames * time_scale), 1)
+    audio = np.zeros(n_frames)
+    triggers = [np.zeros(n_frames), np.zeros(n_frames)]
+    for value, trigger in zip([1, 2], triggers):
+        trigger[:int(0.1*fs*time_scale)+1] = value / 2**16
+
+    if datapixx:
+        dp = backend.dp
+        dp.DPxOpen()
+        acquisition = ResponseAcquisition(dp, backend.rp.ButtonListener('mri 10 button'))
+        lock = acquisition.lock
+        # host onsets are only used by the runner
+        runner = TrialRunner(poll_interval=poll_interval)
+        reset_response, poll_trial = _response_poll(acquisition)
+    else:
+        dp, acquisition, lock, poll_trial = None, None, None, None
+        reset_response = lambda trial: None
+        # host clock = device clock, so the onsets can be compared
+        runner = TrialRunner(poll_interval=poll_interval, clock=backend.device.now)
+    soundmexpro('init', {'samplerate': fs, 'track': 3})
+    player = SoundMexProPlayer(soundmexpro, {'standard': (audio, audio, triggers[0]),
+                                             'target': (audio, audio, triggers[1])},
+                               max_silence_frames=int(np.ceil(jitterlist.max()*fs)))
+    plan = compile_trial_plan(playmatrix, jitterlist, fs, {'standard': 0, 'target': 1},
+                              frames=n_frames, response_types=['target'])
+    if queue_ahead:
+        for k in range(min(queue_ahead, n_trials)):
+            player.queue(plan[k].label, plan[k].silence)
+    player.start()
+    trial_times = _TrialTimes()
+
+    def before(trial):
+        trial_times.before(trial)
+        reset_response(trial)
+
+    def start_trial(trial):
+        startTime, TrialDur, hostOnset, position = start_soundmexpro_trial(
+            player, plan, trial, dp, lock, queue_ahead, clock=runner.clock)
+        return startTime, TrialDur, hostOnset
+
+    if datapixx:
+        acquisition.start()
+    run_trials(n_trials, start_trial, runner, poll=poll_trial, before=before,
+               started=trial_times.started, finished=trial_times.finished)
+
+    player.exit()
+    if datapixx:
+        acquisition.stop()
+        dp.DPxClose()
+    return trial_times.to_dict(TrigLen=None)
+
+def run_oddball_brainproducts(backend, n_trials, time_scale=1.0, seed=0, fs=44100,
+                              stim_frames=57329, jitter_interval=(0.5, 0.9), PulseWidth=0.01,
+                              poll_interval=0.01):
+    """
+    Trial loop of Oddball_brainproducts_triggerbox.py (audio with SoundMexPro,
+    trigger pulses by the TriggerScheduler on the serial port). Host clock = 
+    device clock, so the onsets can be compared.
+    """
+    soundmexpro = backend.soundmexpro
+    rng = np.random.default_rng(seed)
+    playmatrix = (rng.uniform(size=n_trials) < 0.3).astype(int)
+    jitterlist = _jitterlist(rng, n_trials, jitter_interval, time_scale)
+    n_frames = max(int(stim_frames * time_scale), 1)
+    # not silent, the simulator only records non-zero audio
+    audio = np.full(n_frames, 1e-3)
+
+    soundmexpro('init', {'samplerate': fs, 'track': 2})
+    player = SoundMexProPlayer(soundmexpro, {'standard': (audio, audio),
+                                             'target': (audio, audio)})
+    triggers = TriggerScheduler(backend.serial.Serial('COM6'), pulse_width=PulseWidth,
+                                clock=backend.device.now)
+    runner = TrialRunner(poll_interval=poll_interval, clock=backend.device.now)
+    plan = compile_trial_plan(playmatrix, jitterlist, fs, {'standard': 0, 'target': 1},
+                              frames=n_frames, triggers={'standard': 1, 'target': 2},
+                              response_types=['target'])
+    player.start()
+    triggers.start()
+    trial_times = _TrialTimes()
+
+    def start_trial(trial):
+        onset = start_triggerbox_trial(player, plan[trial], triggers, clock=runner.clock)
+        return onset, plan[trial].trial_dur, onset
+
+    run_trials(n_trials, start_trial, runner, before=trial_times.before,
+               started=trial_times.started, finished=trial_times.finished)
+
+    triggers.close()
+    player.exit()
+    return trial_times.to_dict(TrigLen=PulseWidth, trigger_event='serial_write')
+
+def _click(fs, Nsamples, time_scale):
+    """
+    Silent click and trigger of AEF_exp_v2.py (100 ms trigger).
+    """
+    Nsamples = max(int(Nsamples * time_scale), 1)
+    audio_data = np.zeros((2, Nsamples))
+    trigger = np.zeros(Nsamples, dtype=int)
+    trigger[0:max(round(0.1*fs*time_scale), 1)] = 1
+    return audio_data, trigger
+
+def _spin_wait(duration):
+    """
+    core.wait spins for waits shorter than hogCPUperiod.
+    """
+    wait_until = time.perf_counter() + duration
+    while time.perf_counter() < wait_until:
+        pass
+
+def run_aef(backend, n_trials, time_scale=1.0, seed=0, fs=48000, Nsamples=24000,
+            jitter_interval=(1, 1.2), ChunkFrames=2**20):
+    """
+    Single schedule of AEF_exp_v2.py (whole click train in the DATAPixx RAM,
+    progress monitored every 100 ms).
+    """
+    dp = backend.dp
+    rng = np.random.default_rng(seed)
+    jitterlist = _jitterlist(rng, n_trials, jitter_interval, time_scale)
+    audio_data, trigger = _click(fs, Nsamples, time_scale)
+    channel = [0, 1]
+
+    dp.DPxOpen()
+    onsets, TotalFrames = click_train_onsets(jitterlist, fs, audio_data.shape[1])
+    DacAddress, DoutAddress = write_click_train(dp, onsets, TotalFrames, audio_data, trigger,
+                                                channel, ChunkFrames)
+    cpu = time.process_time()
+    startTime = start_click_train(dp, fs, channel, TotalFrames, DacAddress, DoutAddress)
+    monitor_click_train(dp, startTime, onsets / fs, wait=time.sleep,
+                        interval=0.1 * time_scale)
+    cpu_time = np.full(n_trials, (time.process_time() - cpu) / n_trials)
+
+    dp.DPxStopAllScheds()
+    dp.DPxWriteRegCache()
+    dp.DPxClose()
+    isi = np.diff(np.append(onsets, TotalFrames)) / fs
+    return dict(start_time=startTime + onsets / fs, trial_dur=isi, cpu_time=cpu_time,
+                TrigLen=None, onsets=get_schedule_onsets(backend, DoutAddress, TotalFrames))
+
+def run_aef_trial_by_trial(backend, n_trials, time_scale=1.0, seed=0, fs=48000,
+                           Nsamples=24000, jitter_interval=(1, 1.2)):
+    """
+    Trial by trial loop of AEF_exp_v2.py (1 ms polling, core.wait(0.001) spins).
+    """
+    dp = backend.dp
+    rng = np.random.default_rng(seed)
+    jitterlist = _jitterlist(rng, n_trials, jitter_interval, time_scale)
+    audio_data, trigger = _click(fs, Nsamples, time_scale)
+    Nsamples = audio_data.shape[1]
+    channel = [0, 1]
+
+    dp.DPxOpen()
+    dp.DPxWriteDacBuffer(bufferData=audio_data, bufferAddress=int(0), channelList=channel)
+    dp.DPxWriteDoutBuffer(bufferData=trigger, bufferAddress=int(8e6))
+    dp.DPxWriteRegCache()
+
+    start_time, cpu_time = [], []
+    for trial in range(n_trials):
+        cpu = time.process_time()
+        startTime = start_click_trial(dp, fs, channel, Nsamples, DacAddress=int(0),
+                                      DoutAddress=int(8e6))
+        wait_click_trial(dp, startTime, jitterlist[trial], wait=_spin_wait, interval=0.001)
+        start_time.append(startTime)
+        cpu_time.append(time.process_time() - cpu)
+
+    dp.DPxStopAllScheds()
+    dp.DPxWriteRegCache()
+    dp.DPxClose()
+    return dict(start_time=np.array(start_time), trial_dur=np.array(jitterlist),
+                cpu_time=np.array(cpu_time), TrigLen=None)
+
+#%% Evaluation
+#------------------------------------------------------------------------------
+
+def get_onsets(device):
+    """
+    Stimulus onsets on the device clock (DAC schedule starts or audio data).
+    """
+    events = device.get_events('dac_start') or device.get_events('audio')
+    return np.array([event['time'] for event in events])
+
+def get_schedule_onsets(backend, DoutAddress, TotalFrames):
+    """
+    Onsets of a single Dout schedule on the device clock: rising edges of the
+    trigger track in the simulated RAM, timed by the start of the schedule.
+    """
+    chunks = sorted((address, data) for address, data in backend.dp.ram['dout'].items()
+                    if DoutAddress <= address < DoutAddress + 2*TotalFrames)
+    track = np.concatenate([data for address, data in chunks])[:TotalFrames]
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], track != 0)).astype(int)) == 1)
+    schedule = backend.device.get_events('dout_start')[-1]
+    return schedule['time'] + schedule['onset'] + edges / schedule['rate']
+
+def get_pulse_widths(device, event_type='dout'):
+    """
+    Durations of the trigger pulses switched with DPxSetDoutValue ('dout') or
+    written to the TriggerBox ('serial_write').
+    """
+    events = device.get_events(event_type)
+    widths = []
+    for on, off in zip(events[:-1], events[1:]):
+        if on['value'] != 0 and off['value'] == 0:
+            widths.append(off['time'] - on['time'])
+    return np.array(widths)
+
+def evaluate(device, trials):
+    """
+    Returns the timing errors and CPU times in s.
+    """
+    onsets = trials['onsets'] if 'onsets' in trials else get_onsets(device)
+    intended = trials['start_time'][:-1] + trials['trial_dur'][:-1]
+    results = {'onset error': onsets[1:] - intended,
+               'ISI error': np.diff(onsets) - trials.get('isi', trials['trial_dur'])[:-1],
+               'CPU time per trial': trials['cpu_time']}
+    if trials['TrigLen'] is not None:
+        widths = get_pulse_widths(device, trials.get('trigger_event', 'dout'))
+        results['pulse width error'] = widths - trials['TrigLen']
+    return results
+
+def summarize(values):
+    """
+    Returns mean, p95, p99 and max in ms.
+    """
+    values = np.asarray(values) * 1000
+    if values.size == 0:
+        return dict(mean=np.nan, p95=np.nan, p99=np.nan, max=np.nan)
+    return dict(mean=values.mean(), p95=np.percentile(values, 95),
+                p99=np.percentile(values, 99), max=values.max())
+
+def run_benchmark(loop, n_trials=100, time_scale=1.0, seed=0, **device_options):
+    """
+    Runs one trial loop against a fresh simulated device.
+
+    Returns
+    -------
+    summary: dict of dicts (metric -> statistics in ms)
+    """
+    backend = load_backend('simulator', seed=seed, **device_options)
+    run = {'oddball_datapixx': run_oddball_datapixx,
+           'oddball_soundmexpro': run_oddball_soundmexpro,
+           'oddball_soundmexpro_queue': partial(run_oddball_soundmexpro, queue_ahead=3),
+           'oddball_eeg_triggerbox': partial(run_oddball_soundmexpro, datapixx=False),
+           'oddball_brainproducts': run_oddball_brainproducts,
+           'aef': run_aef,
+           'aef_trial_by_trial': run_aef_trial_by_trial}[loop]
+    trials = run(backend, n_trials, time_scale=time_scale, seed=seed)
+    return {metric: summarize(values)
+            for metric, values in evaluate(backend.device, trials).items()}
+
+def print_summary(loop, summary):
+    print(f"\n{loop}")
+    print(f"{'metric [ms]':<22}{'mean':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for metric, stats in summary.items():
+        print(f"{metric:<22}" + ''.join(f"{stats[key]:>10.3f}" for key in ['mean', 'p95', 'p99', 'max']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--loops', nargs='+', choices=LOOPS, default=LOOPS)
+    parser.add_argument('--trials', type=int, default=100)
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                        help='factor for stimulus and jitter durations')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reg-latency', type=float, default=0.0004,
+                        help='USB round trip of the register cache in s')
+    parser.add_argument('--max-onset-error-ms', type=float, default=None,
+                        help='fail (exit code 1) if the p99 onset error exceeds this value')
+    args = parser.parse_args(argv)
+
+    failed = False
+    for loop in args.loops:
+        summary = run_benchmark(loop, args.trials, args.time_scale, args.seed,
+                                reg_latency=args.reg_latency)
+        print_summary(loop, summary)
+        if (args.max_onset_error_ms is not None
+                and summary['onset error']['p99'] > args.max_onset_error_ms):
+            print(f"p99 onset error exceeds {args.max_onset_error_ms} ms!")
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
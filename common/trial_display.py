@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Trial info display with a render worker
+
+With trialinfo = True the oddball scripts used to call
+textStimulusTrial.setText(...) and win.flip() at the start of each trial and
+after a response. setText lays out the text and win.flip() waits for the next
+vertical retrace (up to one frame, ~16 ms), both right where triggers and
+responses have to be handled.
+
+The TrialDisplay owns the window, the fixation cross and the trial info text:
+- threaded=True (render worker): window and text stimuli are created and
+  drawn by a worker thread with its own loop. show() only posts the new state
+  (non-blocking), the worker draws the latest state and flips. All OpenGL
+  calls stay on the worker thread.
+- threaded=False: the same calls are executed directly (previous behavior,
+  e.g. on macOS, where windows have to be created on the main thread).
+
+prepare() lays out one text stimulus per trial before the first trial, so the
+trial start only selects a prepared stimulus. Texts with a reaction time are
+laid out by the worker when they are shown.
+
+Example
+-------
+    display = TrialDisplay(window=dict(units='height'), cross=dict(text='+', height=0.15),
+                           info=dict(pos=(0, -0.1), height=0.03))
+    display.start()
+    display.prepare(['1 / 160', '2 / 160', ...])
+    ...
+    display.show(trial)                 # prepared text of the trial
+    display.show(text='Reaction time')  # any text
+    ...
+    display.close()
+"""
+
+import queue
+import threading
+
+#%% Trial display
+#------------------------------------------------------------------------------
+
+class TrialDisplay:
+    """
+    Window with fixation cross and trial info.
+
+    Parameters
+    ----------
+    window: dict
+        keyword arguments of psychopy.visual.Window
+    cross: dict
+        keyword arguments of the TextStim of the fixation cross
+    info: dict
+        keyword arguments of the TextStim of the trial info
+    threaded: bool
+        render worker (True) or drawing in the calling thread (False). The
+        default is True.
+    """
+
+    def __init__(self, window, cross, info, threaded=True):
+        self.window = window
+        self.cross = cross
+        self.info = info
+        self.threaded = threaded
+        self.win = None
+        self._texts = []
+        self._current = None
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+
+    def start(self):
+        """
+        Opens the window and shows the fixation cross (returns when the window
+        is open).
+        """
+        if not self.threaded:
+            self._open()
+            self._draw()
+            return
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name='TrialDisplay',
+                                        daemon=True)
+        self._thread.start()
+        ready.wait()
+        if self.win is None:
+            raise RuntimeError('The window of the render worker could not be opened.')
+
+    def prepare(self, texts):
+        """
+        Lays out the trial info of every trial (returns when done).
+        """
+        if not self.threaded:
+            self._handle('prepare', list(texts))
+            return
+        done = threading.Event()
+        self._queue.put(('prepare', list(texts), done))
+        done.wait()
+
+    def show(self, trial=None, text=None):
+        """
+        Shows the prepared text of a trial or a text (non-blocking with the
+        render worker).
+        """
+        action, value = ('trial', trial) if text is None else ('text', text)
+        if self.threaded:
+            self._queue.put((action, value, None))
+        else:
+            self._handle(action, value)
+            self._draw()
+
+    def close(self):
+        if not self.threaded:
+            self.win.close()
+            return
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _open(self):
+        from psychopy import visual
+        win = visual.Window(**self.window)
+        self._cross = visual.TextStim(win=win, **self.cross)
+        self._info = visual.TextStim(win=win, **self.info)
+        self.win = win
+
+    def _handle(self, action, value):
+        if action == 'prepare':
+            from psychopy import visual
+            # one stimulus per trial, the layout is done on creation
+            self._texts = [visual.TextStim(win=self.win, **dict(self.info, text=text))
+                           for text in value]
+        elif action == 'trial':
+            self._current = self._texts[value]
+        elif action == 'text':
+            self._info.setText(value)
+            self._current = self._info
+
+    def _draw(self):
+        self._cross.draw()
+        if self._current is not None:
+            self._current.draw()
+        self.win.flip()
+
+    def _run(self, ready):
+        try:
+            self._open()
+            self._draw()
+        finally:
+            ready.set()
+        closing = False
+        while not closing:
+            messages = [self._queue.get()]
+            # only the latest state is drawn
+            while True:
+                try:
+                    messages.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for message in messages:
+                if message is None:
+                    closing = True
+                    continue
+                action, value, done = message
+                self._handle(action, value)
+                if done is not None:
+                    done.set()
+            self._draw()
+        self.win.close()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Crash-safe streaming trial log
+
+The oddball scripts used to keep playmatrix, jitterlist and the reaction
+times in memory and write the results JSON after the last trial, so an abort
+or a crash lost the behavioral data of the whole run. The TrialLog is an
+append-only JSON Lines file (one record per line):
+- 'run': sequence of the run (playmatrix, triallabel, jitterlist, ...)
+- 'trial': per trial label, trigger value (trigger of the trial plan, same in
+  every script), planned and actual onset, duration
+- 'response': reaction time, button and device timestamp of a response
+- 'buttons': complete button record of the run (DATAPixx scripts)
+Every record gets the host time 'time' (time.perf_counter) of the write call.
+numpy scalars and arrays are converted to numbers and lists, other values that
+JSON can't represent are written as their repr. A record that still can't be
+written is replaced by an 'error' record (event of the record and the error)
+and reported on stderr, the writer thread keeps running.
+
+write() only puts the record into a queue. A writer thread collects the
+records, appends them to the file and calls fsync once per batch, at least
+every latency seconds. The trial loop is never blocked by disk I/O and at most
+the last latency seconds are lost in a crash. The log is also closed when the
+interpreter exits (sys.exit, unhandled exception).
+
+finalize_trial_log assembles the summary JSON of the scripts (playmatrix,
+triallabel, jitterlist, reaction times) from the log. It can also be run on
+the log of an aborted run:
+    python trial_log.py results/sub-01task-oddball_1_trials.jsonl
+"""
+
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+#%% Trial log
+#------------------------------------------------------------------------------
+
+def _to_json(value):
+    """
+    Converts values that json.dumps can't serialize (numpy scalars and arrays,
+    other objects as repr).
+    """
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return repr(value)
+
+class TrialLog:
+    """
+    Append-only JSON Lines log written by a background thread.
+
+    Parameters
+    ----------
+    fname: str
+        path of the log (.jsonl), records are appended to an existing file
+        (a repeated run starts with a new 'run' record)
+    latency: float
+        maximum time between write() and fsync in s. The default is 0.5.
+    clock: callable
+        host clock in s. The default is time.perf_counter.
+
+    Attributes
+    ----------
+    errors: int
+        number of records that couldn't be written
+    """
+
+    def __init__(self, fname, latency=0.5, clock=time.perf_counter):
+        self.fname = fname
+        self.latency = latency
+        self.clock = clock
+        self.errors = 0
+        self._queue = queue.SimpleQueue()
+        self._file = open(fname, 'a', encoding='utf-8')
+        if self._file.tell() > 0:
+            # an incomplete last line of a crashed run stays on its own line
+            self._file.write('\n')
+        self._thread = threading.Thread(target=self._run, name='TrialLog', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, event, **fields):
+        """
+        Appends a record {'event': event, 'time': host time, **fields}
+        (non-blocking).
+        """
+        self._queue.put(dict(event=event, time=self.clock(), **fields))
+
+    def close(self):
+        """
+        Writes the pending records and closes the file.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+        atexit.unregister(self.close)
+
+    def _run(self):
+        closing = False
+        while not closing:
+            try:
+                batch = [self._queue.get(timeout=self.latency)]
+            except queue.Empty:
+                continue
+            # everything that has been queued in the meantime
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                closing = True
+                batch = [record for record in batch if record is not None]
+            self._file.writelines(self._dumps(record) + '\n' for record in batch)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _dumps(self, record):
+        try:
+            return json.dumps(record, default=_to_json)
+        except Exception as error:
+            self.errors += 1
+            print(f"TrialLog: record {record.get('event')!r} could not be written ({error!r}).",
+                  file=sys.stderr)
+            return json.dumps({'event': 'error', 'time': record.get('time'),
+                               'record_event': str(record.get('event')), 'error': repr(error)})
+
+#%% Summary
+#------------------------------------------------------------------------------
+
+def read_trial_log(fname):
+    """
+    Returns the records of a log. Incomplete lines (crash while writing) are
+    skipped.
+    """
+    records = []
+    with open(fname, encoding='utf-8') as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+def finalize_trial_log(fname, results_fname=None, **extra):
+    """
+    Assembles the summary of a run from its log and writes it as JSON.
+
+    Parameters
+    ----------
+    fname: str
+        path of the log
+    results_fname: str or None
+        path of the summary. The default is None (fname with _trials.jsonl
+        replaced by _cfg_results.json).
+    extra:
+        additional entries of the summary
+
+    Returns
+    -------
+    results_cfg: dict
+        playmatrix, triallabel, jitterlist (from the last 'run' record),
+        reaction times (from the 'response' records), number of trials played
+        and extra
+    """
+    records = read_trial_log(fname)
+    # only the last run in the log
+    starts = [index for index, record in enumerate(records) if record['event'] == 'run']
+    records = records[starts[-1]:] if starts else records
+    run = records[0] if starts else {}
+    results_cfg = {
+        'playmatrix': run.get('playmatrix', []),
+        'triallabel': run.get('triallabel', []),
+        'jitterlist': run.get('jitterlist', []),
+        'reaction times': [record['rt'] for record in records if record['event'] == 'response'],
+        'trials played': sum(record['event'] == 'trial' for record in records),
+        }
+    results_cfg.update(extra)
+
+    if results_fname is None:
+        base = fname[:-len('_trials.jsonl')] if fname.endswith('_trials.jsonl') else os.path.splitext(fname)[0]
+        results_fname = base + '_cfg_results.json'
+    with open(results_fname, 'w') as outfile:
+        json.dump(results_cfg, outfile)
+    return results_cfg
+
+if __name__ == '__main__':
+    for fname in sys.argv[1:]:
+        finalize_trial_log(fname)
+        print(f"Summary of {fname} written.")
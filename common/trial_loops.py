@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+"""
+Trial loops of the experiment scripts
+
+The hardware part of the trial loops (start of stimulus and trigger, onset
+time, waiting for the end of the trial) is shared by the experiment scripts
+and timing_benchmark.py, so the benchmark measures the code that runs in the
+lab. Window, keyboard, trial log and console output are added by the scripts
+with callbacks.
+
+- run_trials: loop over the trials (start of the trial, TrialRunner,
+  callbacks before and after the start and after the trial)
+- start_datapixx_trial / reset_trigger: DAC schedule and trigger word of a
+  trial with one register write (Oddball_datapixx_v1.py, 
+  Oddball_datapixx_v2.py)
+- start_soundmexpro_trial: loads the prebuilt buffer of a trial or refills the
+  queue in queue-ahead mode (Oddball_soundmexpro.py, Oddball_eeg_triggerbox.py)
+- start_triggerbox_trial: loads the prebuilt buffer of a trial and sends its
+  trigger to the TriggerBox (Oddball_brainproducts_triggerbox.py)
+- click_train_onsets / write_click_train / start_click_train /
+  monitor_click_train: whole click train with a single DAC and Dout schedule
+  (AEF_exp_v2.py, single_schedule = True)
+- start_click_trial / wait_click_trial: click by click (AEF_exp_v2.py,
+  single_schedule = False)
+
+Example
+-------
+    def start_trial(trial):
+        onset, hostOnset = start_datapixx_trial(dp, plan[trial], fs, channel, acquisition.lock,
+                                                clock=runner.clock)
+        return onset, plan[trial].trial_dur, hostOnset
+
+    aborted = run_trials(len(plan), start_trial, runner, events=[(TrigLen, trigger_off)],
+                         poll=poll_trial, before=before_trial, started=trial_started,
+                         finished=trial_finished)
+"""
+
+import time
+import numpy as np
+
+#%% Trial loop
+#------------------------------------------------------------------------------
+
+def run_trials(n_trials, start_trial, runner, events=(), poll=None, before=None,
+               started=None, finished=None):
+    """
+    Runs the trials one after another. The loop stops after a cancelled trial
+    (emergency stop).
+
+    Parameters
+    ----------
+    n_trials: int
+        number of trials
+    start_trial: callable
+        start_trial(trial) starts stimulus and trigger of a trial and returns
+        (startTime, TrialDur, hostOnset): onset in device time, duration and
+        onset on the clock of the runner (start of the trial in the runner,
+        so the time until the runner is called doesn't lengthen the trial)
+    runner: TrialRunner
+        runner of the trials
+    events: list of (float, callable)
+        timed events of every trial (e.g. trigger off). The default is ().
+    poll: callable or None
+        poll callback of the runner. The default is None.
+    before: callable or None
+        before(trial), called before the start (e.g. trial info, response
+        index). The default is None.
+    started: callable or None
+        started(trial, startTime, TrialDur), called after the start (e.g.
+        trial log). The default is None.
+    finished: callable or None
+        finished(trial, aborted), called after the trial. The default is None.
+
+    Returns
+    -------
+    aborted: bool
+        True if a trial was cancelled
+    """
+    for trial in range(n_trials):
+        if before is not None:
+            before(trial)
+        startTime, TrialDur, hostOnset = start_trial(trial)
+        if started is not None:
+            started(trial, startTime, TrialDur)
+        aborted = runner.run(TrialDur, events=events, poll=poll, start=hostOnset)
+        if finished is not None:
+            finished(trial, aborted)
+        if aborted:
+            return True
+    return False
+
+#%% DATAPixx oddball
+#------------------------------------------------------------------------------
+
+def start_datapixx_trial(dp, trialplan, fs, channel, lock, data=None, clock=time.perf_counter):
+    """
+    Starts the DAC schedule of a trial and turns on its trigger word with the
+    same register write (no trigger word for trigger 0, e.g. analog trigger 
+    channel).
+
+    Parameters
+    ----------
+    dp: module
+        pypixxlib._libdpx (or the simulated DATAPixx)
+    trialplan: Trial
+        row of the trial plan (address, frames, trigger)
+    fs: float
+        sampling rate in Hz
+    channel: list of int
+        DAC channels
+    lock: threading.RLock
+        lock of the register access (ResponseAcquisition.lock)
+    data: array or None
+        nChans x nFrames audio written to the buffer of the trial before the
+        start (no preloaded bank). The default is None.
+    clock: callable
+        host clock of the TrialRunner. The default is time.perf_counter.
+
+    Returns
+    -------
+    startTime: float
+        device time of the register write
+    hostOnset: float
+        host clock time of the register write
+    """
+    with lock:
+        if data is not None:
+            dp.DPxWriteDacBuffer(bufferData = data,
+                                 bufferAddress = trialplan.address,
+                                 channelList = channel)
+            dp.DPxWriteRegCache()
+        dp.DPxSetDacSchedule(onSet = 0, # Onset delay
+                             rateValue = fs, # sampling rate
+                             rateUnits = "Hz",
+                             maxScheduleFrames = trialplan.frames,
+                             channelList = channel,
+                             bufferBaseAddress = trialplan.address,
+                             numBufferFrames = trialplan.frames)
+        dp.DPxStartDacSched()
+        if trialplan.trigger:
+            # Turn on trigger channels
+            dp.DPxSetDoutValue(bit_value = trialplan.trigger,
+                               bit_mask = 16777215) # enable all 24 pins
+        dp.DPxUpdateRegCache() # Read and Write (sound and trigger at the same time)
+        hostOnset = clock()
+        return dp.DPxGetTime(), hostOnset
+
+def reset_trigger(dp, lock):
+    """
+    Turns off all trigger channels.
+    """
+    with lock:
+        dp.DPxSetDoutValue(bit_value = 0, bit_mask = 16777215)
+        dp.DPxWriteRegCache()
+
+#%% SoundMexPro oddball
+#------------------------------------------------------------------------------
+
+def start_soundmexpro_trial(player, plan, trial, dp, lock, queue_ahead=0, clock=time.perf_counter):
+    """
+    Starts a trial of the SoundMexPro oddball. Without queue-ahead the
+    prebuilt buffer of the trial is loaded into the running device, with
+    queue-ahead the queue is refilled (the trial has been queued before) and
+    the onset is computed from the play position. Without DATAPixx (dp=None)
+    the onset is taken from the host clock.
+
+    Parameters
+    ----------
+    player: SoundMexProPlayer
+        running player
+    plan: TrialPlan
+        plan of the run
+    trial: int
+        trial index
+    dp: module or None
+        pypixxlib._libdpx (or the simulated DATAPixx), clock of the onsets.
+        None: host clock.
+    lock: threading.RLock or None
+        lock of the register access (ResponseAcquisition.lock)
+    queue_ahead: int
+        number of trials queued in advance (0: no queue). The default is 0.
+    clock: callable
+        host clock of the TrialRunner. The default is time.perf_counter.
+
+    Returns
+    -------
+    startTime: float
+        onset in device time (host time without DATAPixx)
+    TrialDur: float
+        time from the onset until the next onset in s
+    hostOnset: float
+        onset on the host clock
+    position: int or None
+        play position of the device (None without queue-ahead)
+    """
+    trialplan = plan[trial]
+    if not queue_ahead:
+        player.play(trialplan.label)
+        startTime, hostOnset = _onset_times(dp, lock, clock)
+        return startTime, trialplan.trial_dur, hostOnset, None
+
+    if trial + queue_ahead < len(plan):
+        player.queue(plan[trial+queue_ahead].label, plan[trial+queue_ahead].silence)
+    # Onset of the trial in device and host time from the play position
+    position = player.position()
+    startTime, hostOnset = _onset_times(dp, lock, clock)
+    passed = (position - trialplan.onset) / plan.fs
+    # The trial ends with the onset of the next trial (sound card clock)
+    return startTime - passed, trialplan.trial_dur, hostOnset - passed, position
+
+def _onset_times(dp, lock, clock):
+    """
+    Current device and host time (host time twice without DATAPixx).
+    """
+    if dp is None:
+        hostOnset = clock()
+        return hostOnset, hostOnset
+    with lock:
+        dp.DPxUpdateRegCache()
+        hostOnset = clock()
+        return dp.DPxGetTime(), hostOnset
+
+#%% TriggerBox oddball
+#------------------------------------------------------------------------------
+
+def start_triggerbox_trial(player, trialplan, triggers, clock=time.perf_counter):
+    """
+    Loads the prebuilt buffer of a trial into the running device and sends its
+    trigger (reset after the pulse width by the TriggerScheduler).
+
+    Parameters
+    ----------
+    player: SoundMexProPlayer
+        running player
+    trialplan: Trial
+        row of the trial plan (label, trigger)
+    triggers: TriggerScheduler
+        scheduler of the TriggerBox
+    clock: callable
+        host clock of the TrialRunner. The default is time.perf_counter.
+
+    Returns
+    -------
+    hostOnset: float
+        host clock time before the buffer is loaded
+    """
+    hostOnset = clock()
+    player.play(trialplan.label)
+    triggers.send(trialplan.trigger)
+    return hostOnset
+
+#%% AEF click train
+#------------------------------------------------------------------------------
+
+def click_train_onsets(jitterlist, fs, Nsamples):
+    """
+    Onsets of the clicks on the sample grid (jitter rounded to samples).
+
+    Returns
+    -------
+    onsets: array of int
+        onset sample of each click
+    TotalFrames: int
+        frames of the whole click train
+    """
+    isi_samples = np.round(np.asarray(jitterlist)*fs).astype(int)
+    if isi_samples.min() < Nsamples:
+        raise ValueError('Jitter is shorter than the trial duration.')
+    onsets = np.concatenate(([0], np.cumsum(isi_samples[:-1])))
+    return onsets, int(isi_samples.sum())
+
+def render_chunk(start, stop, onsets, audio_data, trigger):
+    """
+    Renders the samples [start, stop) of the whole-run click train. Each trial
+    is placed at its onset sample, the time between the trials is filled with
+    zeros.
+
+    start, stop: first and last (exclusive) sample of the chunk
+    onsets: onset samples of all trials (sorted)
+    audio_data: nChans x nFrame audio of a single trial
+    trigger: nFrame trigger of a single trial
+
+    Returns nChans x (stop-start) audio and (stop-start) trigger samples.
+    """
+    Nsamples = audio_data.shape[1]
+    audio_chunk = np.zeros((audio_data.shape[0], stop-start))
+    trigger_chunk = np.zeros(stop-start, dtype=trigger.dtype)
+
+    # Only trials overlapping with the chunk
+    first = max(np.searchsorted(onsets, start, side='right') - 1, 0)
+    last = np.searchsorted(onsets, stop, side='left')
+    for onset in onsets[first:last]:
+        a = max(onset, start)
+        b = min(onset + Nsamples, stop)
+        if a < b:
+            audio_chunk[:, a-start:b-start] = audio_data[:, a-onset:b-onset]
+            trigger_chunk[a-start:b-start] = trigger[a-onset:b-onset]
+
+    return audio_chunk, trigger_chunk
+
+def write_click_train(dp, onsets, TotalFrames, audio_data, trigger, channel, ChunkFrames=2**20):
+    """
+    Renders the click train chunk by chunk into the DATAPixx RAM. 2 bytes per
+    sample and channel are needed for the DAC and 2 bytes per sample for the
+    Dout buffer, the Dout buffer follows the DAC buffer.
+
+    Returns
+    -------
+    DacAddress, DoutAddress: int
+        buffer addresses of audio and trigger
+    """
+    DacAddress = int(0)
+    DoutAddress = int(np.ceil(2*len(channel)*TotalFrames/4096)*4096)
+    if DoutAddress + 2*TotalFrames > dp.DPxGetRamSize():
+        raise ValueError('Click train does not fit into DATAPixx RAM.')
+    for start in range(0, TotalFrames, ChunkFrames):
+        stop = min(start + ChunkFrames, TotalFrames)
+        audio_chunk, trigger_chunk = render_chunk(start, stop, onsets, audio_data, trigger)
+        dp.DPxWriteDacBuffer(bufferData = audio_chunk,
+                             bufferAddress = DacAddress + 2*len(channel)*start,
+                             channelList = channel)
+        dp.DPxWriteDoutBuffer(bufferData = trigger_chunk,
+                              bufferAddress = DoutAddress + 2*start)
+    dp.DPxWriteRegCache()
+    return DacAddress, DoutAddress
+
+def start_click_train(dp, fs, channel, TotalFrames, DacAddress, DoutAddress):
+    """
+    Starts one DAC and one Dout schedule for the whole click train with the
+    same register write.
+
+    Returns
+    -------
+    startTime: float
+        device time of the register write
+    """
+    dp.DPxSetDacSchedule(scheduleOnset = 0,
+                         scheduleRate = fs,
+                         rateUnits = "Hz",
+                         maxScheduleFrames = TotalFrames,
+                         channelList = channel,
+                         bufferBaseAddress = DacAddress,
+                         numBufferFrames = TotalFrames)
+    dp.DPxStartDacSched()
+    dp.DPxSetDoutSchedule(scheduleOnset = 0.0,
+                          scheduleRate = fs,
+                          maxScheduleFrames = TotalFrames,
+                          bufferAddress = DoutAddress,
+                          numBufferFrames = TotalFrames)
+    dp.DPxStartDoutSched()
+    dp.DPxUpdateRegCache() # both schedules start with the same register write
+    return dp.DPxGetTime()
+
+def monitor_click_train(dp, startTime, onset_times, wait, interval=0.1, stop=None,
+                        on_trial=None):
+    """
+    Monitors the progress of the click train until the schedule has finished
+    (no busy waiting, the timing is handled by the device).
+
+    Parameters
+    ----------
+    wait: callable
+        wait(interval) between two reads of the device time
+    stop: callable or None
+        stop() returns True for an emergency stop. The default is None.
+    on_trial: callable or None
+        on_trial(trial) for every click that has been played. The default is
+        None.
+
+    Returns
+    -------
+    aborted: bool
+    """
+    trials_played = 0
+    running = True
+    while running:
+        wait(interval)
+        dp.DPxUpdateRegCache()
+        passedTime = dp.DPxGetTime() - startTime
+        running = dp.DPxIsDacSchedRunning()
+        if stop is not None and stop():
+            return True
+        # Onsets which already passed
+        trials_started = int(np.searchsorted(onset_times, passedTime, side='right'))
+        if on_trial is not None:
+            for trial in range(trials_played, trials_started):
+                on_trial(trial)
+        trials_played = trials_started
+    return False
+
+def start_click_trial(dp, fs, channel, Nsamples, DacAddress=int(0), DoutAddress=int(8e6)):
+    """
+    Starts the DAC and Dout schedule of a single click with the same register
+    write.
+
+    Returns
+    -------
+    startTime: float
+        device time of the register write
+    """
+    dp.DPxSetDacSchedule(scheduleOnset = 0,
+                         scheduleRate = fs,
+                         rateUnits = "Hz",
+                         maxScheduleFrames = Nsamples,
+                         channelList = channel,
+                         bufferBaseAddress = DacAddress,
+                         numBufferFrames = Nsamples)
+    dp.DPxStartDacSched()
+    dp.DPxSetDoutSchedule(scheduleOnset = 0.0,
+                          scheduleRate = fs,
+                          maxScheduleFrames = Nsamples,
+                          bufferAddress = DoutAddress,
+                          numBufferFrames = None)
+    dp.DPxStartDoutSched()
+    dp.DPxUpdateRegCache() # Read and Write
+    return dp.DPxGetTime()
+
+def wait_click_trial(dp, startTime, duration, wait, interval=0.001, stop=None):
+    """
+    Waits until duration has passed on the device clock, the device time is
+    read every interval.
+
+    Parameters
+    ----------
+    wait: callable
+        wait(interval) between two reads of the device time (core.wait spins
+        for waits shorter than its hogCPUperiod)
+    stop: callable or None
+        stop() returns True for an emergency stop. The default is None.
+
+    Returns
+    -------
+    aborted: bool
+    """
+    passedTime = 0
+    while passedTime < duration:
+        dp.DPxUpdateRegCache()
+        passedTime = dp.DPxGetTime() - startTime
+        if stop is not None and stop():
+            return True
+        wait(interval)
+    return False
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Trial plan compiler
+
+The timeline of a run is compiled once before the first trial from the
+playmatrix, the stimulus lengths and the jitter. All times are on the sample
+grid of the DAC / sound card: the jitter is rounded to whole samples and every
+onset is the sum of the preceding stimulus and jitter frames, so the planned
+onset-to-onset intervals are exact multiples of the sample period.
+
+The plan is an immutable structured array (TrialPlan.trials, read-only) with
+one row per trial:
+- trialtype: code of the playmatrix
+- onset: absolute onset sample (first trial at sample start)
+- frames: stimulus frames
+- silence: jitter frames after the stimulus
+- duration: frames until the next onset (frames + silence)
+- trial_dur: duration in s
+- address: DATAPixx buffer address or SoundMexPro track (-1: unused)
+- trigger: trigger word of the onset (0: unused)
+- response_start, response_stop: response window in samples after the onset
+  (0, 0: no response expected). The poll of the trial loops only accepts
+  button presses within the window.
+
+The trial loop only executes the plan. plan[trial] returns a prebuilt
+namedtuple of Python scalars, so there is no per-trial arithmetic, conversion
+or allocation.
+
+Example
+-------
+    plan = compile_trial_plan(playmatrix, jitterlist, fs, trialtypes,
+                              frames={'standard': len(sig_standard), 'target': len(sig_target)},
+                              triggers=event_values, response_types=['target'])
+    for trial in range(len(plan)):
+        trialplan = plan[trial]
+        ...
+        runner.run(trialplan.trial_dur, ...)
+"""
+
+from collections import namedtuple
+import numpy as np
+
+PLAN_DTYPE = np.dtype([('trialtype', np.int64),
+                       ('onset', np.int64),
+                       ('frames', np.int64),
+                       ('silence', np.int64),
+                       ('duration', np.int64),
+                       ('trial_dur', np.float64),
+                       ('address', np.int64),
+                       ('trigger', np.int64),
+                       ('response_start', np.int64),
+                       ('response_stop', np.int64)])
+
+Trial = namedtuple('Trial', ['label'] + list(PLAN_DTYPE.names))
+
+#%% Trial plan
+#------------------------------------------------------------------------------
+
+class TrialPlan:
+    """
+    Immutable timeline of a run (see compile_trial_plan).
+
+    Attributes
+    ----------
+    trials: structured array (read-only)
+        one row per trial (see PLAN_DTYPE)
+    labels: tuple
+        label of each trial
+    fs: float
+        sampling rate of the timeline
+    """
+
+    def __init__(self, trials, labels, fs):
+        trials.setflags(write=False)
+        self.trials = trials
+        self.labels = tuple(labels)
+        self.fs = fs
+        # Python scalars per trial, built once
+        self._rows = tuple(Trial(label, *row) for label, row in zip(self.labels, trials.tolist()))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, trial):
+        return self._rows[trial]
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    @property
+    def onsets(self):
+        """
+        Onsets in s.
+        """
+        return self.trials['onset'] / self.fs
+
+    def response_window(self, trial, onset):
+        """
+        Response window of a trial on the clock of onset.
+
+        Returns
+        -------
+        window: tuple or None
+            (start, stop) in s, None if no response is expected
+        """
+        row = self._rows[trial]
+        if row.response_stop <= row.response_start:
+            return None
+        return onset + row.response_start / self.fs, onset + row.response_stop / self.fs
+
+    def to_dict(self):
+        """
+        Columns as lists (e.g. for the results JSON).
+        """
+        return {name: self.trials[name].tolist() for name in PLAN_DTYPE.names}
+
+def _lookup(values, trialtypes, default, dtype):
+    """
+    Lookup table trialtype code -> value for a dict label -> value (or a
+    single value for all trial types).
+    """
+    table = np.full(max(trialtypes.values()) + 1, default, dtype=dtype)
+    for label, code in trialtypes.items():
+        if isinstance(values, dict):
+            if label in values:
+                table[code] = values[label]
+        elif values is not None:
+            table[code] = values
+    return table
+
+def compile_trial_plan(playmatrix, jitterlist, fs, trialtypes, frames, addresses=None,
+                       triggers=None, response_types=(), response_window=None, start=0):
+    """
+    Compiles the timeline of a run.
+
+    Parameters
+    ----------
+    playmatrix: array of int
+        trial type code per trial
+    jitterlist: array
+        silence after each stimulus in s (rounded to samples)
+    fs: float
+        sampling rate in Hz
+    trialtypes: dict
+        label -> code (e.g. {'standard': 0, 'target': 1})
+    frames: dict or int
+        label -> stimulus frames
+    addresses: dict, int or None
+        label -> buffer address / track. The default is None (-1).
+    triggers: dict, int or None
+        label -> trigger word at the onset. The default is None (0).
+    response_types: sequence of str
+        labels of the trials with a response. The default is ().
+    response_window: tuple or None
+        (start, stop) in s after the onset. The default is None (whole trial).
+    start: int
+        onset sample of the first trial. The default is 0.
+
+    Returns
+    -------
+    plan: TrialPlan
+    """
+    playmatrix = np.asarray(playmatrix, dtype=np.int64)
+    labels_by_code = {code: label for label, code in trialtypes.items()}
+
+    trials = np.zeros(len(playmatrix), dtype=PLAN_DTYPE)
+    trials['trialtype'] = playmatrix
+    trials['frames'] = _lookup(frames, trialtypes, 0, np.int64)[playmatrix]
+    trials['silence'] = np.round(np.asarray(jitterlist, dtype=float) * fs).astype(np.int64)
+    trials['duration'] = trials['frames'] + trials['silence']
+    # onset of each trial: sum of the durations of the preceding trials
+    trials['onset'] = start + np.cumsum(trials['duration']) - trials['duration']
+    trials['trial_dur'] = trials['duration'] / fs
+    trials['address'] = _lookup(addresses, trialtypes, -1, np.int64)[playmatrix]
+    trials['trigger'] = _lookup(triggers, trialtypes, 0, np.int64)[playmatrix]
+
+    has_response = np.isin(playmatrix, [trialtypes[label] for label in response_types])
+    if response_window is None:
+        window_start, window_stop = np.zeros(len(trials), dtype=np.int64), trials['duration']
+    else:
+        window_start = np.full(len(trials), round(response_window[0] * fs), dtype=np.int64)
+        window_stop = np.full(len(trials), round(response_window[1] * fs), dtype=np.int64)
+    trials['response_start'] = np.where(has_response, window_start, 0)
+    trials['response_stop'] = np.where(has_response, window_stop, 0)
+
+    return TrialPlan(trials, [labels_by_code[code] for code in playmatrix.tolist()], fs)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Event-driven trial loop
+
+Instead of polling the hardware every millisecond until the trial duration has
+passed, all deadlines of a trial (e.g. trigger off after 100 ms, end of trial)
+are known when the trial starts. The TrialRunner sleeps until the next
+meaningful event:
+- timed events: callbacks at fixed times after trial onset (precise, the last
+  spin_margin seconds before the deadline are spent spinning on the host clock,
+  no USB round trips)
+- poll: callback for button logs and keyboard, called every poll_interval
+  (button presses carry hardware timestamps, so a coarser poll interval does
+  not change the reaction times)
+- end of trial
+The runner can be cancelled from another thread (cancel, threading.Event, e.g.
+the emergency stop of the KeyboardService): it waits on the event instead of
+sleeping, so run() returns at most spin_margin after the event is set.
+
+Typical use
+-----------
+    runner = TrialRunner(poll_interval=0.01)
+    ...
+    dp.DPxUpdateRegCache()
+    hostOnset = runner.clock() # onset on the host clock
+    startTime = dp.DPxGetTime()
+    aborted = runner.run(TrialDur, events=[(0.1, trigger_off)], poll=poll_trial,
+                         start=hostOnset)
+"""
+
+import atexit
+import sys
+import time
+
+#%% Timer resolution
+#------------------------------------------------------------------------------
+
+_timer_resolution_set = False
+
+def set_timer_resolution():
+    """
+    On Windows, time.sleep is only precise to ~15.6 ms unless the resolution
+    of the system timer is set to 1 ms. The resolution is set once per process
+    and reset (timeEndPeriod) when the interpreter exits. Does nothing on other
+    platforms.
+    """
+    global _timer_resolution_set
+    if sys.platform == 'win32' and not _timer_resolution_set:
+        import ctypes
+        ctypes.windll.winmm.timeBeginPeriod(1)
+        atexit.register(ctypes.windll.winmm.timeEndPeriod, 1)
+        _timer_resolution_set = True
+
+#%% Trial runner
+#------------------------------------------------------------------------------
+
+class TrialRunner:
+    """
+    Runs single trials based on deadlines.
+
+    Parameters
+    ----------
+    poll_interval: float
+        time between two calls of the poll callback in s. The default is 0.01.
+    spin_margin: float
+        the last spin_margin seconds before a timed event or the end of a trial
+        are spent spinning on the host clock. The default is 0.002.
+    clock: callable
+        host clock in s. The default is time.perf_counter.
+    sleep: callable
+        sleep function. The default is time.sleep.
+    cancel: threading.Event or None
+        cancellation event, run() aborts the trial when it is set. The sleeps
+        wait on the event instead of calling sleep. The default is None.
+    """
+
+    def __init__(self, poll_interval=0.01, spin_margin=0.002, clock=time.perf_counter,
+                 sleep=time.sleep, cancel=None):
+        self.poll_interval = poll_interval
+        self.spin_margin = spin_margin
+        self.clock = clock
+        self.sleep = sleep
+        self.cancel = cancel
+        set_timer_resolution()
+
+    def _sleep(self, duration):
+        if self.cancel is None:
+            self.sleep(duration)
+        else:
+            # a cancellation wakes the runner up
+            self.cancel.wait(duration)
+
+    def wait_until(self, deadline, spin=True):
+        """
+        Sleeps until deadline (host clock). With spin=True the last spin_margin
+        seconds are spent spinning for a precise wake up.
+        """
+        remaining = deadline - self.clock()
+        if not spin:
+            if remaining > 0:
+                self._sleep(remaining)
+            return
+        if remaining > self.spin_margin:
+            self._sleep(remaining - self.spin_margin)
+        while self.clock() < deadline:
+            pass
+
+    def run(self, duration, events=(), poll=None, start=None):
+        """
+        Runs one trial.
+
+        Parameters
+        ----------
+        duration: float
+            trial duration in s (relative to start)
+        events: list of (time, callback)
+            callbacks without arguments, called once at time s after start
+            (time <= duration, otherwise ValueError)
+        poll: callable or None
+            poll(passedTime) is called every poll_interval. If it returns True
+            the trial is aborted.
+        start: float or None
+            host clock time of the trial start. The default is None (now).
+
+        Returns
+        -------
+        aborted: bool
+            True if poll returned True or the cancellation event was set
+        """
+        t0 = self.clock() if start is None else start
+        pending = sorted(events, key=lambda event: event[0])
+        if pending and pending[-1][0] > duration:
+            raise ValueError(f"Event at {pending[-1][0]} s is after the end of the trial "
+                             f"({duration} s) and would never be called.")
+        next_poll = 0.0
+
+        while True:
+            if self.cancel is not None and self.cancel.is_set():
+                return True
+            passedTime = self.clock() - t0
+
+            # Timed events
+            while pending and pending[0][0] <= passedTime:
+                pending.pop(0)[1]()
+
+            if passedTime >= duration:
+                return False
+
+            # Poll button logs / keyboard
+            if poll is not None and passedTime >= next_poll:
+                if poll(passedTime):
+                    return True
+                next_poll += self.poll_interval
+                if next_poll <= passedTime:
+                    # poll was late, don't catch up with several calls
+                    next_poll = passedTime + self.poll_interval
+
+            # Sleep until next deadline
+            deadline = duration
+            if pending:
+                deadline = min(deadline, pending[0][0])
+            hard_deadline = True
+            if poll is not None and next_poll < deadline:
+                deadline = next_poll
+                hard_deadline = False
+            self.wait_until(t0 + deadline, spin=hard_deadline)
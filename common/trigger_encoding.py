@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Trigger word encoding of the SoundMexPro trigger tracks
+
+The trigger track of the SoundMexPro scripts is sent via SPDIF to the trigger
+interface, which reads the sample value as a bit pattern. The first bit of the
+interface (value 1 in the sum channel) is the most significant bit of the
+sample, i.e. the bits of the event value are reversed:
+    sample = bitreverse(value, bits) / 2**bits
+- bits = 16: MEG trigger interface
+- bits = 8: EEG (NeurOne System)
+
+The TriggerEncoder precomputes the lookup table value -> sample for all
+2**bits values once. encode() converts whole event vectors with one indexing
+operation, decode() converts a recorded trigger track back to event values
+and marks samples that are no exact trigger word, so recordings can be
+checked bit-exactly against what was sent.
+
+Formats
+-------
+- 'spdif': bit-reversed sample value in [0, 1) (SoundMexPro trigger track)
+- 'triggerbox': the event value itself (Brain Products TriggerBox byte)
+
+Example
+-------
+    encoder = TriggerEncoder(bits=16)
+    encoder.encode([1, 2])          # array([0.5 , 0.25])
+    encoder.decode(trigger_track)   # event value per sample, -1: no trigger word
+"""
+
+import functools
+import numpy as np
+
+FORMATS = ['spdif', 'triggerbox']
+
+#%% Encoder
+#------------------------------------------------------------------------------
+
+def bitreverse(values, bits):
+    """
+    Reverses the lowest bits of integer values (vectorized).
+    """
+    values = np.asarray(values, dtype=np.int64)
+    reversed_values = np.zeros_like(values)
+    for bit in range(bits):
+        reversed_values |= ((values >> bit) & 1) << (bits - 1 - bit)
+    return reversed_values
+
+class TriggerEncoder:
+    """
+    Lookup-table encoder/decoder of trigger words.
+
+    Parameters
+    ----------
+    bits: int
+        bit depth of the trigger interface (16: MEG, 8: EEG). The default is
+        16.
+    fmt: str
+        'spdif' or 'triggerbox'. The default is 'spdif'.
+    """
+
+    def __init__(self, bits=16, fmt='spdif'):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown format '{fmt}', use one of {FORMATS}.")
+        self.bits = bits
+        self.fmt = fmt
+        codes = np.arange(2**bits, dtype=np.int64)
+        if fmt == 'spdif':
+            # value -> sample, and integer sample pattern -> value (the bit
+            # reversal is its own inverse)
+            self.table = bitreverse(codes, bits) / 2**bits
+            self._decode_table = bitreverse(codes, bits)
+        else:
+            self.table = codes
+            self._decode_table = codes
+        self.table.setflags(write=False)
+
+    def encode(self, values):
+        """
+        Sample values of event values (scalar or array).
+        """
+        values = np.asarray(values)
+        if values.size and (values.min() < 0 or values.max() >= 2**self.bits):
+            raise ValueError(f"Event values have to be in [0, {2**self.bits - 1}].")
+        samples = self.table[values]
+        return samples if samples.ndim else samples.item()
+
+    def decode(self, samples):
+        """
+        Event values of a recorded trigger track. Samples that are no exact
+        trigger word (e.g. scaled or dithered) are -1.
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        scale = 2**self.bits if self.fmt == 'spdif' else 1
+        patterns = np.rint(samples * scale)
+        valid = (patterns == samples * scale) & (patterns >= 0) & (patterns < 2**self.bits)
+        values = np.full(samples.shape, -1, dtype=np.int64)
+        values[valid] = self._decode_table[patterns[valid].astype(np.int64)]
+        return values
+
+@functools.lru_cache(maxsize=None)
+def get_encoder(bits=16, fmt='spdif'):
+    """
+    Shared encoder per bit depth and format (the table is built once).
+    """
+    return TriggerEncoder(bits, fmt)
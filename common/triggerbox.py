@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Brain Products TriggerBox (serial port)
+
+A trigger pulse is a write of the trigger value followed by a write of 0x00
+after the pulse width. Sending it on the main thread with time.sleep stalls
+the trial loop, keyboard polling and win.flip for the whole pulse.
+
+TriggerScheduler
+----------------
+Trigger values are put into a bounded queue (send returns immediately). A
+worker thread writes the values, timestamps every write on the host clock
+and resets the line after the pulse width. Pulses that overlap (e.g. a button
+press during a stimulus trigger) are merged: the line carries the bitwise OR
+of all active pulses and is reset when the last one has ended, so no trigger
+is lost.
+
+TriggerReader
+-------------
+The TriggerBox echoes the values written to it. A reader thread blocks in
+port.read with a timeout (no CPU time while nothing arrives) and stores each
+returned byte with a host clock timestamp in a preallocated ring buffer. The
+reader thread is the only writer of the ring buffer, the experiment reads a
+snapshot with get() without locks.
+
+Example
+-------
+    port = backend.serial.Serial(comPort)
+    reader = TriggerReader(port)
+    reader.start()
+    triggers = TriggerScheduler(port, pulse_width=0.01)
+    triggers.start() # sets the line to 0x00
+    ...
+    triggers.send(trigVal)
+    ...
+    triggers.close()
+    reader.stop()
+    times, values = reader.get()
+    port.close()
+"""
+
+import queue
+import threading
+import time
+import numpy as np
+
+from trial_runner import set_timer_resolution
+
+#%% Trigger scheduler
+#------------------------------------------------------------------------------
+
+class TriggerScheduler:
+    """
+    Sends trigger pulses on a serial port from a worker thread.
+
+    Parameters
+    ----------
+    port: serial.Serial
+        open serial port of the TriggerBox
+    pulse_width: float
+        duration of a pulse in s. The default is 0.01.
+    maxsize: int
+        maximum number of pending triggers. The default is 64.
+    clock: callable
+        host clock in s. The default is time.perf_counter.
+
+    Attributes
+    ----------
+    log: list
+        (time, value) of every write to the port (host clock)
+    dropped: int
+        number of triggers not sent because the queue was full
+    """
+
+    def __init__(self, port, pulse_width=0.01, maxsize=64, clock=time.perf_counter):
+        self.port = port
+        self.pulse_width = pulse_width
+        self.clock = clock
+        self.log = []
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+        set_timer_resolution()
+
+    def start(self):
+        """
+        Sets the line to 0x00 and starts the worker thread.
+        """
+        self._write(0)
+        self._thread = threading.Thread(target=self._run, name='TriggerScheduler',
+                                        daemon=True)
+        self._thread.start()
+
+    def send(self, value):
+        """
+        Schedules a pulse with the given value (non-blocking). Returns False if
+        the queue is full and the trigger was dropped.
+        """
+        try:
+            self._queue.put_nowait(int(value))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def close(self, timeout=1.0):
+        """
+        Sends the pending pulses, resets the line and stops the worker thread.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _write(self, value):
+        self.port.write([value])
+        self.log.append((self.clock(), value))
+
+    def _run(self):
+        active = [] # end times and values of the active pulses
+        line = 0
+        stopping = False
+        while active or not stopping:
+            timeout = max(min(end for end, _ in active) - self.clock(), 0) if active else None
+            value = None
+            if stopping:
+                time.sleep(timeout)
+            else:
+                try:
+                    value = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    pass
+                else:
+                    # None: close() was called
+                    stopping = value is None
+            now = self.clock()
+            active = [(end, active_value) for end, active_value in active if end > now]
+            if value is not None:
+                # the pulse width starts with the write
+                active.append((None, value))
+            merged = 0
+            for _, active_value in active:
+                merged |= active_value
+            if merged != line:
+                self._write(merged)
+                line = merged
+                now = self.log[-1][0]
+            active = [(now + self.pulse_width if end is None else end, active_value)
+                      for end, active_value in active]
+
+#%% Trigger reader
+#------------------------------------------------------------------------------
+
+class TriggerReader:
+    """
+    Records the bytes echoed by the TriggerBox from a reader thread.
+
+    Parameters
+    ----------
+    port: serial.Serial
+        open serial port of the TriggerBox (its read timeout is set to timeout)
+    size: int
+        capacity of the ring buffer (older entries are overwritten). The
+        default is 65536.
+    timeout: float
+        read timeout in s, i.e. the maximum time stop() has to wait for the
+        thread. The default is 0.1.
+    clock: callable
+        host clock in s. The default is time.perf_counter.
+    """
+
+    def __init__(self, port, size=65536, timeout=0.1, clock=time.perf_counter):
+        self.port = port
+        self.port.timeout = timeout
+        self.size = size
+        self.clock = clock
+        self.times = np.zeros(size)
+        self.values = np.zeros(size, dtype=np.uint8)
+        self.count = 0 # number of bytes received, only written by the thread
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='TriggerReader',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        """
+        Stops the reader thread (returns after at most one read timeout).
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def get(self, start=0):
+        """
+        Returns times and values of the bytes received since the start-th byte
+        (at most the last size bytes).
+
+        Returns
+        -------
+        times: array
+            host clock in s
+        values: array of uint8
+        """
+        count = self.count
+        start = max(start, count - self.size, 0)
+        index = np.arange(start, count) % self.size
+        return self.times[index], self.values[index]
+
+    def _run(self):
+        while self._running:
+            try:
+                data = self.port.read(1)
+                if data:
+                    # the rest of a burst (same timestamp)
+                    data += self.port.read(self.port.in_waiting)
+            except Exception:
+                # port closed
+                break
+            if not data:
+                continue
+            now = self.clock()
+            for value in data:
+                index = self.count % self.size
+                self.times[index] = now
+                self.values[index] = value
+                self.count += 1